@@ -0,0 +1,119 @@
+# Compact and archive rooms in a separate process from the web server, so
+# compaction can be scaled without taking CPU from the websocket workers. Run with
+# IN_PROCESS_COMPACTION=false on the web server so the two don't compete for the
+# replacement lock
+
+import argparse
+import asyncio
+import logging.config
+import signal
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from uuid import uuid4
+
+import scout_apm.core
+import timber
+from scout_apm.api import Config as ScoutConfig
+
+from src.compaction import Compactor
+from src.config import config
+from src.redis import create_redis_pool
+from src.room_store.configured_room_store import create_configured_room_store
+from src.room_store.filesystem_room_archive import create_filesystem_room_archive
+from src.room_store.indexed_room_archive import IndexedRoomArchive
+from src.room_store.room_store import COMPACTION_INTERVAL_SECONDS
+from src.room_store.s3_room_archive import S3RoomArchive
+from src.s3 import create_s3_context
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Compact and archive rooms')
+    parser.add_argument(
+        '--interval',
+        type=int,
+        default=COMPACTION_INTERVAL_SECONDS,
+        help='Seconds to wait between compaction cycles',
+    )
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=config.compaction_concurrency,
+        help='Number of rooms to compact at once',
+    )
+    parser.add_argument(
+        '--processes',
+        type=int,
+        default=config.compaction_processes,
+        help='Number of processes to replay rooms in, or 0 to replay them on the '
+        'event loop',
+    )
+    parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='Report what compaction would do without changing anything',
+    )
+    return parser.parse_args()
+
+
+async def main(args: argparse.Namespace) -> None:
+    compaction_id = str(uuid4())
+    timber.context(server={'compaction_id': compaction_id})
+
+    redis = await create_redis_pool(config.redis_address, config.redis_ssl_validation)
+    room_store_context = create_configured_room_store(redis, config.room_storage)
+    s3_client_context = create_s3_context(
+        config.aws_region,
+        config.aws_endpoint,
+        config.aws_key_id,
+        config.aws_secret_key,
+    )
+    executor_context = (
+        ProcessPoolExecutor(args.processes) if args.processes else nullcontext()
+    )
+
+    async with (
+        room_store_context as room_store,
+        s3_client_context as s3_client,
+        (
+            create_filesystem_room_archive(config.archive_dir)
+            if config.archive_dir
+            else nullcontext(S3RoomArchive(s3_client, config.aws_bucket))
+        ) as base_archive,
+    ):
+        with executor_context as executor:
+            room_archive = IndexedRoomArchive(base_archive, redis)
+            compactor = Compactor(
+                room_store,
+                room_archive,
+                compaction_id,
+                args.concurrency,
+                executor,
+                args.interval,
+                args.dry_run,
+            )
+
+            async def compact() -> None:
+                if not args.dry_run:
+                    await room_archive.index_if_missing()
+                await compactor.maintain_compaction()
+
+            compaction_task = asyncio.create_task(compact())
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGTERM, compaction_task.cancel
+            )
+            try:
+                await compaction_task
+            except asyncio.CancelledError:
+                logger.info('Compactor shutting down')
+
+    # aclose does exist, but mypy doesn't know about it
+    await redis.aclose()  # type: ignore
+
+
+if __name__ == '__main__':
+    logging.config.dictConfig(config.log_config)
+    ScoutConfig.set(**config.scout_config)
+    scout_apm.core.install()
+    asyncio.run(main(parse_args()))
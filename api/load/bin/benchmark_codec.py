@@ -0,0 +1,79 @@
+# Compare the codec in src.api.codec with the dacite/asdict based conversions it
+# replaced, on a typical request and a room's worth of stored tokens
+
+import json
+import timeit
+from collections.abc import Callable
+from dataclasses import asdict
+from typing import Any
+
+import dacite
+
+from src.api.api_structures import Request, UpsertAction
+from src.api.codec import decode_request, encode_action, encode_request
+from src.colors import colors
+from src.game_components import IconTokenContents, Token
+
+ROOM_SIZE = 500
+
+
+def _token(i: int) -> Token:
+    return Token(
+        f'token-{i}',
+        'character',
+        IconTokenContents('icon'),
+        i,
+        0,
+        0,
+        i + 1,
+        1,
+        1,
+        colors[i % len(colors)],
+    )
+
+
+def _report(
+    name: str, number: int, old: Callable[[], Any], new: Callable[[], Any]
+) -> None:
+    old_secs = min(timeit.repeat(old, number=number, repeat=5)) / number
+    new_secs = min(timeit.repeat(new, number=number, repeat=5)) / number
+    print(
+        f'{name:<24} dacite/asdict: {old_secs * 1e6:9.1f}us'
+        f'  codec: {new_secs * 1e6:9.1f}us  ({old_secs / new_secs:.1f}x)'
+    )
+
+
+def main() -> None:
+    request = Request('request-id', [UpsertAction(_token(0))])
+    request_json = json.loads(json.dumps(asdict(request)))
+    room = Request('room', [UpsertAction(_token(i)) for i in range(ROOM_SIZE)])
+    room_json = json.loads(json.dumps(asdict(room)))
+
+    _report(
+        'decode request',
+        10_000,
+        lambda: dacite.from_dict(Request, request_json),
+        lambda: decode_request(request_json),
+    )
+    _report(
+        'encode request',
+        10_000,
+        lambda: asdict(request),
+        lambda: encode_request(request),
+    )
+    _report(
+        f'decode {ROOM_SIZE} tokens',
+        20,
+        lambda: dacite.from_dict(Request, room_json),
+        lambda: decode_request(room_json),
+    )
+    _report(
+        f'encode {ROOM_SIZE} tokens',
+        20,
+        lambda: list(map(asdict, room.actions)),
+        lambda: list(map(encode_action, room.actions)),
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+# Compare sending each response in its own websocket message with sending batched
+# responses, for a room of busy clients. Every message sent is a write to the
+# client's socket, so messages per update is roughly syscalls per update
+
+import asyncio
+import json
+import random
+from collections.abc import AsyncIterator, Mapping, Sequence
+from dataclasses import dataclass, field
+from uuid import uuid4
+
+from src.api.api_structures import (
+    BATCHED_RESPONSES_SUBPROTOCOL,
+    BYPASS_RATE_LIMIT_HEADER,
+    Request,
+    UpsertAction,
+)
+from src.api.codec import encode_request
+from src.api.wsmanager import WebsocketManager
+from src.colors import colors
+from src.game_components import IconTokenContents, Token
+from src.game_state_server import GameStateServer
+from src.rate_limit.memory_rate_limit import MemoryRateLimiter, MemoryRateLimiterStorage
+from src.rate_limit.noop_rate_limit import NoopRateLimiter
+from src.room_cache import RoomCache
+from src.room_store.memory_room_store import MemoryRoomStorage, MemoryRoomStore
+
+CLIENTS_PER_ROOM = 20
+UPDATES_PER_CLIENT = 12
+# How often the web client sends its queued actions
+SEND_INTERVAL_SECONDS = 0.25
+BYPASS_KEY = 'benchmark'
+
+
+def _frame_header_bytes(payload_bytes: int) -> int:
+    """Size of the header of an unmasked websocket frame sent by the server"""
+    if payload_bytes < 126:
+        return 2
+    if payload_bytes < 2**16:
+        return 4
+    return 10
+
+
+@dataclass
+class _CountingClient:
+    """A websocket client that counts what's sent to it instead of sending it"""
+
+    index: int
+    room_id: str
+    batched: bool
+    requests_q: asyncio.Queue[str | None] = field(default_factory=asyncio.Queue)
+    messages: int = 0
+    bytes: int = 0
+    updates: int = 0
+    connected: asyncio.Event = field(default_factory=asyncio.Event)
+
+    async def send(self, msg: str) -> None:
+        payload_bytes = len(msg.encode())
+        self.messages += 1
+        self.bytes += payload_bytes + _frame_header_bytes(payload_bytes)
+        decoded = json.loads(msg)
+        for response in decoded if self.batched else [decoded]:
+            if response['type'] == 'connected':
+                self.connected.set()
+            elif response['type'] == 'update':
+                self.updates += 1
+
+    async def requests(self) -> AsyncIterator[str]:
+        while (request := await self.requests_q.get()) is not None:
+            yield request
+
+    def ip(self) -> str:
+        return f'10.0.0.{self.index}'
+
+    async def close(self, code: int) -> None:
+        pass
+
+    def path(self) -> str:
+        return f'/{self.room_id}'
+
+    async def accept(self, subprotocol: str | None = None) -> None:
+        pass
+
+    def headers(self) -> Mapping[str, str]:
+        return {BYPASS_RATE_LIMIT_HEADER: BYPASS_KEY}
+
+    def subprotocols(self) -> Sequence[str]:
+        return [BATCHED_RESPONSES_SUBPROTOCOL] if self.batched else []
+
+    def query_params(self) -> Mapping[str, str]:
+        return {}
+
+
+def _request(client_index: int, update_index: int) -> str:
+    token = Token(
+        f'token-{client_index}',
+        'character',
+        IconTokenContents('icon'),
+        update_index,
+        client_index,
+        0,
+        update_index + 1,
+        client_index + 1,
+        1,
+        colors[client_index % len(colors)],
+    )
+    request = Request(f'{client_index}-{update_index}', [UpsertAction(token)])
+    return json.dumps(encode_request(request))
+
+
+async def _drag(client: _CountingClient) -> None:
+    await asyncio.sleep(random.uniform(0, SEND_INTERVAL_SECONDS))
+    for i in range(UPDATES_PER_CLIENT):
+        await client.requests_q.put(_request(client.index, i))
+        await asyncio.sleep(SEND_INTERVAL_SECONDS)
+
+
+async def _run(batched: bool) -> None:
+    room_store = MemoryRoomStore(MemoryRoomStorage())
+    rate_limiter = MemoryRateLimiter('benchmark', MemoryRateLimiterStorage())
+    gss = GameStateServer(
+        room_store, RoomCache(room_store), rate_limiter, NoopRateLimiter()
+    )
+    ws = WebsocketManager(gss, rate_limiter, BYPASS_KEY)
+    room_id = str(uuid4())
+    clients = [_CountingClient(i, room_id, batched) for i in range(CLIENTS_PER_ROOM)]
+
+    handlers = [
+        asyncio.create_task(ws.connection_handler(client)) for client in clients
+    ]
+    await asyncio.gather(*(client.connected.wait() for client in clients))
+    await asyncio.gather(*map(_drag, clients))
+
+    expected_updates = CLIENTS_PER_ROOM * UPDATES_PER_CLIENT
+    while any(client.updates < expected_updates for client in clients):
+        await asyncio.sleep(0.01)
+    for client in clients:
+        await client.requests_q.put(None)
+    await asyncio.gather(*handlers)
+
+    updates = sum(client.updates for client in clients)
+    messages = sum(client.messages for client in clients)
+    sent_bytes = sum(client.bytes for client in clients)
+    print(
+        f'{"batched" if batched else "one per message":<16}'
+        f' messages/update: {messages / updates:5.2f}'
+        f'  bytes/update: {sent_bytes / updates:6.1f}'
+    )
+
+
+def main() -> None:
+    print(
+        f'{CLIENTS_PER_ROOM} clients per room, each sending an update every'
+        f' {SEND_INTERVAL_SECONDS * 1000:.0f}ms'
+    )
+    asyncio.run(_run(batched=False))
+    asyncio.run(_run(batched=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,12 +5,12 @@ import asyncio
 from load.clear_load_test_rooms import clear_load_test_rooms
 from src.config import config
 from src.redis import create_redis_pool
-from src.room_store.redis_room_store import create_redis_room_store
+from src.room_store.configured_room_store import create_configured_room_store
 
 
 async def main() -> None:
     redis = await create_redis_pool(config.redis_address, config.redis_ssl_validation)
-    async with create_redis_room_store(redis) as room_store:
+    async with create_configured_room_store(redis, config.room_storage) as room_store:
         await clear_load_test_rooms(room_store)
 
 
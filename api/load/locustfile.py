@@ -4,7 +4,6 @@ import random
 import ssl
 import time
 import uuid
-from dataclasses import asdict
 
 from locust import User, between, task
 from locust.env import Environment
@@ -19,6 +18,7 @@ from src.api.api_structures import (
     Request,
     UpsertAction,
 )
+from src.api.codec import encode_request
 from src.game_components import IconTokenContents, Ping, Token
 
 CONNECTION_TIMEOUT_SECONDS = 10
@@ -77,7 +77,7 @@ class TTBudClient:
             raise RuntimeError('ws not set up, connect was not called before send')
         start_time = time.time()
         try:
-            self._ws.send(json.dumps(asdict(request)))
+            self._ws.send(json.dumps(encode_request(request)))
             while True:
                 raw_resp = self._ws.recv()
                 resp = json.loads(raw_resp)
@@ -10,9 +10,12 @@ from asyncio import (
     Future,
     Handle,
     Protocol,
+    Task,
     Transport,
 )
 from collections.abc import Awaitable, Callable
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import AbstractAsyncContextManager, nullcontext
 from functools import partial
 from socket import gaierror
 from typing import Any, TypedDict, cast
@@ -21,7 +24,6 @@ from uuid import uuid4
 import scout_apm.core
 import timber
 import uvicorn
-from aiobotocore.session import ClientCreatorContext, get_session
 from aiohttp import ClientConnectorError
 from botocore.exceptions import ClientError
 from scout_apm.api import Config as ScoutConfig
@@ -37,10 +39,16 @@ from src.game_state_server import GameStateServer
 from src.rate_limit.noop_rate_limit import NoopRateLimiter
 from src.rate_limit.redis_rate_limit import create_redis_rate_limiter
 from src.redis import create_redis_pool
+from src.room_cache import RoomCache
+from src.room_store.configured_room_store import create_configured_room_store
+from src.room_store.disk_cached_room_archive import DiskCachedRoomArchive
+from src.room_store.filesystem_room_archive import create_filesystem_room_archive
+from src.room_store.indexed_room_archive import IndexedRoomArchive
 from src.room_store.merged_room_store import MergedRoomStore
-from src.room_store.redis_room_store import create_redis_room_store
+from src.room_store.room_archive import ObjectRoomArchive, RoomArchive
 from src.room_store.s3_room_archive import S3RoomArchive
 from src.routes import routes
+from src.s3 import create_s3_context
 from src.usage_stats import get_usage_stats
 from src.util.async_util import end_task
 from src.util.lazy_asgi import LazyASGI
@@ -63,17 +71,6 @@ class ExceptionContext(TypedDict):
     socket: socket.socket | None
 
 
-def create_s3_context() -> ClientCreatorContext:
-    s3_client_context = get_session().create_client(
-        's3',
-        region_name=config.aws_region,
-        endpoint_url=config.aws_endpoint,
-        aws_access_key_id=config.aws_key_id,
-        aws_secret_access_key=config.aws_secret_key,
-    )
-    return s3_client_context
-
-
 async def make_app() -> Starlette:
     shutting_down = False
     worker_id = str(uuid4())
@@ -98,19 +95,66 @@ async def make_app() -> Starlette:
     loop.set_exception_handler(exception_handler)
 
     redis = await create_redis_pool(config.redis_address, config.redis_ssl_validation)
-    room_store_context = create_redis_room_store(redis)
+    write_batch_window_seconds = (
+        config.write_batch_window_ms / 1000 if config.write_batching else None
+    )
+    room_store_context = create_configured_room_store(
+        redis,
+        config.room_storage,
+        write_batch_window_seconds,
+        config.eager_compaction_length,
+    )
     redis_room_store = await room_store_context.__aenter__()
     rate_limiter = await create_redis_rate_limiter(server_id, redis)
 
-    s3_client_context = create_s3_context()
+    s3_client_context = create_s3_context(
+        config.aws_region,
+        config.aws_endpoint,
+        config.aws_key_id,
+        config.aws_secret_key,
+    )
     s3_client = await s3_client_context.__aenter__()
-    room_archive = S3RoomArchive(s3_client, config.aws_bucket)
-    compactor = Compactor(redis_room_store, room_archive, worker_id)
+    base_archive_context: AbstractAsyncContextManager[ObjectRoomArchive] = (
+        create_filesystem_room_archive(config.archive_dir)
+        if config.archive_dir
+        else nullcontext(S3RoomArchive(s3_client, config.aws_bucket))
+    )
+    base_archive = await base_archive_context.__aenter__()
+    indexed_archive = IndexedRoomArchive(base_archive, redis)
+    # The cache goes in front of the index, so an unchanged room that's cached is
+    # read without asking the archive
+    room_archive: RoomArchive = (
+        DiskCachedRoomArchive(
+            indexed_archive, config.archive_cache_dir, config.archive_cache_max_bytes
+        )
+        if config.archive_cache_dir
+        else indexed_archive
+    )
 
     merged_room_store = MergedRoomStore(redis_room_store, room_archive)
-    gss = GameStateServer(merged_room_store, rate_limiter, NoopRateLimiter())
-    ws = WebsocketManager(gss, rate_limiter, config.bypass_rate_limit_key)
-    stat_getter = partial(get_usage_stats, redis_room_store, rate_limiter)
+    room_cache = RoomCache(
+        merged_room_store,
+        max_queued_updates=config.max_queued_updates,
+        slow_connection_policy=config.slow_connection_policy,
+        coalesce_queued_updates=config.coalesce_queued_updates,
+        snapshot_interval_requests=config.snapshot_interval_requests,
+    )
+    gss = GameStateServer(
+        merged_room_store,
+        room_cache,
+        rate_limiter,
+        NoopRateLimiter(),
+        # Unbatched writes can reach redis out of order if they overlap
+        config.max_writes_in_flight if config.write_batching else 1,
+    )
+    ws = WebsocketManager(
+        gss,
+        rate_limiter,
+        config.bypass_rate_limit_key,
+        frame_batch_window_seconds=config.frame_batch_window_ms / 1000,
+        max_frame_batch_bytes=config.max_frame_batch_bytes,
+    )
+    stat_getter = partial(get_usage_stats, redis_room_store, rate_limiter, room_cache)
     stats_view: Callable[[Request], Awaitable[Response]] = partial(
         stats_endpoint, stat_getter
     )
@@ -118,21 +162,48 @@ async def make_app() -> Starlette:
     liveness_task = asyncio.create_task(
         ws.maintain_liveness(), name='maintain_liveness'
     )
-    compactor_task = asyncio.create_task(
-        compactor.maintain_compaction(), name='maintain_compaction'
+    # Compaction can instead be run separately with compactor.py
+    compaction_executor: ProcessPoolExecutor | None = None
+    compactor_task: Task | None = None
+    index_task: Task | None = None
+    if config.in_process_compaction:
+        index_task = asyncio.create_task(
+            indexed_archive.index_if_missing(), name='index_room_archive'
+        )
+        if config.compaction_processes:
+            compaction_executor = ProcessPoolExecutor(config.compaction_processes)
+        compactor = Compactor(
+            redis_room_store,
+            room_archive,
+            worker_id,
+            config.compaction_concurrency,
+            compaction_executor,
+        )
+        compactor_task = asyncio.create_task(
+            compactor.maintain_compaction(), name='maintain_compaction'
+        )
+    room_cache_task = asyncio.create_task(
+        room_cache.maintain_invalidation(), name='maintain_room_cache'
     )
 
     async def shutdown() -> None:
         nonlocal shutting_down
         shutting_down = True
 
+        if compactor_task:
+            await end_task(compactor_task)
+        if index_task:
+            await end_task(index_task)
         await room_store_context.__aexit__(None, None, None)
         await asyncio.gather(
             redis.close(),
             end_task(liveness_task),
-            end_task(compactor_task),
+            end_task(room_cache_task),
         )
+        await base_archive_context.__aexit__(None, None, None)
         await s3_client_context.__aexit__(None, None, None)
+        if compaction_executor:
+            compaction_executor.shutdown()
 
     return Starlette(
         routes=routes(stats_view, ws),
@@ -146,7 +217,12 @@ app = LazyASGI(make_app)
 
 async def wait_for_s3_ready() -> None:
     logger.info('waiting for s3 bucket to exist')
-    async with create_s3_context() as client:
+    async with create_s3_context(
+        config.aws_region,
+        config.aws_endpoint,
+        config.aws_key_id,
+        config.aws_secret_key,
+    ) as client:
         while True:
             try:
                 await client.head_bucket(Bucket=config.aws_bucket)
@@ -5,6 +5,12 @@ from typing import Literal
 from src.game_components import Ping, Token
 
 BYPASS_RATE_LIMIT_HEADER = 'X-BYPASS-RATE-LIMITER'
+# Clients that ask for this websocket subprotocol are sent arrays of responses,
+# each holding every response made in a short window
+BATCHED_RESPONSES_SUBPROTOCOL = 'ttbud.batched-responses'
+# Clients reconnecting to a room pass the last version of the room they saw in this
+# query parameter, so they can be sent just the updates they missed
+LAST_SEEN_VERSION_PARAM = 'version'
 
 
 @dataclass
@@ -31,6 +37,9 @@ Action = UpsertAction | DeleteAction | PingAction
 @dataclass
 class ConnectionResponse:
     data: Iterable[Token]
+    # The version of the room the tokens are from, if it has one. Not compared,
+    # since it's decided by the room store rather than by what's in the response
+    version: int | None = field(default=None, compare=False)
     type: Literal['connected'] = field(init=False, default='connected')
 
 
@@ -38,7 +47,12 @@ class ConnectionResponse:
 class UpdateResponse:
     actions: Iterable[Action]
     request_id: str
+    # The version of the room once the update is applied, if it has one
+    version: int | None = field(default=None, compare=False)
     type: Literal['update'] = field(init=False, default='update')
+    # The encoded response, cached so a response sent to every connection in a room
+    # is only encoded once. See codec.response_frame
+    frame: str | None = field(init=False, default=None, compare=False, repr=False)
 
 
 @dataclass
@@ -56,3 +70,6 @@ Response = ConnectionResponse | UpdateResponse | ErrorResponse
 class Request:
     request_id: str
     actions: list[Action]
+    # The version of the room once the request is applied, assigned by the room
+    # store when the request is added
+    version: int | None = field(default=None, compare=False)
@@ -0,0 +1,318 @@
+"""
+Handwritten conversions between API structures and JSON-compatible values
+
+These accept and reject exactly the same values that dacite.from_dict and
+dataclasses.asdict would, but skip the reflection they do on every call, which
+dominated the CPU time spent handling each message. Values are expected to come
+straight from json.loads. Like dacite, bools are accepted where ints are, since
+bool is a subclass of int.
+"""
+
+import json
+from dataclasses import dataclass
+from typing import Any
+
+from src.api.api_structures import (
+    Action,
+    ConnectionResponse,
+    DeleteAction,
+    ErrorResponse,
+    PingAction,
+    Request,
+    Response,
+    UpdateResponse,
+    UpsertAction,
+)
+from src.colors import Color
+from src.game_components import (
+    IconTokenContents,
+    Ping,
+    TextTokenContents,
+    Token,
+    TokenContents,
+)
+
+_TOKEN_TYPES = ('character', 'floor')
+_MISSING = object()
+
+
+class DecodeError(ValueError):
+    """The value does not have the structure of the type it's being decoded to"""
+
+
+def _missing(name: str) -> DecodeError:
+    return DecodeError(f'missing value for field "{name}"')
+
+
+def _wrong_type(name: str, value: Any) -> DecodeError:
+    return DecodeError(f'wrong value type for field "{name}": {value!r}')
+
+
+def _decode_color(data: Any) -> Color:
+    if not isinstance(data, dict):
+        raise _wrong_type('color_rgb', data)
+    try:
+        red = data['red']
+        green = data['green']
+        blue = data['blue']
+    except KeyError as e:
+        raise _missing(e.args[0]) from None
+    if (
+        not isinstance(red, int)
+        or not isinstance(green, int)
+        or not isinstance(blue, int)
+    ):
+        raise _wrong_type('color_rgb', data)
+    try:
+        return Color(red, green, blue)
+    except ValueError as e:
+        raise DecodeError(str(e)) from e
+
+
+def _decode_contents(data: Any) -> TokenContents:
+    # Try each kind of contents in the order they're declared, like dacite does
+    # for unions
+    if isinstance(data, dict):
+        text = data.get('text')
+        if type(text) is str:
+            return TextTokenContents(text)
+        icon_id = data.get('icon_id')
+        if type(icon_id) is str:
+            return IconTokenContents(icon_id)
+    raise _wrong_type('contents', data)
+
+
+def decode_token(data: Any) -> Token:
+    if not isinstance(data, dict):
+        raise _wrong_type('data', data)
+    try:
+        token_id = data['id']
+        token_type = data['type']
+        contents = data['contents']
+        start_x = data['start_x']
+        start_y = data['start_y']
+        start_z = data['start_z']
+        end_x = data['end_x']
+        end_y = data['end_y']
+        end_z = data['end_z']
+    except KeyError as e:
+        raise _missing(e.args[0]) from None
+
+    if type(token_id) is not str:
+        raise _wrong_type('id', token_id)
+    if token_type not in _TOKEN_TYPES:
+        raise _wrong_type('type', token_type)
+    if (
+        not isinstance(start_x, int)
+        or not isinstance(start_y, int)
+        or not isinstance(start_z, int)
+        or not isinstance(end_x, int)
+        or not isinstance(end_y, int)
+        or not isinstance(end_z, int)
+    ):
+        raise _wrong_type('position', data)
+
+    color_rgb = data.get('color_rgb')
+    try:
+        return Token(
+            token_id,
+            token_type,
+            _decode_contents(contents),
+            start_x,
+            start_y,
+            start_z,
+            end_x,
+            end_y,
+            end_z,
+            None if color_rgb is None else _decode_color(color_rgb),
+        )
+    except DecodeError:
+        raise
+    except ValueError as e:
+        raise DecodeError(str(e)) from e
+
+
+def decode_ping(data: Any) -> Ping:
+    if not isinstance(data, dict):
+        raise _wrong_type('data', data)
+    try:
+        ping_id = data['id']
+        ping_type = data['type']
+        x = data['x']
+        y = data['y']
+    except KeyError as e:
+        raise _missing(e.args[0]) from None
+    if (
+        type(ping_id) is not str
+        or ping_type != 'ping'
+        or not isinstance(x, int)
+        or not isinstance(y, int)
+    ):
+        raise _wrong_type('data', data)
+    return Ping(ping_id, 'ping', x, y)
+
+
+def decode_action(data: Any) -> Action:
+    if not isinstance(data, dict):
+        raise _wrong_type('actions', data)
+    action_data = data.get('data', _MISSING)
+    if action_data is _MISSING:
+        raise _missing('data')
+
+    # Like dacite, try each kind of action in turn. The action field is optional,
+    # but if it's given it has to match the kind of action
+    action = data.get('action', _MISSING)
+    if action is _MISSING or action == 'upsert':
+        try:
+            return UpsertAction(decode_token(action_data))
+        except DecodeError:
+            if action == 'upsert':
+                raise
+    if (action is _MISSING or action == 'delete') and type(action_data) is str:
+        return DeleteAction(action_data)
+    if action is _MISSING or action == 'ping':
+        return PingAction(decode_ping(action_data))
+    raise _wrong_type('actions', data)
+
+
+def decode_request(data: Any) -> Request:
+    if not isinstance(data, dict):
+        raise _missing('request_id')
+    request_id = data.get('request_id', _MISSING)
+    if request_id is _MISSING:
+        raise _missing('request_id')
+    if type(request_id) is not str:
+        raise _wrong_type('request_id', request_id)
+
+    actions = data.get('actions', _MISSING)
+    if actions is _MISSING:
+        raise _missing('actions')
+    if type(actions) is not list:
+        raise _wrong_type('actions', actions)
+
+    return Request(request_id, [decode_action(action) for action in actions])
+
+
+def encode_color(color: Color) -> dict[str, Any]:
+    return {'red': color.red, 'green': color.green, 'blue': color.blue}
+
+
+def _encode_contents(contents: TokenContents) -> dict[str, Any]:
+    if isinstance(contents, TextTokenContents):
+        return {'text': contents.text}
+    return {'icon_id': contents.icon_id}
+
+
+def encode_token(token: Token, omit_none: bool = False) -> dict[str, Any]:
+    """
+    :param token: The token to encode
+    :param omit_none: Leave out fields that are None instead of encoding them as
+    null, like asdict with ignore_none does
+    """
+    encoded = {
+        'id': token.id,
+        'type': token.type,
+        'contents': _encode_contents(token.contents),
+        'start_x': token.start_x,
+        'start_y': token.start_y,
+        'start_z': token.start_z,
+        'end_x': token.end_x,
+        'end_y': token.end_y,
+        'end_z': token.end_z,
+    }
+    if token.color_rgb is not None:
+        encoded['color_rgb'] = encode_color(token.color_rgb)
+    elif not omit_none:
+        encoded['color_rgb'] = None
+    return encoded
+
+
+def encode_ping(ping: Ping) -> dict[str, Any]:
+    return {'id': ping.id, 'type': ping.type, 'x': ping.x, 'y': ping.y}
+
+
+def encode_action(action: Action, omit_none: bool = False) -> dict[str, Any]:
+    data: Any
+    if isinstance(action, UpsertAction):
+        data = encode_token(action.data, omit_none)
+    elif isinstance(action, PingAction):
+        data = encode_ping(action.data)
+    else:
+        data = action.data
+    return {'data': data, 'action': action.action}
+
+
+def encode_request(request: Request) -> dict[str, Any]:
+    return {
+        'request_id': request.request_id,
+        'actions': [encode_action(action) for action in request.actions],
+    }
+
+
+def request_message(request: Request) -> str:
+    return json.dumps(encode_request(request))
+
+
+@dataclass
+class EncodedRequest:
+    # The request's actions other than pings, the way they're stored in a room
+    room_update: str
+    # The whole request, the way it's published to other servers
+    message: str
+
+
+def encode_request_for_room(request: Request) -> EncodedRequest:
+    """
+    Encode a request to both store and publish, encoding each action only once.
+    The message is the same text request_message would produce
+    """
+    encoded_actions = [json.dumps(encode_action(action)) for action in request.actions]
+    room_update = ', '.join(
+        encoded
+        for action, encoded in zip(request.actions, encoded_actions, strict=True)
+        if action.action != 'ping'
+    )
+    # Laid out the same way json.dumps(encode_request(request)) would be
+    message = (
+        f'{{"request_id": {json.dumps(request.request_id)}, '
+        f'"actions": [{", ".join(encoded_actions)}]}}'
+    )
+    return EncodedRequest(f'[{room_update}]', message)
+
+
+def encode_response(response: Response) -> dict[str, Any]:
+    """Encode a response to send to clients, leaving out every field that's None"""
+    encoded: dict[str, Any]
+    if isinstance(response, ConnectionResponse):
+        encoded = {
+            'data': [encode_token(token, omit_none=True) for token in response.data],
+            'version': response.version,
+        }
+    elif isinstance(response, UpdateResponse):
+        encoded = {
+            'actions': [
+                encode_action(action, omit_none=True) for action in response.actions
+            ],
+            'request_id': response.request_id,
+            'version': response.version,
+        }
+    elif isinstance(response, ErrorResponse):
+        encoded = {
+            'data': response.data,
+            'request_id': response.request_id,
+            'session_id': response.session_id,
+        }
+    encoded['type'] = response.type
+    return {key: value for key, value in encoded.items() if value is not None}
+
+
+def response_frame(response: Response) -> str:
+    """
+    Encode the response as the JSON text sent to clients. Update responses keep
+    their encoding, so one shared between connections is only encoded once
+    """
+    if isinstance(response, UpdateResponse):
+        if response.frame is None:
+            response.frame = json.dumps(encode_response(response))
+        return response.frame
+    return json.dumps(encode_response(response))
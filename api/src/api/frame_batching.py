@@ -0,0 +1,83 @@
+import asyncio
+from asyncio import Task
+from collections.abc import AsyncGenerator, AsyncIterable
+
+from src.api.api_structures import Response
+from src.api.codec import response_frame
+from src.util.async_util import to_coroutine
+
+# How long to wait for more responses after the first response of a batch
+DEFAULT_FRAME_BATCH_WINDOW_SECONDS = 0.01
+# Batches are sent as soon as they reach this many bytes, even if the window hasn't
+# passed yet
+DEFAULT_MAX_FRAME_BATCH_BYTES = 16 * 1024
+
+
+def batch_frame(frames: list[str]) -> str:
+    """Join already encoded responses into a single JSON array"""
+    return f'[{",".join(frames)}]'
+
+
+async def batched_frames(
+    responses: AsyncIterable[Response],
+    window_seconds: float = DEFAULT_FRAME_BATCH_WINDOW_SECONDS,
+    max_batch_bytes: int = DEFAULT_MAX_FRAME_BATCH_BYTES,
+) -> AsyncGenerator[str, None]:
+    """
+    Gather responses into frames holding a JSON array of every response made in a
+    short window, so a busy room costs one websocket message per window instead of
+    one per response
+
+    :param window_seconds: How long to wait for more responses after the first
+    response of a batch arrives
+    :param max_batch_bytes: Send the batch early once it's at least this big
+    :return: The frames to send, in the order the responses were made
+    :raises: Any error from the responses, once the responses before it are sent
+    """
+    loop = asyncio.get_running_loop()
+    response_iter = aiter(responses)
+    # The next response, which may still be pending when a batch is sent
+    next_response: Task[Response] | None = None
+    try:
+        while True:
+            frames: list[str] = []
+            batch_bytes = 0
+            deadline: float | None = None
+            while batch_bytes < max_batch_bytes:
+                if next_response is None:
+                    next_response = asyncio.create_task(
+                        to_coroutine(anext(response_iter))
+                    )
+                timeout = None if deadline is None else max(deadline - loop.time(), 0)
+                done, _ = await asyncio.wait([next_response], timeout=timeout)
+                if not done:
+                    break
+
+                finished, next_response = next_response, None
+                try:
+                    response = finished.result()
+                except StopAsyncIteration:
+                    if frames:
+                        yield batch_frame(frames)
+                    return
+                except Exception:
+                    # Send what came before the error, e.g. so a client sees the
+                    # room before being told why it's being disconnected
+                    if frames:
+                        yield batch_frame(frames)
+                    raise
+
+                frame = response_frame(response)
+                frames.append(frame)
+                batch_bytes += len(frame)
+                if deadline is None:
+                    deadline = loop.time() + window_seconds
+
+            yield batch_frame(frames)
+    finally:
+        if next_response is not None:
+            next_response.cancel()
+            await asyncio.wait([next_response])
+            if not next_response.cancelled():
+                # Only the error that ended the batching matters
+                next_response.exception()
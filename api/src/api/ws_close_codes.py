@@ -6,3 +6,4 @@ ERR_TOO_MANY_CONNECTIONS = 4003
 ERR_TOO_MANY_ROOMS_CREATED = 4004
 ERR_INVALID_ROOM = 4005
 ERR_INVALID_REQUEST = 4006
+ERR_TOO_FAR_BEHIND = 4007
@@ -3,19 +3,28 @@ import json
 import logging
 import random
 import secrets
-from collections.abc import AsyncIterator
-from dataclasses import asdict
+from collections.abc import AsyncGenerator, AsyncIterable, AsyncIterator
+from contextlib import aclosing
 from typing import (
-    Any,
     NoReturn,
 )
 from uuid import UUID
 
-import dacite
-from dacite.exceptions import MissingValueError, WrongTypeError
 from websockets.exceptions import ConnectionClosedError
 
-from src.api.api_structures import BYPASS_RATE_LIMIT_HEADER, Request
+from src.api.api_structures import (
+    BATCHED_RESPONSES_SUBPROTOCOL,
+    BYPASS_RATE_LIMIT_HEADER,
+    LAST_SEEN_VERSION_PARAM,
+    Request,
+    Response,
+)
+from src.api.codec import DecodeError, decode_request, response_frame
+from src.api.frame_batching import (
+    DEFAULT_FRAME_BATCH_WINDOW_SECONDS,
+    DEFAULT_MAX_FRAME_BATCH_BYTES,
+    batched_frames,
+)
 from src.api.ws_close_codes import (
     ERR_INVALID_REQUEST,
     ERR_INVALID_UUID,
@@ -41,10 +50,6 @@ logger = logging.getLogger(__name__)
 class InvalidRequestException(Exception): ...
 
 
-def ignore_none(items: list[tuple[str, Any]]) -> dict[str, Any]:
-    return dict(filter(lambda entry: entry[1] is not None, items))
-
-
 def is_valid_uuid(uuid_string: str) -> bool:
     try:
         val = UUID(uuid_string, version=4)
@@ -57,8 +62,10 @@ async def _requests(client: WebsocketClient) -> AsyncIterator[Request]:
     async for raw_message in client.requests():
         try:
             message = json.loads(raw_message)
-            request = dacite.from_dict(Request, message)
-        except (json.JSONDecodeError, WrongTypeError, MissingValueError) as e:
+            # Re-encoded before it's stored or published, so only the fields
+            # that were decoded are passed on to other clients
+            request = decode_request(message)
+        except (json.JSONDecodeError, DecodeError) as e:
             logger.info(
                 'invalid json received from client',
                 extra={'json': raw_message},
@@ -66,10 +73,25 @@ async def _requests(client: WebsocketClient) -> AsyncIterator[Request]:
             )
             raise InvalidRequestException() from e
 
-        yield Request(
-            actions=request.actions,
-            request_id=request.request_id,
-        )
+        yield request
+
+
+def _last_seen_version(client: WebsocketClient) -> int | None:
+    """The last version of the room the client saw, if it's reconnecting"""
+    version = client.query_params().get(LAST_SEEN_VERSION_PARAM)
+    if version is None:
+        return None
+    try:
+        return int(version)
+    except ValueError:
+        # The client can still be sent the whole room
+        logger.info(f'Invalid room version: {version}')
+        return None
+
+
+async def _frames(responses: AsyncIterable[Response]) -> AsyncGenerator[str, None]:
+    async for response in responses:
+        yield response_frame(response)
 
 
 class WebsocketManager:
@@ -78,10 +100,20 @@ class WebsocketManager:
         gss: GameStateServer,
         rate_limiter: RateLimiter,
         bypass_rate_limiter_key: str,
+        frame_batch_window_seconds: float = DEFAULT_FRAME_BATCH_WINDOW_SECONDS,
+        max_frame_batch_bytes: int = DEFAULT_MAX_FRAME_BATCH_BYTES,
     ) -> None:
+        """
+        :param frame_batch_window_seconds: How long to gather responses for
+        before sending them, for clients that asked for batched responses
+        :param max_frame_batch_bytes: How big a batch of responses can get before
+        it's sent without waiting for the rest of the window
+        """
         self._gss = gss
         self._rate_limiter = rate_limiter
         self._bypass_rate_limiter_key = bypass_rate_limiter_key
+        self._frame_batch_window_seconds = frame_batch_window_seconds
+        self._max_frame_batch_bytes = max_frame_batch_bytes
         self._clients: list[WebsocketClient] = []
 
     async def maintain_liveness(self) -> NoReturn:
@@ -110,7 +142,8 @@ class WebsocketManager:
             await client.close(code=ERR_INVALID_UUID)
             return
 
-        await client.accept()
+        batch_responses = BATCHED_RESPONSES_SUBPROTOCOL in client.subprotocols()
+        await client.accept(BATCHED_RESPONSES_SUBPROTOCOL if batch_responses else None)
 
         self._clients.append(client)
 
@@ -128,13 +161,28 @@ class WebsocketManager:
         else:
             bypass_rate_limiter = False
 
+        responses = self._gss.handle_connection(
+            room_id,
+            client_ip,
+            _requests(client),
+            bypass_rate_limiter,
+            _last_seen_version(client),
+        )
+        frames = (
+            batched_frames(
+                responses,
+                self._frame_batch_window_seconds,
+                self._max_frame_batch_bytes,
+            )
+            if batch_responses
+            else _frames(responses)
+        )
         try:
-            async for response in self._gss.handle_connection(
-                room_id, client_ip, _requests(client), bypass_rate_limiter
-            ):
-                await client.send(
-                    json.dumps(asdict(response, dict_factory=ignore_none))
-                )
+            # Close the frames straight away if sending fails, so batching doesn't
+            # keep waiting on the connection's responses
+            async with aclosing(frames):
+                async for frame in frames:
+                    await client.send(frame)
         except InvalidRequestException:
             logger.info(
                 f'Closing connection to {client_ip}, invalid request received',
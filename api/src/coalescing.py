@@ -0,0 +1,86 @@
+from collections.abc import Collection, Iterable, Mapping, Sequence
+from copy import copy
+
+from src.api.api_structures import (
+    Action,
+    DeleteAction,
+    PingAction,
+    UpdateResponse,
+    UpsertAction,
+)
+from src.game_components import Token
+
+
+def coalesce_actions(
+    actions: Iterable[Action], current_tokens: Mapping[str, Token]
+) -> list[Action]:
+    """
+    Merge actions so each token is only changed once, to where it is on the
+    server. Pings are kept as they are
+
+    Clients ignore upserts that would put a token on top of another one, and
+    skipping the steps in between can leave a token where another one is moving
+    to. So every changed token is deleted first, then the ones that still exist
+    are upserted to where they ended up. The actions themselves can't be used for
+    that, since the last upsert of a token may have been rejected by the server
+
+    :param current_tokens: The tokens in the room once the actions are applied,
+    by ID
+    """
+    changed_token_ids: dict[str, None] = {}
+    pings: list[PingAction] = []
+    for action in actions:
+        if isinstance(action, PingAction):
+            pings.append(action)
+        else:
+            token_id = (
+                action.data if isinstance(action, DeleteAction) else action.data.id
+            )
+            # Move the token to the end, so tokens are upserted in the order they
+            # were last changed
+            changed_token_ids.pop(token_id, None)
+            changed_token_ids[token_id] = None
+
+    return [
+        *(DeleteAction(token_id) for token_id in changed_token_ids),
+        *(
+            UpsertAction(copy(current_tokens[token_id]))
+            for token_id in changed_token_ids
+            if token_id in current_tokens
+        ),
+        *pings,
+    ]
+
+
+def coalesce_updates(
+    updates: Sequence[UpdateResponse],
+    own_request_ids: Collection[str],
+    current_tokens: Mapping[str, Token],
+) -> list[UpdateResponse]:
+    """
+    Merge updates waiting to be sent to a connection that's fallen behind
+
+    :param updates: The updates, in the order they were made
+    :param own_request_ids: The requests the connection made and hasn't been sent
+    yet. Clients wait to hear back about each of their requests, so every one of
+    them still gets a response
+    :param current_tokens: The tokens in the room once the updates are applied,
+    by ID
+    :return: The merged update, followed by empty updates for the rest of the
+    connection's requests. They all have the version of the last update
+    """
+    if len(updates) == 1:
+        return list(updates)
+
+    acknowledged_ids = [
+        update.request_id for update in updates if update.request_id in own_request_ids
+    ]
+    actions = coalesce_actions(
+        (action for update in updates for action in update.actions), current_tokens
+    )
+    first_id, *other_ids = acknowledged_ids or [updates[-1].request_id]
+    version = updates[-1].version
+    return [
+        UpdateResponse(actions, first_id, version),
+        *(UpdateResponse([], request_id, version) for request_id in other_ids),
+    ]
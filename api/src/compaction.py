@@ -1,16 +1,24 @@
 import asyncio
+import json
 import logging
 import time
-from typing import NoReturn
+from collections import Counter
+from collections.abc import Iterable
+from concurrent.futures import Executor
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Any, NoReturn
 
 from src.api.api_structures import Action, UpsertAction
+from src.api.codec import encode_action
 from src.apm import background_transaction
-from src.game_components import Token
 from src.room import create_room
 from src.room_store.common import ARCHIVE_WHEN_IDLE_SECONDS, NoSuchRoomError
+from src.room_store.json_to_actions import json_to_actions
 from src.room_store.room_archive import RoomArchive
 from src.room_store.room_store import (
     COMPACTION_INTERVAL_SECONDS,
+    COMPACTION_LOCK_EXPIRATION_SECONDS,
     RoomStore,
     UnexpectedReplacementId,
     UnexpectedReplacementToken,
@@ -18,6 +26,54 @@ from src.room_store.room_store import (
 
 _logger = logging.getLogger(__name__)
 
+# How often to compact every room instead of only the rooms that changed
+FULL_COMPACTION_INTERVAL_SECONDS = 24 * 60 * 60
+# How many rooms to compact at once. Compacting a room is mostly waiting on redis
+# and S3, so this can be well above the number of cores
+DEFAULT_COMPACTION_CONCURRENCY = 8
+# How often to check for rooms that grew long enough to be compacted right away
+# between compaction cycles
+EAGER_COMPACTION_POLL_SECONDS = 5
+
+
+class CompactionResult(Enum):
+    COMPACTED = 'compacted'
+    ARCHIVED = 'archived'
+    DELETED = 'deleted'
+    SKIPPED = 'skipped'
+
+
+@dataclass
+class CompactionStats:
+    rooms_by_result: Counter[CompactionResult] = field(default_factory=Counter)
+    start_time: float = field(default_factory=time.monotonic)
+
+    def log_extra(self) -> dict[str, float]:
+        elapsed_time_secs = time.monotonic() - self.start_time
+        rooms = self.rooms_by_result.total()
+        return {
+            'elapsed_time_secs': elapsed_time_secs,
+            'rooms': rooms,
+            'rooms_per_sec': rooms / elapsed_time_secs if elapsed_time_secs else 0,
+            **{
+                f'rooms_{result.value}': self.rooms_by_result[result]
+                for result in CompactionResult
+            },
+        }
+
+
+@dataclass
+class _CompactedRoom:
+    replace_token: Any
+    # Rooms compacted on the event loop have actions, rooms compacted in an
+    # executor have an already encoded update instead. Empty rooms have neither
+    actions: list[Action] = field(default_factory=list)
+    update: bytes | None = None
+
+    @property
+    def is_empty(self) -> bool:
+        return not self.actions and self.update is None
+
 
 class Compactor:
     def __init__(
@@ -25,76 +81,325 @@ class Compactor:
         room_store: RoomStore,
         room_archive: RoomArchive,
         compaction_id: str,
+        concurrency: int = DEFAULT_COMPACTION_CONCURRENCY,
+        executor: Executor | None = None,
+        interval_seconds: int = COMPACTION_INTERVAL_SECONDS,
+        dry_run: bool = False,
+        eager_poll_seconds: float = EAGER_COMPACTION_POLL_SECONDS,
     ):
+        """
+        :param concurrency: How many rooms to compact at once
+        :param executor: Where to decode and replay rooms, usually a process pool.
+        If not provided, rooms are compacted on the event loop
+        :param interval_seconds: How long to wait between compaction cycles
+        :param dry_run: Report what would be done to every room without taking the
+        replacement lock or changing anything
+        :param eager_poll_seconds: How often to check for rooms to compact right
+        away between compaction cycles
+        """
         self._room_store = room_store
         self._compaction_id = compaction_id
         self._room_archive = room_archive
+        self._concurrency = concurrency
+        self._executor = executor
+        self._interval_seconds = interval_seconds
+        self._dry_run = dry_run
+        self._eager_poll_seconds = eager_poll_seconds
+        self._last_full_sweep_time: float | None = None
+        # When the replacement lock we last acquired expires, or None if we don't
+        # hold it. The lock can't be acquired again while we hold it, so this is
+        # how we know we still do between cycles
+        self._lock_expire_time: float | None = None
 
     async def maintain_compaction(self) -> NoReturn:
         while True:
-            if await self._room_store.acquire_replacement_lock(self._compaction_id):
+            if self._dry_run or await self._room_store.acquire_replacement_lock(
+                self._compaction_id
+            ):
+                if not self._dry_run:
+                    self._lock_expire_time = (
+                        time.monotonic() + COMPACTION_LOCK_EXPIRATION_SECONDS
+                    )
                 with background_transaction('compaction'):
-                    start_time = time.monotonic()
+                    stats = CompactionStats()
                     try:
-                        async for room_id in self._room_store.get_all_room_ids():
-                            await self._compact_room(room_id)
-                    except UnexpectedReplacementId:
+                        await self._compaction_cycle(stats)
+                    except* UnexpectedReplacementId:
                         _logger.info('Lost replacement lock while compacting')
-                    _logger.info(
-                        'Compaction cycle complete',
-                        extra={'elapsed_time_secs': time.monotonic() - start_time},
-                    )
+                        self._lock_expire_time = None
+                    _logger.info('Compaction cycle complete', extra=stats.log_extra())
             else:
                 _logger.info('Failed to acquire compaction lock')
 
-            await asyncio.sleep(COMPACTION_INTERVAL_SECONDS)
+            await self._compact_oversized_rooms_until(
+                time.monotonic() + self._interval_seconds
+            )
+
+    def _holds_lock(self) -> bool:
+        return (
+            self._lock_expire_time is not None
+            and time.monotonic() < self._lock_expire_time
+        )
+
+    async def _compact_oversized_rooms_until(self, end_time: float) -> None:
+        """
+        Wait for the next compaction cycle, compacting rooms that grow too long in
+        the meantime if we hold the replacement lock
+        """
+        while (remaining_seconds := end_time - time.monotonic()) > 0:
+            await asyncio.sleep(min(remaining_seconds, self._eager_poll_seconds))
+            if not self._holds_lock():
+                continue
+
+            with background_transaction('eager_compaction'):
+                stats = CompactionStats()
+                try:
+                    await self._compact_oversized_rooms(stats)
+                except* UnexpectedReplacementId:
+                    _logger.info('Lost replacement lock while compacting')
+                    self._lock_expire_time = None
+                if stats.rooms_by_result:
+                    _logger.info('Compacted oversized rooms', extra=stats.log_extra())
+
+    async def _compact_oversized_rooms(
+        self, stats: CompactionStats | None = None
+    ) -> None:
+        """
+        Compact the rooms that grew long enough since they were last checked to
+        not wait for the next cycle, at most `concurrency` at a time. Each room is
+        only queued once per cooldown by the room store, so a single busy room
+        can't keep the compactor to itself
+
+        If any room fails to compact the rest are cancelled, marked dirty so the
+        next cycle picks them up, and the errors are raised in an ExceptionGroup
+        """
+        if stats is None:
+            stats = CompactionStats()
+
+        oversized_room_ids = await self._room_store.drain_oversized_room_ids()
+        uncompacted_room_ids = set(oversized_room_ids)
+        semaphore = asyncio.Semaphore(self._concurrency)
+
+        async def compact(room_id: str) -> None:
+            async with semaphore:
+                result = await self._compact_room(room_id, is_idle=False)
+            uncompacted_room_ids.discard(room_id)
+            stats.rooms_by_result[result] += 1
 
-    async def _compact_room(self, room_id: str) -> None:
-        replacement_data = await self._room_store.read_for_replacement(room_id)
-        room = create_room(replacement_data.actions)
-        compacted_actions = _tokens_to_actions(list(room.game_state.values()))
         try:
-            room_idle_seconds = await self._room_store.get_room_idle_seconds(room_id)
-        except NoSuchRoomError:
-            _logger.warning(f'Room unexpectedly deleted during compaction: {room_id}')
-            return
+            async with asyncio.TaskGroup() as tg:
+                for room_id in oversized_room_ids:
+                    tg.create_task(compact(room_id))
+        except BaseException:
+            if uncompacted_room_ids:
+                await self._room_store.add_dirty_room_ids(uncompacted_room_ids)
+            raise
+
+    async def _compaction_cycle(self, stats: CompactionStats | None = None) -> None:
+        """
+        Compact every room written to since the last cycle and archive every idle
+        room, occasionally falling back to compacting every room in case a written
+        room was missed (e.g. because a compactor died partway through a cycle)
+
+        Rooms are queued up by a single producer and compacted by a fixed number
+        of workers, so at most `concurrency` rooms are being compacted at once.
+        If any room fails to compact (including losing the replacement lock) the
+        rest of the cycle is cancelled and the errors are raised in an
+        ExceptionGroup
+        """
+        if stats is None:
+            stats = CompactionStats()
 
-        if not compacted_actions:
+        idle_room_ids = {
+            room_id
+            async for room_id in self._room_store.get_idle_room_ids(
+                ARCHIVE_WHEN_IDLE_SECONDS, read_only=self._dry_run
+            )
+        }
+        if self._dry_run:
+            # Leave the dirty rooms for the real compactor
+            dirty_room_ids: set[str] = set()
+            full_sweep = True
+        else:
+            # Drain before a full sweep too, so rooms aren't compacted again next
+            # cycle
+            dirty_room_ids = await self._room_store.drain_dirty_room_ids()
+            full_sweep = self._full_sweep_due()
+        sweep_start_time = time.monotonic()
+
+        # Keep the queue small so a full sweep doesn't list every room up front
+        queue: asyncio.Queue[str | None] = asyncio.Queue(self._concurrency * 2)
+
+        async def produce() -> None:
+            if full_sweep:
+                async for room_id in self._room_store.get_all_room_ids():
+                    await queue.put(room_id)
+            else:
+                for room_id in dirty_room_ids | idle_room_ids:
+                    await queue.put(room_id)
+
+            for _ in range(self._concurrency):
+                await queue.put(None)
+
+        # Dirty rooms that haven't been compacted yet, marked dirty again if the
+        # cycle fails so the next cycle picks them up
+        uncompacted_dirty_room_ids = set(dirty_room_ids)
+
+        async def work() -> None:
+            while (room_id := await queue.get()) is not None:
+                is_idle: bool | None
+                if room_id in idle_room_ids:
+                    is_idle = True
+                elif full_sweep:
+                    # Rooms found by a full sweep may have no recorded activity,
+                    # which looking it up will fill in
+                    is_idle = None
+                else:
+                    is_idle = False
+                result = await self._compact_room(room_id, is_idle=is_idle)
+                uncompacted_dirty_room_ids.discard(room_id)
+                stats.rooms_by_result[result] += 1
+
+        try:
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(produce())
+                for _ in range(self._concurrency):
+                    tg.create_task(work())
+        except BaseException:
+            if uncompacted_dirty_room_ids:
+                await self._room_store.add_dirty_room_ids(uncompacted_dirty_room_ids)
+            raise
+
+        if full_sweep:
+            self._last_full_sweep_time = sweep_start_time
+
+    def _full_sweep_due(self) -> bool:
+        return (
+            self._last_full_sweep_time is None
+            or time.monotonic() - self._last_full_sweep_time
+            >= FULL_COMPACTION_INTERVAL_SECONDS
+        )
+
+    async def _compact_room(
+        self, room_id: str, is_idle: bool | None = None
+    ) -> CompactionResult:
+        """
+        :param room_id: The ID of the room to compact
+        :param is_idle: Whether the room has been idle long enough to be archived,
+        looked up from the room store if not provided
+        :return: What was done with the room
+        """
+        compacted_room = await self._read_compacted(room_id)
+        if is_idle is None:
+            try:
+                room_idle_seconds = await self._room_store.get_room_idle_seconds(
+                    room_id, read_only=self._dry_run
+                )
+            except NoSuchRoomError:
+                _logger.warning(
+                    f'Room unexpectedly deleted during compaction: {room_id}'
+                )
+                return CompactionResult.SKIPPED
+            is_idle = room_idle_seconds >= ARCHIVE_WHEN_IDLE_SECONDS
+
+        if self._dry_run:
+            if compacted_room.is_empty:
+                result = CompactionResult.DELETED
+            elif is_idle:
+                result = CompactionResult.ARCHIVED
+            else:
+                result = CompactionResult.COMPACTED
+            _logger.debug(f'Dry run: room {room_id} would be {result.value}')
+            return result
+
+        if compacted_room.is_empty:
             try:
                 await asyncio.gather(
                     self._room_store.delete(
-                        room_id, self._compaction_id, replacement_data.replace_token
+                        room_id, self._compaction_id, compacted_room.replace_token
                     ),
                     self._room_archive.delete(room_id),
                 )
-                return
+                return CompactionResult.DELETED
             except UnexpectedReplacementToken:
                 # Something was added to the room after we started compacting,
                 # so just fall back to regular compacting
                 pass
 
-        elif room_idle_seconds >= ARCHIVE_WHEN_IDLE_SECONDS:
-            await self._room_archive.write(room_id, compacted_actions)
+        elif is_idle:
+            await self._write_to_archive(room_id, compacted_room)
             try:
                 await self._room_store.delete(
-                    room_id, self._compaction_id, replacement_data.replace_token
+                    room_id, self._compaction_id, compacted_room.replace_token
                 )
-                return
+                return CompactionResult.ARCHIVED
             except UnexpectedReplacementToken:
                 # Something was added to the room after we started compacting,
                 # so just fall back to regular compacting
                 pass
 
-        await self._room_store.replace(
-            room_id,
-            compacted_actions,
-            replacement_data.replace_token,
-            self._compaction_id,
+        await self._replace(room_id, compacted_room)
+        return CompactionResult.COMPACTED
+
+    async def _read_compacted(self, room_id: str) -> _CompactedRoom:
+        if self._executor is None:
+            replacement_data = await self._room_store.read_for_replacement(
+                room_id, read_only=self._dry_run
+            )
+            return _CompactedRoom(
+                replacement_data.replace_token,
+                actions=compact_actions(replacement_data.actions),
+            )
+
+        raw_data = await self._room_store.read_raw_for_replacement(
+            room_id, read_only=self._dry_run
+        )
+        update = await asyncio.get_running_loop().run_in_executor(
+            self._executor, compact_raw_updates, raw_data.updates
         )
+        return _CompactedRoom(raw_data.replace_token, update=update)
+
+    async def _write_to_archive(
+        self, room_id: str, compacted_room: _CompactedRoom
+    ) -> None:
+        if compacted_room.update is not None:
+            await self._room_archive.write_raw(room_id, compacted_room.update)
+        else:
+            await self._room_archive.write(room_id, compacted_room.actions)
+
+    async def _replace(self, room_id: str, compacted_room: _CompactedRoom) -> None:
+        if compacted_room.update is not None:
+            await self._room_store.replace_raw(
+                room_id,
+                compacted_room.update,
+                compacted_room.replace_token,
+                self._compaction_id,
+            )
+        else:
+            await self._room_store.replace(
+                room_id,
+                compacted_room.actions,
+                compacted_room.replace_token,
+                self._compaction_id,
+            )
+
+
+def compact_actions(actions: Iterable[Action]) -> list[Action]:
+    """Replay the actions and return the actions needed to create the result"""
+    room = create_room(actions)
+    return [UpsertAction(token) for token in room.game_state.values()]
+
 
+def compact_raw_updates(updates: list[bytes]) -> bytes | None:
+    """
+    Decode, compact and re-encode a room's updates. Runs in a separate process
+    when compacting with an executor, so only takes and returns bytes
 
-def _tokens_to_actions(tokens: list[Token]) -> list[Action]:
-    actions: list[Action] = []
-    for token in tokens:
-        actions.append(UpsertAction(token))
-    return actions
+    :param updates: The updates from RawReplacementData
+    :return: The compacted actions encoded as a single update, or None if the
+    room is empty
+    """
+    compacted_actions = compact_actions(json_to_actions(updates))
+    if not compacted_actions:
+        return None
+    return json.dumps(list(map(encode_action, compacted_actions))).encode()
@@ -2,7 +2,20 @@ import os
 from dataclasses import dataclass, field
 from enum import Enum
 
+from src.api.frame_batching import (
+    DEFAULT_FRAME_BATCH_WINDOW_SECONDS,
+    DEFAULT_MAX_FRAME_BATCH_BYTES,
+)
+from src.compaction import DEFAULT_COMPACTION_CONCURRENCY
 from src.redis import SSLValidation
+from src.room_cache import (
+    COALESCE_QUEUED_UPDATES,
+    MAX_QUEUED_UPDATES,
+    SNAPSHOT_INTERVAL_REQUESTS,
+    SlowConnectionPolicy,
+)
+from src.room_store.common import EAGER_COMPACTION_LENGTH, RedisRoomStorage
+from src.room_store.disk_cached_room_archive import DEFAULT_ARCHIVE_CACHE_MAX_BYTES
 
 
 class Environment(Enum):
@@ -49,6 +62,71 @@ class Config:
     redis_ssl_validation: SSLValidation = SSLValidation[
         os.environ.get('REDIS_SSL_VALIDATION', 'default').upper()
     ]
+    compaction_concurrency: int = int(
+        os.environ.get('COMPACTION_CONCURRENCY', DEFAULT_COMPACTION_CONCURRENCY)
+    )
+    # Whether each web worker runs its own compactor. Turn this off when running
+    # compactor.py separately
+    in_process_compaction: bool = (
+        os.environ.get('IN_PROCESS_COMPACTION', 'true') == 'true'
+    )
+    # Number of processes to decode and replay rooms in during compaction, or 0 to
+    # do it on the event loop
+    compaction_processes: int = int(os.environ.get('COMPACTION_PROCESSES', 0))
+    room_storage: RedisRoomStorage = RedisRoomStorage[
+        os.environ.get('ROOM_STORAGE', 'list').upper()
+    ]
+    # Whether requests from every connection are gathered into shared pipelines,
+    # and how long to wait for more requests before writing a batch. A window of 0
+    # waits for a single turn of the event loop
+    write_batching: bool = os.environ.get('WRITE_BATCHING', 'true') == 'true'
+    write_batch_window_ms: int = int(os.environ.get('WRITE_BATCH_WINDOW_MS', 0))
+    # How many requests from each connection can be written at once. Batched writes
+    # are sent in the order they're made, so this only applies with write batching
+    max_writes_in_flight: int = int(os.environ.get('MAX_WRITES_IN_FLIGHT', 8))
+    # How many updates can be waiting to be sent to one connection, and what to do
+    # with connections that fall further behind than that
+    max_queued_updates: int = int(
+        os.environ.get('MAX_QUEUED_UPDATES', MAX_QUEUED_UPDATES)
+    )
+    slow_connection_policy: SlowConnectionPolicy = SlowConnectionPolicy[
+        os.environ.get('SLOW_CONNECTION_POLICY', 'resync').upper()
+    ]
+    # How long to gather responses for, and how big a batch of them can get, for
+    # clients that ask for batched responses
+    frame_batch_window_ms: int = int(
+        os.environ.get(
+            'FRAME_BATCH_WINDOW_MS', DEFAULT_FRAME_BATCH_WINDOW_SECONDS * 1000
+        )
+    )
+    max_frame_batch_bytes: int = int(
+        os.environ.get('MAX_FRAME_BATCH_BYTES', DEFAULT_MAX_FRAME_BATCH_BYTES)
+    )
+    # How many updates can be waiting to be sent to one connection before they're
+    # merged, 0 to never merge them
+    coalesce_queued_updates: int = int(
+        os.environ.get('COALESCE_QUEUED_UPDATES', COALESCE_QUEUED_UPDATES)
+    )
+    # How many requests are applied to a cached room between saving snapshots of
+    # it, so reading the room only goes through the requests since. 0 to never
+    # save them
+    snapshot_interval_requests: int = int(
+        os.environ.get('SNAPSHOT_INTERVAL_REQUESTS', SNAPSHOT_INTERVAL_REQUESTS)
+    )
+    # How many updates a room can be stored as before it's compacted right away
+    # instead of waiting for the next compaction cycle. 0 to always wait
+    eager_compaction_length: int = int(
+        os.environ.get('EAGER_COMPACTION_LENGTH', EAGER_COMPACTION_LENGTH)
+    )
+    # Where to archive rooms on local disk instead of S3, for single server installs
+    archive_dir: str | None = os.environ.get('ARCHIVE_DIR')
+    # Where to keep copies of archived rooms on local disk, and how large the copies
+    # can get before the least recently used are removed. Rooms aren't cached if
+    # there's no directory
+    archive_cache_dir: str | None = os.environ.get('ARCHIVE_CACHE_DIR')
+    archive_cache_max_bytes: int = int(
+        os.environ.get('ARCHIVE_CACHE_MAX_BYTES', DEFAULT_ARCHIVE_CACHE_MAX_BYTES)
+    )
     scout_config = {
         'name': f'ttbud ({environment.value})',
         'key': os.environ.get('SCOUT_KEY'),
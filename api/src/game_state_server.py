@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import asyncio
 import logging
+from asyncio import Task
 from collections.abc import AsyncIterable, AsyncIterator
 from uuid import uuid4
 
@@ -13,12 +14,12 @@ from src.api.api_structures import (
     Response,
     UpdateResponse,
 )
-from src.api.ws_close_codes import ERR_TOO_MANY_ROOMS_CREATED
+from src.api.ws_close_codes import ERR_TOO_FAR_BEHIND, ERR_TOO_MANY_ROOMS_CREATED
 
 from .apm import foreground_transaction
 from .rate_limit.noop_rate_limit import NoopRateLimiter
 from .rate_limit.rate_limit import RateLimiter, TooManyRoomsCreatedException
-from .room import create_room
+from .room_cache import RoomCache, SlowConnectionError
 from .room_store.room_store import RoomStore
 from .util.async_util import items_until
 
@@ -37,34 +38,110 @@ class InvalidConnectionException(Exception):
         self.reason = reason
 
 
-async def _requests_to_messages(
-    requests: AsyncIterator[Request],
+def _check_finished(writes: set[Task[None]]) -> set[Task[None]]:
+    """
+    :return: The writes that haven't finished yet
+    :raises: The error from the first failed write
+    """
+    for write in writes:
+        if write.done():
+            write.result()
+    return {write for write in writes if not write.done()}
+
+
+async def _updates_to_messages(
+    updates: AsyncIterator[UpdateResponse | ConnectionResponse],
+    sent_version: int | None,
 ) -> AsyncIterator[Response]:
-    async for request in requests:
-        with (
-            foreground_transaction('update_send'),
-            timber.context(request={'request_id': request.request_id}),
-        ):
-            yield UpdateResponse(request.actions, request.request_id)
+    """
+    :param sent_version: The version of the room the connection was sent when it
+    connected. Updates up to that version might have been queued before the room
+    was read, and are skipped since the connection already has them
+    """
+    try:
+        async for update in updates:
+            if (
+                isinstance(update, UpdateResponse)
+                and sent_version is not None
+                and update.version is not None
+                and update.version <= sent_version
+            ):
+                continue
+
+            if isinstance(update, ConnectionResponse):
+                logger.info('Resyncing slow connection')
+                yield update
+                continue
+
+            with (
+                foreground_transaction('update_send'),
+                timber.context(request={'request_id': update.request_id}),
+            ):
+                yield update
+    except SlowConnectionError as e:
+        raise InvalidConnectionException(
+            ERR_TOO_FAR_BEHIND, 'Connection fell too far behind on updates'
+        ) from e
 
 
 class GameStateServer:
     def __init__(
         self,
         room_store: RoomStore,
+        room_cache: RoomCache,
         rate_limiter: RateLimiter,
         noop_rate_limiter: NoopRateLimiter,
+        max_writes_in_flight: int = 1,
     ):
+        """
+        :param max_writes_in_flight: How many requests from each connection can be
+        written to the room store at once. Only use more than one with a room
+        store that writes requests in the order add_request is called
+        """
         self.room_store = room_store
+        self._room_cache = room_cache
         self._rate_limiter = rate_limiter
         self._noop_rate_limiter = noop_rate_limiter
+        self._max_writes_in_flight = max_writes_in_flight
 
     async def _process_requests(
-        self, room_id: str, requests: AsyncIterator[Request]
+        self,
+        room_id: str,
+        requests: AsyncIterator[Request],
+        own_request_ids: set[str],
     ) -> None:
-        async for request in requests:
-            with foreground_transaction('update_receive'):
-                await self.room_store.add_request(room_id, request)
+        """
+        Add each request to the room store without waiting for the previous ones
+        to finish, up to max_writes_in_flight at once. Once that many are in
+        flight, stop reading requests until one finishes so that slow writes push
+        back on the client
+
+        :param own_request_ids: Has the ID of each request added before it's
+        written, so the room cache knows which updates came from this connection
+        """
+        writes: set[Task[None]] = set()
+        try:
+            async for request in requests:
+                writes = _check_finished(writes)
+                if len(writes) >= self._max_writes_in_flight:
+                    await asyncio.wait(writes, return_when=asyncio.FIRST_COMPLETED)
+                    writes = _check_finished(writes)
+                own_request_ids.add(request.request_id)
+                # Tasks start in the order they're created, so add_request is
+                # called in the order the requests arrived
+                writes.add(asyncio.create_task(self._add_request(room_id, request)))
+
+            for write in writes:
+                await write
+        finally:
+            for write in writes:
+                if not write.cancel() and not write.cancelled():
+                    # Only the first error is raised, don't warn about the others
+                    write.exception()
+
+    async def _add_request(self, room_id: str, request: Request) -> None:
+        with foreground_transaction('update_receive'):
+            await self.room_store.add_request(room_id, request)
 
     async def handle_connection(
         self,
@@ -72,6 +149,7 @@ class GameStateServer:
         client_ip: str,
         requests: AsyncIterator[Request],
         bypass_rate_limiter: bool = False,
+        last_seen_version: int | None = None,
     ) -> AsyncIterable[Response]:
         """Handle a new client connection
         :param client_ip: IP address of the client
@@ -80,6 +158,9 @@ class GameStateServer:
         :param requests: The stream of requests from the connection
         :param bypass_rate_limiter: If true, rate limiting will not be enforced for
         this connection
+        :param last_seen_version: The last version of the room the client saw, if
+        it's reconnecting. If every update since can still be read, the client is
+        sent just those updates instead of the whole room
         :raise InvalidConnectionException: If the client connection should be rejected
         """
         rate_limiter = (
@@ -95,22 +176,43 @@ class GameStateServer:
             }
         ):
             logger.info(f'Connected to {client_ip}')
-            async with rate_limiter.rate_limited_connection(client_ip, room_id):
-                room_changes = await self.room_store.changes(room_id)
-
+            # Requests from this connection that haven't been sent back yet
+            own_request_ids: set[str] = set()
+            async with (
+                rate_limiter.rate_limited_connection(client_ip, room_id),
+                self._room_cache.changes(room_id, own_request_ids) as room_changes,
+            ):
                 with foreground_transaction('connect'):
                     if not await self.room_store.room_exists(room_id):
                         await self._acquire_room_slot(room_id, client_ip, rate_limiter)
 
-                    room = create_room(await self.room_store.read(room_id))
-                    yield ConnectionResponse(list(room.game_state.values()))
+                    missed_updates = (
+                        None
+                        if last_seen_version is None
+                        else await self._room_cache.read_updates_since(
+                            room_id, last_seen_version
+                        )
+                    )
+                    if missed_updates is not None:
+                        logger.info(f'Sending {len(missed_updates)} missed updates')
+                        sent_version = (
+                            missed_updates[-1].version
+                            if missed_updates
+                            else last_seen_version
+                        )
+                        for update in missed_updates:
+                            yield update
+                    else:
+                        snapshot = await self._room_cache.read_snapshot(room_id)
+                        sent_version = snapshot.version
+                        yield ConnectionResponse(snapshot.tokens, snapshot.version)
 
                 try:
                     request_task = asyncio.create_task(
-                        self._process_requests(room_id, requests)
+                        self._process_requests(room_id, requests, own_request_ids)
                     )
                     async for msg in items_until(
-                        _requests_to_messages(room_changes), request_task
+                        _updates_to_messages(room_changes, sent_version), request_task
                     ):
                         yield msg
                 finally:
@@ -4,6 +4,7 @@ from copy import deepcopy
 from src.api.api_structures import Action
 from src.colors import colors
 from src.game_components import Token, content_id
+from src.spatial_index import Box, BoxIndex
 
 
 def _assign_colors(tokens: list[Token]) -> None:
@@ -18,31 +19,26 @@ def _assign_colors(tokens: list[Token]) -> None:
             token.color_rgb = available_colors.pop(0)
 
 
-def _get_unit_blocks(token: Token) -> list[tuple[int, int, int]]:
-    unit_blocks = []
-    for x in range(token.start_x, token.end_x):
-        for y in range(token.start_y, token.end_y):
-            for z in range(token.start_z, token.end_z):
-                unit_blocks.append((x, y, z))
-    return unit_blocks
+def _get_box(token: Token) -> Box:
+    return (
+        token.start_x,
+        token.start_y,
+        token.start_z,
+        token.end_x,
+        token.end_y,
+        token.end_z,
+    )
 
 
 class Room:
     def __init__(self) -> None:
         self.game_state: dict[str, Token] = {}
-        self.id_to_positions: dict[str, list[tuple[int, int, int]]] = {}
-        self.positions_to_ids: dict[tuple[int, int, int], str] = {}
+        self.token_boxes = BoxIndex()
         self.icon_to_token_ids: dict[str, list[str]] = {}
 
-    def _remove_positions(self, token_id: str) -> None:
-        positions = self.id_to_positions.get(token_id, [])
-        for pos in positions:
-            self.positions_to_ids.pop(pos, None)
-
     def delete_token(self, token_id: str) -> None:
-        # Remove token data from position dictionaries
-        self._remove_positions(token_id)
-        self.id_to_positions.pop(token_id, None)
+        # Remove token data from the position index
+        self.token_boxes.remove(token_id)
         # Remove the token from the state
         removed_token = self.game_state.pop(token_id, None)
         # Remove token from icon_id table
@@ -54,7 +50,7 @@ class Room:
     def create_or_update_token(self, token: Token) -> None:
         if self.is_valid_position(token):
             if self.game_state.get(token.id):
-                self._remove_positions(token.id)
+                self.token_boxes.remove(token.id)
             elif token.type == 'character':
                 new_content_id = content_id(token.contents)
                 if self.icon_to_token_ids.get(new_content_id):
@@ -71,22 +67,22 @@ class Room:
 
             # Update state for new or existing token
             if token.type == 'character' or token.type == 'floor':
-                blocks = _get_unit_blocks(token)
-                self.id_to_positions[token.id] = blocks
-                for block in blocks:
-                    self.positions_to_ids[block] = token.id
+                self.token_boxes.insert(token.id, _get_box(token))
             self.game_state[token.id] = token
 
     def is_valid_position(self, token: Token) -> bool:
-        blocks = _get_unit_blocks(token)
-        return all(not self.positions_to_ids.get(block, False) for block in blocks)
+        return not self.token_boxes.any_intersecting(_get_box(token))
 
 
-def create_room(updates: Iterable[Action]) -> Room:
-    room = Room()
+def apply_actions(room: Room, updates: Iterable[Action]) -> None:
     for update in updates:
         if update.action == 'upsert':
             room.create_or_update_token(update.data)
         elif update.action == 'delete':
             room.delete_token(update.data)
+
+
+def create_room(updates: Iterable[Action]) -> Room:
+    room = Room()
+    apply_actions(room, updates)
     return room
@@ -0,0 +1,569 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from asyncio import CancelledError, Future, Task
+from collections import OrderedDict
+from collections.abc import AsyncGenerator, AsyncIterator, Container
+from contextlib import asynccontextmanager
+from copy import copy
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import NoReturn
+
+from src.api.api_structures import (
+    ConnectionResponse,
+    DeleteAction,
+    Request,
+    UpdateResponse,
+    UpsertAction,
+)
+from src.apm import instrument
+from src.coalescing import coalesce_updates
+from src.game_components import Token
+from src.room import Room, apply_actions, create_room
+from src.room_store.room_store import RoomStore
+from src.util.async_util import end_task
+
+logger = logging.getLogger(__name__)
+
+MAX_CACHED_ROOMS = 1000
+# How many updates can be waiting to be sent to a single connection
+MAX_QUEUED_UPDATES = 256
+# How many updates can be waiting to be sent to a single connection before it's
+# considered behind, and the updates are merged before they're sent
+COALESCE_QUEUED_UPDATES = 16
+# How many requests are applied to a cached room between saving snapshots of it
+SNAPSHOT_INTERVAL_REQUESTS = 256
+# How long to wait before listening for invalidations again after it fails, which
+# doubles with each failure in a row up to the max
+MIN_INVALIDATION_RETRY_SECONDS = 0.5
+MAX_INVALIDATION_RETRY_SECONDS = 30
+
+
+class SlowConnectionPolicy(Enum):
+    # Throw away the connection's queued updates and send it the whole room instead
+    RESYNC = 'resync'
+    # Disconnect the connection, it can reconnect once it catches up
+    DISCONNECT = 'disconnect'
+    # Wait for the connection to catch up, holding up every connection in the room.
+    # Changes keep queueing up in the room store meanwhile, until its own limit on
+    # queued changes is reached
+    BLOCK = 'block'
+
+
+class SlowConnectionError(Exception):
+    """The connection fell too far behind on updates and was disconnected"""
+
+
+@dataclass
+class _Resync:
+    """Queued in place of the updates dropped for a slow connection"""
+
+    # Every token changed by the dropped updates
+    changed_token_ids: set[str] = field(default_factory=set)
+    # The connection's own requests in the dropped updates
+    own_request_ids: list[str] = field(default_factory=list)
+    last_request_id: str = ''
+
+    def add(self, update: UpdateResponse, own_request_ids: Container[str]) -> None:
+        for action in update.actions:
+            if isinstance(action, DeleteAction):
+                self.changed_token_ids.add(action.data)
+            elif isinstance(action, UpsertAction):
+                self.changed_token_ids.add(action.data.id)
+        if update.request_id in own_request_ids:
+            self.own_request_ids.append(update.request_id)
+        self.last_request_id = update.request_id
+
+
+_QueueItem = UpdateResponse | _Resync | BaseException
+
+
+@dataclass
+class _Connection:
+    queue: asyncio.Queue[_QueueItem]
+    # Requests the connection made that it hasn't been sent back yet
+    own_request_ids: set[str]
+
+
+@dataclass
+class FanOutStats:
+    queued_updates: int
+    max_queued_updates: int
+    coalesced_updates: int
+    dropped_updates: int
+    resyncs: int
+    slow_disconnects: int
+
+
+@dataclass
+class RoomSnapshot:
+    tokens: list[Token]
+    # The version of the room the tokens are from, if it has one
+    version: int | None
+
+
+@dataclass
+class _CachedRoom:
+    room: Room
+    version: int | None
+    requests_since_snapshot: int = 0
+
+
+@dataclass
+class _RoomSubscription:
+    connections: list[_Connection]
+    subscribed: Future[None] = field(default_factory=Future)
+    task: Task | None = None
+    # The snapshot of the room being saved, if there is one
+    snapshot_task: Task | None = None
+    # Incremented whenever the room changes, so fills that raced with a change can
+    # be detected and thrown away
+    generation: int = 0
+
+
+def _apply_request(room: Room, request: Request) -> None:
+    # Requests are shared with every connection in the room, and rooms mutate the
+    # tokens given to them, so give the room its own copies
+    apply_actions(
+        room,
+        (
+            UpsertAction(copy(action.data)) if action.action == 'upsert' else action
+            for action in request.actions
+        ),
+    )
+
+
+def _clear(queue: asyncio.Queue[_QueueItem]) -> list[_QueueItem]:
+    """:return: The items that were removed"""
+    cleared = []
+    while not queue.empty():
+        cleared.append(queue.get_nowait())
+    return cleared
+
+
+class RoomCache:
+    """
+    Materialized rooms for every room that has a connection on this server
+
+    The cache holds a single subscription to the room store per room and fans it
+    out to each local connection, applying every update to the cached room before
+    any connection can see it. That way a connection that subscribes to changes
+    and then reads the room never misses an update. Since the cached room is
+    already up to date, it's also saved as a snapshot of the room every so often,
+    so the next server to read the room doesn't have to replay every request.
+
+    Every connection is given the same response for each update, so it's only
+    encoded once no matter how many connections are in the room.
+
+    Once enough updates are waiting to be sent to a connection, the ones waiting
+    are merged and sent together so it can catch up. Each connection can only
+    have so many updates waiting to be sent to it, after which the slow
+    connection policy decides what happens to it.
+    """
+
+    def __init__(
+        self,
+        room_store: RoomStore,
+        max_rooms: int = MAX_CACHED_ROOMS,
+        max_queued_updates: int = MAX_QUEUED_UPDATES,
+        slow_connection_policy: SlowConnectionPolicy = SlowConnectionPolicy.RESYNC,
+        coalesce_queued_updates: int = COALESCE_QUEUED_UPDATES,
+        snapshot_interval_requests: int = SNAPSHOT_INTERVAL_REQUESTS,
+    ):
+        """
+        :param coalesce_queued_updates: How many updates can be waiting to be sent
+        to a connection before they're merged. 0 never merges them
+        :param snapshot_interval_requests: How many requests are applied to a
+        cached room between saving snapshots of it. 0 never saves them
+        """
+        self._room_store = room_store
+        self._max_rooms = max_rooms
+        self._max_queued_updates = max_queued_updates
+        self._coalesce_queued_updates = coalesce_queued_updates
+        self._snapshot_interval_requests = snapshot_interval_requests
+        self._slow_connection_policy = slow_connection_policy
+        self._subscriptions: dict[str, _RoomSubscription] = {}
+        self._rooms: OrderedDict[str, _CachedRoom] = OrderedDict()
+        self._coalesced_updates = 0
+        self._dropped_updates = 0
+        self._resyncs = 0
+        self._slow_disconnects = 0
+
+    @asynccontextmanager
+    async def changes(
+        self, room_id: str, own_request_ids: set[str] | None = None
+    ) -> AsyncGenerator[AsyncIterator[UpdateResponse | ConnectionResponse], None]:
+        """
+        Subscribe to changes to the room until the context exits. Must be entered
+        before read_tokens so the cached room can be kept up to date
+
+        The subscription is held by the context rather than the iterator, so it's
+        cleaned up even if the changes are never iterated
+
+        :param own_request_ids: The requests the connection has made. Add each
+        request before writing it, and it's removed once it's been sent back
+        :return: Each update to the room. If the connection fell too far behind
+        and its queued updates were thrown away, the tokens they changed are
+        deleted and the whole room is sent instead, along with an empty update
+        for each of the connection's own requests that was thrown away
+        :raises SlowConnectionError: When iterating, if the connection falls too
+        far behind and the policy is to disconnect it
+        """
+        connection = _Connection(
+            asyncio.Queue(self._max_queued_updates),
+            set() if own_request_ids is None else own_request_ids,
+        )
+        sub = await self._subscribe(room_id, connection)
+        try:
+            yield self._room_changes(room_id, connection)
+        finally:
+            # Disconnected slow connections have already been removed
+            if connection in sub.connections:
+                sub.connections.remove(connection)
+            # Let the fan out go if it's blocked waiting for this connection
+            _clear(connection.queue)
+            if not sub.connections:
+                self._drop_subscription(room_id, sub)
+                if sub.task:
+                    await end_task(sub.task)
+                if sub.snapshot_task:
+                    await end_task(sub.snapshot_task)
+
+    async def _subscribe(
+        self, room_id: str, connection: _Connection
+    ) -> _RoomSubscription:
+        sub = self._subscriptions.get(room_id)
+        if sub is None:
+            sub = _RoomSubscription([connection])
+            self._subscriptions[room_id] = sub
+            try:
+                upstream = await self._room_store.changes(room_id)
+            except BaseException as e:
+                self._drop_subscription(room_id, sub)
+                sub.subscribed.set_exception(e)
+                # Mark the exception as retrieved, anyone waiting will re-raise it
+                sub.subscribed.exception()
+                raise
+            sub.task = asyncio.create_task(
+                self._fan_out(room_id, sub, upstream), name=f'RoomCache {room_id}'
+            )
+            sub.subscribed.set_result(None)
+        else:
+            sub.connections.append(connection)
+            try:
+                await asyncio.shield(sub.subscribed)
+            except BaseException:
+                sub.connections.remove(connection)
+                raise
+
+        return sub
+
+    async def _fan_out(
+        self, room_id: str, sub: _RoomSubscription, upstream: AsyncIterator[Request]
+    ) -> None:
+        try:
+            async for request in upstream:
+                sub.generation += 1
+                cached = self._rooms.get(room_id)
+                if cached is not None:
+                    _apply_request(cached.room, request)
+                    cached.version = request.version
+                update = UpdateResponse(
+                    request.actions, request.request_id, request.version
+                )
+                for connection in list(sub.connections):
+                    if connection.queue.full():
+                        await self._handle_slow_connection(
+                            room_id, sub, connection, update
+                        )
+                    else:
+                        connection.queue.put_nowait(update)
+                if cached is not None:
+                    self._snapshot_if_due(room_id, sub, cached)
+        except BaseException as e:
+            # Pass the error on to every connection instead of raising it here,
+            # the room will be resubscribed by the next connection
+            self._drop_subscription(room_id, sub)
+            for connection in sub.connections:
+                # The connection is ending anyway, so it doesn't need its updates
+                if connection.queue.full():
+                    _clear(connection.queue)
+                connection.queue.put_nowait(e)
+            if isinstance(e, CancelledError):
+                raise
+
+    def _snapshot_if_due(
+        self, room_id: str, sub: _RoomSubscription, cached: _CachedRoom
+    ) -> None:
+        """
+        Start saving a snapshot of the room in the background, so the fan out
+        isn't held up while it's written. If the last one is still being saved,
+        it's tried again after the next request instead
+        """
+        cached.requests_since_snapshot += 1
+        if (
+            cached.version is None
+            or self._snapshot_interval_requests == 0
+            or cached.requests_since_snapshot < self._snapshot_interval_requests
+            or (sub.snapshot_task is not None and not sub.snapshot_task.done())
+        ):
+            return
+
+        cached.requests_since_snapshot = 0
+        # The cached room keeps changing while the snapshot is written
+        actions = [
+            UpsertAction(copy(token)) for token in cached.room.game_state.values()
+        ]
+        sub.snapshot_task = asyncio.create_task(
+            self._write_snapshot(room_id, actions, cached.version),
+            name=f'RoomCache snapshot {room_id}',
+        )
+
+    async def _write_snapshot(
+        self, room_id: str, actions: list[UpsertAction], version: int
+    ) -> None:
+        try:
+            await self._room_store.write_snapshot(room_id, actions, version)
+        except Exception:
+            # The room is still read correctly without it, just more slowly
+            logger.warning(
+                f'Failed to save snapshot of room {room_id}',
+                exc_info=True,
+                extra={'room_id': room_id},
+            )
+
+    async def _handle_slow_connection(
+        self,
+        room_id: str,
+        sub: _RoomSubscription,
+        connection: _Connection,
+        update: UpdateResponse,
+    ) -> None:
+        if self._slow_connection_policy == SlowConnectionPolicy.BLOCK:
+            await connection.queue.put(update)
+            return
+
+        dropped = _clear(connection.queue)
+        dropped_updates = sum(isinstance(item, UpdateResponse) for item in dropped)
+        if self._slow_connection_policy == SlowConnectionPolicy.RESYNC:
+            self._resyncs += 1
+            # Everything after the resync is still sent, so this update is dropped
+            # too. It's already in the room the connection will be sent
+            dropped_updates += 1
+            # Connections that fall behind again before catching up keep the
+            # resync they already had
+            resync = next(
+                (item for item in dropped if isinstance(item, _Resync)), _Resync()
+            )
+            for item in [*dropped, update]:
+                if isinstance(item, UpdateResponse):
+                    resync.add(item, connection.own_request_ids)
+            connection.queue.put_nowait(resync)
+            action = 'Resyncing'
+        else:
+            self._slow_disconnects += 1
+            # Stop sending it updates, so the error can't be thrown away in turn
+            sub.connections.remove(connection)
+            connection.queue.put_nowait(SlowConnectionError())
+            action = 'Disconnecting'
+
+        self._dropped_updates += dropped_updates
+        logger.info(
+            f'{action} connection that fell behind on updates to room {room_id}',
+            extra={'room_id': room_id, 'dropped_updates': dropped_updates},
+        )
+
+    async def _room_changes(
+        self, room_id: str, connection: _Connection
+    ) -> AsyncIterator[UpdateResponse | ConnectionResponse]:
+        queue = connection.queue
+        # Taken off the queue while merging updates, but not an update itself
+        next_item: _QueueItem | None = None
+        while True:
+            if next_item is not None:
+                item, next_item = next_item, None
+            else:
+                item = await queue.get()
+
+            responses: list[UpdateResponse | ConnectionResponse]
+            if isinstance(item, UpdateResponse):
+                if 0 < self._coalesce_queued_updates <= queue.qsize():
+                    updates = [item]
+                    while not queue.empty():
+                        queued_item = queue.get_nowait()
+                        if not isinstance(queued_item, UpdateResponse):
+                            next_item = queued_item
+                            break
+                        updates.append(queued_item)
+                    self._coalesced_updates += len(updates)
+                    # Updates queued after these might already be applied to the
+                    # room, but applying them again is harmless
+                    cached = await self._cached_room(room_id)
+                    responses = [
+                        *coalesce_updates(
+                            updates,
+                            connection.own_request_ids,
+                            cached.room.game_state,
+                        )
+                    ]
+                else:
+                    responses = [item]
+            elif isinstance(item, _Resync):
+                responses = await self._resync_responses(room_id, item)
+            else:
+                raise item
+
+            for response in responses:
+                if isinstance(response, UpdateResponse):
+                    connection.own_request_ids.discard(response.request_id)
+                yield response
+
+    async def _resync_responses(
+        self, room_id: str, resync: _Resync
+    ) -> list[UpdateResponse | ConnectionResponse]:
+        # Updates queued after the resync might already be in the room that's read
+        # here, but applying them again is harmless
+        snapshot = await self.read_snapshot(room_id)
+        # Clients wait to hear back about each of their requests, so every one of
+        # them still gets a response
+        first_id, *other_ids = resync.own_request_ids or [resync.last_request_id]
+        return [
+            # Clients only upsert the tokens they're sent, so remove any tokens
+            # that might have moved or been deleted first
+            UpdateResponse(
+                [DeleteAction(token_id) for token_id in resync.changed_token_ids],
+                first_id,
+            ),
+            ConnectionResponse(snapshot.tokens, snapshot.version),
+            *(UpdateResponse([], request_id) for request_id in other_ids),
+        ]
+
+    def _drop_subscription(self, room_id: str, sub: _RoomSubscription) -> None:
+        # Without a subscription there's no way to keep the room up to date
+        if self._subscriptions.get(room_id) is sub:
+            del self._subscriptions[room_id]
+            self._rooms.pop(room_id, None)
+
+    async def read_tokens(self, room_id: str) -> list[Token]:
+        """
+        Read the current state of the room, only reading from the room store if
+        the room is not already cached
+        """
+        return (await self.read_snapshot(room_id)).tokens
+
+    @instrument
+    async def read_snapshot(self, room_id: str) -> RoomSnapshot:
+        """Like read_tokens, but also return the version of the room that was read"""
+        cached = await self._cached_room(room_id)
+        return RoomSnapshot(
+            [copy(token) for token in cached.room.game_state.values()],
+            cached.version,
+        )
+
+    @instrument
+    async def read_updates_since(
+        self, room_id: str, version: int
+    ) -> list[UpdateResponse] | None:
+        """
+        :param version: The last version of the room a connection saw
+        :return: Every update to the room since that version, or None if they
+        can't all be read and the connection needs the whole room instead
+        """
+        cached = self._rooms.get(room_id)
+        if cached is not None and cached.version == version:
+            return []
+
+        requests = await self._room_store.read_requests_since(room_id, version)
+        if requests is None:
+            return None
+        return [
+            UpdateResponse(request.actions, request.request_id, request.version)
+            for request in requests
+        ]
+
+    async def _cached_room(self, room_id: str) -> _CachedRoom:
+        cached = self._rooms.get(room_id)
+        if cached is not None:
+            self._rooms.move_to_end(room_id)
+            return cached
+        return await self._fill(room_id)
+
+    async def _fill(self, room_id: str) -> _CachedRoom:
+        sub = self._subscriptions.get(room_id)
+        generation = sub.generation if sub else None
+        versioned_room = await self._room_store.read_with_version(room_id)
+        cached = _CachedRoom(
+            create_room(versioned_room.actions), versioned_room.version
+        )
+
+        # Only cache the room if nothing changed while we were reading it. If
+        # something did, we can't tell whether the read included it or not
+        if (
+            sub is not None
+            and self._subscriptions.get(room_id) is sub
+            and sub.generation == generation
+        ):
+            self._rooms[room_id] = cached
+            if len(self._rooms) > self._max_rooms:
+                self._rooms.popitem(last=False)
+
+        return cached
+
+    def fan_out_stats(self) -> FanOutStats:
+        queue_sizes = [
+            connection.queue.qsize()
+            for sub in self._subscriptions.values()
+            for connection in sub.connections
+        ]
+        return FanOutStats(
+            queued_updates=sum(queue_sizes),
+            max_queued_updates=max(queue_sizes, default=0),
+            coalesced_updates=self._coalesced_updates,
+            dropped_updates=self._dropped_updates,
+            resyncs=self._resyncs,
+            slow_disconnects=self._slow_disconnects,
+        )
+
+    def invalidate(self, room_id: str) -> None:
+        self._rooms.pop(room_id, None)
+        sub = self._subscriptions.get(room_id)
+        if sub:
+            sub.generation += 1
+
+    def invalidate_all(self) -> None:
+        self._rooms.clear()
+        for sub in self._subscriptions.values():
+            sub.generation += 1
+
+    async def maintain_invalidation(self) -> NoReturn:
+        """
+        Drop cached rooms whenever a replacer replaces or deletes them
+
+        If listening for invalidations fails, listen again after a delay that
+        grows with each failure in a row. Invalidations could have been missed in
+        between, so every cached room is dropped once listening again
+        """
+        retry_seconds = MIN_INVALIDATION_RETRY_SECONDS
+        resubscribing = False
+        while True:
+            try:
+                invalidations = await self._room_store.invalidations()
+                if resubscribing:
+                    logger.info('Listening for room invalidations again')
+                    self.invalidate_all()
+                async for room_id in invalidations:
+                    retry_seconds = MIN_INVALIDATION_RETRY_SECONDS
+                    if room_id in self._rooms:
+                        logger.info(f'Invalidating cached room {room_id}')
+                    self.invalidate(room_id)
+                logger.error('Room invalidations ended unexpectedly')
+            except Exception:
+                logger.exception('Failed to listen for room invalidations')
+
+            # Don't keep serving rooms that could be out of date while waiting
+            self.invalidate_all()
+            resubscribing = True
+            await asyncio.sleep(retry_seconds)
+            retry_seconds = min(retry_seconds * 2, MAX_INVALIDATION_RETRY_SECONDS)
@@ -0,0 +1,172 @@
+"""
+How archived rooms are stored
+
+Archives used to be a JSON list of actions. They now start with a byte saying
+how the rest is stored, which can't be confused with the start of a JSON list,
+so archives written before this still read:
+
+FORMAT_ZLIB_JSON is the same JSON list compressed with zlib. It's what rooms
+compacted in an executor are archived as, since they arrive already encoded.
+
+FORMAT_ZLIB_COLUMNS is the room's tokens as a JSON object of columns, one list
+per field, compressed with zlib. Every token's fields are the same types, so
+they're read straight out of the lists instead of being decoded and checked
+one by one, and the repeated field names are only stored once.
+"""
+
+import json
+import zlib
+from collections.abc import Iterable
+from typing import Any
+
+from src.api.api_structures import Action, UpsertAction
+from src.api.codec import DecodeError, encode_action
+from src.colors import Color
+from src.game_components import (
+    IconTokenContents,
+    TextTokenContents,
+    Token,
+    TokenContents,
+)
+from src.room_store.json_to_actions import json_to_actions
+
+FORMAT_ZLIB_JSON = 1
+FORMAT_ZLIB_COLUMNS = 2
+# Coordinates stored for each token in the positions column
+_COORDINATES_PER_TOKEN = 6
+
+
+def compress_archive_json(data: bytes) -> bytes:
+    """
+    :param data: The room's actions already encoded as a JSON list
+    :return: The archive to store
+    """
+    return bytes([FORMAT_ZLIB_JSON]) + zlib.compress(data)
+
+
+def encode_archive(actions: Iterable[Action]) -> bytes:
+    """
+    :return: The archive to store, in columns if the room only has upserts like
+    compacted rooms do
+    """
+    actions = list(actions)
+    if not all(isinstance(action, UpsertAction) for action in actions):
+        return compress_archive_json(
+            json.dumps(list(map(encode_action, actions))).encode()
+        )
+
+    tokens = [action.data for action in actions if isinstance(action, UpsertAction)]
+    columns = {
+        'ids': [token.id for token in tokens],
+        'types': [token.type for token in tokens],
+        'texts': [_text(token.contents) for token in tokens],
+        'icon_ids': [_icon_id(token.contents) for token in tokens],
+        'positions': [
+            coordinate
+            for token in tokens
+            for coordinate in (
+                token.start_x,
+                token.start_y,
+                token.start_z,
+                token.end_x,
+                token.end_y,
+                token.end_z,
+            )
+        ],
+        'colors': [_color_to_int(token.color_rgb) for token in tokens],
+    }
+    encoded = json.dumps(columns, separators=(',', ':')).encode()
+    return bytes([FORMAT_ZLIB_COLUMNS]) + zlib.compress(encoded)
+
+
+def decode_archive(data: bytes) -> list[Action]:
+    """
+    :param data: An archive in any format, including plain JSON
+    :raises DecodeError: If the archive is corrupted or in an unknown format
+    """
+    if not data:
+        raise DecodeError('empty archive')
+
+    archive_format = data[0]
+    try:
+        if archive_format == FORMAT_ZLIB_JSON:
+            return list(json_to_actions([zlib.decompress(data[1:])]))
+        elif archive_format == FORMAT_ZLIB_COLUMNS:
+            return _decode_columns(json.loads(zlib.decompress(data[1:])))
+        else:
+            return list(json_to_actions([data]))
+    except zlib.error as e:
+        raise DecodeError(f'corrupted archive: {e}') from e
+    except (json.JSONDecodeError, UnicodeDecodeError) as e:
+        raise DecodeError(f'invalid archive in format {archive_format}') from e
+
+
+def _decode_columns(columns: Any) -> list[Action]:
+    try:
+        ids = columns['ids']
+        types = columns['types']
+        texts = columns['texts']
+        icon_ids = columns['icon_ids']
+        positions = columns['positions']
+        colors = columns['colors']
+        if (
+            not (len(ids) == len(types) == len(texts) == len(icon_ids) == len(colors))
+            or len(positions) != len(ids) * _COORDINATES_PER_TOKEN
+        ):
+            raise DecodeError('archive columns are different lengths')
+
+        actions: list[Action] = []
+        for i, token_id in enumerate(ids):
+            start_x, start_y, start_z, end_x, end_y, end_z = positions[
+                i * _COORDINATES_PER_TOKEN : (i + 1) * _COORDINATES_PER_TOKEN
+            ]
+            token = Token(
+                token_id,
+                types[i],
+                _contents(texts[i], icon_ids[i]),
+                start_x,
+                start_y,
+                start_z,
+                end_x,
+                end_y,
+                end_z,
+                _int_to_color(colors[i]),
+            )
+            actions.append(UpsertAction(token))
+        return actions
+    except (KeyError, TypeError) as e:
+        raise DecodeError(f'invalid archive columns: {e}') from e
+    except DecodeError:
+        raise
+    except ValueError as e:
+        raise DecodeError(str(e)) from e
+
+
+def _text(contents: TokenContents) -> str | None:
+    return contents.text if isinstance(contents, TextTokenContents) else None
+
+
+def _icon_id(contents: TokenContents) -> str | None:
+    return contents.icon_id if isinstance(contents, IconTokenContents) else None
+
+
+def _contents(text: str | None, icon_id: str | None) -> TokenContents:
+    if text is not None:
+        return TextTokenContents(text)
+    if icon_id is not None:
+        return IconTokenContents(icon_id)
+    raise DecodeError('token has no contents')
+
+
+def _color_to_int(color: Color | None) -> int | None:
+    if color is None:
+        return None
+    return color.red << 16 | color.green << 8 | color.blue
+
+
+def _int_to_color(value: int | None) -> Color | None:
+    if value is None:
+        return None
+    if not 0 <= value <= 0xFFFFFF:
+        raise DecodeError(f'invalid color: {value}')
+    return Color(value >> 16 & 0xFF, value >> 8 & 0xFF, value & 0xFF)
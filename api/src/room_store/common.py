@@ -1,5 +1,38 @@
+import time
+from enum import Enum
+
 ARCHIVE_WHEN_IDLE_SECONDS = 6 * 60 * 60
+# How many changes to a room can be waiting for each listener to take them
+MAX_QUEUED_CHANGES = 1024
+# How many of the latest requests to each room are kept, so clients that reconnect
+# can be sent just the requests they missed
+ROOM_LOG_LENGTH = 1024
+# How many updates a room can be stored as before it's compacted right away instead
+# of waiting for the next compaction cycle
+EAGER_COMPACTION_LENGTH = 1000
+# How long to wait before compacting the same room right away again, so a single
+# busy room can't keep the compactor to itself
+EAGER_COMPACTION_COOLDOWN_SECONDS = 60
 
 
 class NoSuchRoomError(BaseException):
     pass
+
+
+def first_room_version() -> int:
+    """
+    The version a room starts at. Rooms start at the current time in milliseconds,
+    so a room that's archived and brought back doesn't reuse the versions a client
+    might still have from before
+    """
+    return time.time_ns() // 1_000_000
+
+
+class RedisRoomStorage(Enum):
+    # Every request is appended to a list, and rooms are rebuilt by replaying it
+    LIST = 'list'
+    # The current state of each room is kept in a hash of tokens
+    HASH = 'hash'
+    # Every request is added to a stream, which servers also read to hear about
+    # changes
+    STREAM = 'stream'
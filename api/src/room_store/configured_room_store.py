@@ -0,0 +1,34 @@
+from contextlib import AbstractAsyncContextManager
+
+from redis.asyncio.client import Redis
+
+from src.room_store.common import EAGER_COMPACTION_LENGTH, RedisRoomStorage
+from src.room_store.redis_hash_room_store import create_redis_hash_room_store
+from src.room_store.redis_room_store import RedisRoomStore, create_redis_room_store
+from src.room_store.redis_stream_room_store import create_redis_stream_room_store
+
+
+def create_configured_room_store(
+    redis: Redis,
+    storage: RedisRoomStorage,
+    write_batch_window_seconds: float | None = None,
+    eager_compaction_length: int = EAGER_COMPACTION_LENGTH,
+) -> AbstractAsyncContextManager[RedisRoomStore]:
+    """
+    :param storage: How rooms are stored in redis
+    :param write_batch_window_seconds: How long to gather requests from every
+    connection before writing them together, or None to write each on its own
+    :param eager_compaction_length: How long a room can get before it's queued to
+    be compacted right away. 0 never queues rooms. Rooms stored as hashes don't
+    grow, so they're never queued
+    """
+    if storage == RedisRoomStorage.HASH:
+        return create_redis_hash_room_store(redis, write_batch_window_seconds)
+    elif storage == RedisRoomStorage.STREAM:
+        return create_redis_stream_room_store(
+            redis, write_batch_window_seconds, eager_compaction_length
+        )
+    else:
+        return create_redis_room_store(
+            redis, write_batch_window_seconds, eager_compaction_length
+        )
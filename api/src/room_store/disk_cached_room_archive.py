@@ -0,0 +1,289 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+from collections.abc import AsyncIterator, Iterable
+from pathlib import Path
+from uuid import uuid4
+
+from src.api.api_structures import Action
+from src.room_store.archive_format import (
+    compress_archive_json,
+    decode_archive,
+    encode_archive,
+)
+from src.room_store.common import NoSuchRoomError
+from src.room_store.room_archive import ArchiveObject, ObjectRoomArchive, RoomArchive
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ARCHIVE_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+# Files are written under this suffix and then renamed, so a half written file is
+# never read
+_TEMP_SUFFIX = '.tmp'
+# Temp files older than this were left behind by a write that died, rather than
+# being written right now by another process sharing the cache
+STALE_TEMP_FILE_SECONDS = 60 * 60
+# How often the whole cache is sized up again, picking up the files written and
+# removed by other processes sharing it since
+RESCAN_INTERVAL_SECONDS = 60
+
+
+def _checksum(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _read_cache_file(path: Path) -> ArchiveObject | None:
+    """
+    :return: The cached archive, or None if it's missing or corrupted
+    """
+    try:
+        contents = path.read_bytes()
+    except FileNotFoundError:
+        return None
+    except OSError:
+        logger.warning(f'Failed to read archive from cache: {path}', exc_info=True)
+        return None
+
+    etag, _, rest = contents.partition(b'\n')
+    checksum, _, data = rest.partition(b'\n')
+    if _checksum(data) != checksum.decode(errors='replace'):
+        logger.warning(f'Corrupted archive in cache, removing it: {path}')
+        _remove_cache_files([path])
+        return None
+    return ArchiveObject(data, etag.decode())
+
+
+def _write_cache_file(path: Path, archive_object: ArchiveObject) -> int:
+    """
+    :return: The size of the file
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name(f'{path.name}.{uuid4()}{_TEMP_SUFFIX}')
+    contents = (
+        archive_object.etag.encode()
+        + b'\n'
+        + _checksum(archive_object.data).encode()
+        + b'\n'
+        + archive_object.data
+    )
+    try:
+        temp_path.write_bytes(contents)
+        os.replace(temp_path, path)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+    return len(contents)
+
+
+def _touch_cache_file(path: Path) -> None:
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+    except OSError:
+        logger.warning(f'Failed to touch archive in cache: {path}', exc_info=True)
+
+
+def _remove_cache_files(paths: Iterable[Path]) -> None:
+    for path in paths:
+        try:
+            path.unlink(missing_ok=True)
+        except OSError:
+            logger.warning(
+                f'Failed to remove archive from cache: {path}', exc_info=True
+            )
+
+
+def _scan_cache_files(directory: Path) -> list[tuple[Path, int]]:
+    """
+    Remove temp files left behind by writes that died
+
+    :return: The path and size of each cached file, least recently used first
+    """
+    now = time.time()
+    cached_files: list[tuple[float, Path, int]] = []
+    for path in directory.glob('*/*'):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            # Removed by another process sharing the cache
+            continue
+        if not path.name.endswith(_TEMP_SUFFIX):
+            cached_files.append((stat.st_mtime, path, stat.st_size))
+        elif now - stat.st_mtime > STALE_TEMP_FILE_SECONDS:
+            _remove_cache_files([path])
+    return [(path, size) for _, path, size in sorted(cached_files)]
+
+
+class DiskCachedRoomArchive(RoomArchive):
+    """
+    Keeps copies of archived rooms on local disk, so reopening a room that was
+    recently read or written here doesn't download it again. Once the cache is
+    larger than max_bytes, the least recently used rooms are removed from it
+
+    Other servers can archive the room again after it's cached, so each read
+    still asks the archive for the room, but only if it doesn't match the ETag
+    of the cached copy. An unchanged room is read from disk without being
+    transferred again, or without asking the archive at all when it's in front
+    of an IndexedRoomArchive that knows the room's ETag
+
+    Each room is cached in a file named after a hash of its ID holding the ETag
+    of the archive, a checksum of the archive and then the archive itself.
+    Files that don't match their checksum are treated as missing
+
+    Every worker on a server can share the directory. Each one keeps track of the
+    files it's used, and every RESCAN_INTERVAL_SECONDS sizes up the whole
+    directory again, so the cache as a whole stays within max_bytes instead of
+    each worker's share of it. Failing to use the cache (e.g. because the disk
+    is full) is logged, and the room is read from the archive instead
+    """
+
+    def __init__(
+        self,
+        room_archive: ObjectRoomArchive,
+        directory: str | Path,
+        max_bytes: int = DEFAULT_ARCHIVE_CACHE_MAX_BYTES,
+    ):
+        """
+        :param room_archive: Where rooms are archived
+        :param directory: Where to cache rooms, created if it doesn't exist
+        :param max_bytes: How large the cache can get before rooms are removed
+        """
+        self._room_archive = room_archive
+        self._directory = Path(directory)
+        self._max_bytes = max_bytes
+        # The size of each cached file, least recently used first
+        self._sizes_by_path: OrderedDict[Path, int] = OrderedDict()
+        self._total_bytes = 0
+        self._last_scan_time = time.monotonic()
+        self._load_cached_files()
+
+    def _load_cached_files(self) -> None:
+        """Pick up the rooms cached before a restart, ordered by when last used"""
+        try:
+            self._directory.mkdir(parents=True, exist_ok=True)
+            self._use_cached_files(_scan_cache_files(self._directory))
+        except OSError:
+            logger.warning(
+                f'Failed to load archive cache: {self._directory}', exc_info=True
+            )
+        _remove_cache_files(self._evict())
+
+    def _use_cached_files(self, cached_files: list[tuple[Path, int]]) -> None:
+        self._sizes_by_path = OrderedDict(cached_files)
+        self._total_bytes = sum(self._sizes_by_path.values())
+
+    async def _rescan_if_due(self) -> None:
+        if time.monotonic() - self._last_scan_time < RESCAN_INTERVAL_SECONDS:
+            return
+
+        self._last_scan_time = time.monotonic()
+        try:
+            cached_files = await asyncio.to_thread(_scan_cache_files, self._directory)
+        except OSError:
+            logger.warning(
+                f'Failed to scan archive cache: {self._directory}', exc_info=True
+            )
+            return
+        self._use_cached_files(cached_files)
+
+    def _path(self, room_id: str) -> Path:
+        name = hashlib.sha256(room_id.encode()).hexdigest()
+        return self._directory / name[:2] / name
+
+    def get_all_room_ids(self) -> AsyncIterator[str]:
+        return self._room_archive.get_all_room_ids()
+
+    async def room_exists(self, room_id: str) -> bool:
+        # Rooms can be deleted by other servers, so a cached copy doesn't mean the
+        # room still exists
+        return await self._room_archive.room_exists(room_id)
+
+    async def read(self, room_id: str) -> Iterable[Action]:
+        path = self._path(room_id)
+        cached = None
+        if path in self._sizes_by_path:
+            cached = await asyncio.to_thread(_read_cache_file, path)
+            if cached is None:
+                self._forget(path)
+
+        try:
+            archive_object = await self._room_archive.read_object(
+                room_id, None if cached is None else cached.etag
+            )
+        except NoSuchRoomError:
+            await self._remove(path)
+            raise
+
+        if archive_object is not None:
+            await self._store(path, archive_object)
+            return decode_archive(archive_object.data)
+        elif cached is not None:
+            await self._touch(path)
+            return decode_archive(cached.data)
+        else:  # pragma: no cover
+            # Without an ETag to match, the object is always returned
+            raise NoSuchRoomError
+
+    async def write(self, room_id: str, data: Iterable[Action]) -> None:
+        await self._write_object(room_id, encode_archive(data))
+
+    async def write_raw(self, room_id: str, data: bytes) -> None:
+        await self._write_object(room_id, compress_archive_json(data))
+
+    async def _write_object(self, room_id: str, data: bytes) -> None:
+        etag = await self._room_archive.write_object(room_id, data)
+        await self._store(self._path(room_id), ArchiveObject(data, etag))
+
+    async def delete(self, room_id: str) -> None:
+        await self._room_archive.delete(room_id)
+        await self._remove(self._path(room_id))
+
+    async def _store(self, path: Path, archive_object: ArchiveObject) -> None:
+        if len(archive_object.data) > self._max_bytes:
+            await self._remove(path)
+            return
+
+        try:
+            size = await asyncio.to_thread(_write_cache_file, path, archive_object)
+        except OSError:
+            logger.warning(f'Failed to cache archive: {path}', exc_info=True)
+            return
+        self._forget(path)
+        self._sizes_by_path[path] = size
+        self._total_bytes += size
+        await self._rescan_if_due()
+        evicted_paths = self._evict()
+        if evicted_paths:
+            await asyncio.to_thread(_remove_cache_files, evicted_paths)
+
+    async def _touch(self, path: Path) -> None:
+        if path in self._sizes_by_path:
+            self._sizes_by_path.move_to_end(path)
+        # Keep the order of use across restarts
+        await asyncio.to_thread(_touch_cache_file, path)
+
+    async def _remove(self, path: Path) -> None:
+        self._forget(path)
+        await asyncio.to_thread(_remove_cache_files, [path])
+
+    def _forget(self, path: Path) -> None:
+        size = self._sizes_by_path.pop(path, None)
+        if size is not None:
+            self._total_bytes -= size
+
+    def _evict(self) -> list[Path]:
+        """
+        Forget the least recently used rooms until the cache fits in max_bytes
+
+        :return: The files of the rooms that were forgotten, to be removed
+        """
+        evicted_paths = []
+        while self._total_bytes > self._max_bytes and self._sizes_by_path:
+            path, size = self._sizes_by_path.popitem(last=False)
+            self._total_bytes -= size
+            evicted_paths.append(path)
+        return evicted_paths
@@ -0,0 +1,239 @@
+import asyncio
+import hashlib
+import logging
+import os
+from asyncio import Future, Task
+from collections.abc import AsyncIterator, Iterable
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from urllib.parse import quote, unquote
+from uuid import uuid4
+
+from src.api.api_structures import Action
+from src.room_store.archive_format import (
+    compress_archive_json,
+    decode_archive,
+    encode_archive,
+)
+from src.room_store.common import NoSuchRoomError
+from src.room_store.room_archive import ArchiveObject, ObjectRoomArchive, md5_etag
+from src.util.async_util import end_task
+
+logger = logging.getLogger(__name__)
+
+# How long to wait for more changes before syncing them to disk together
+DEFAULT_SYNC_WINDOW_SECONDS = 0.005
+# Files are written under this suffix and then renamed, so a half written file is
+# never read
+_TEMP_SUFFIX = '.tmp'
+
+
+@dataclass
+class _PendingChange:
+    path: Path
+    # What to write to path, or None to remove path
+    data: bytes | None
+    future: Future[None]
+
+
+def _fsync(path: Path) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_file(path: Path, data: bytes) -> None:
+    """Write the file under a temporary name and sync it, then move it into place"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name(f'{path.name}.{uuid4()}{_TEMP_SUFFIX}')
+    try:
+        with temp_path.open('wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+
+def _apply_changes(changes: list[tuple[Path, bytes | None]]) -> list[OSError | None]:
+    """
+    Write or remove each file in order, then sync the directories they're in
+    once each
+
+    :return: The error each change failed with, if it did
+    """
+    errors: list[OSError | None] = []
+    for path, data in changes:
+        try:
+            if data is None:
+                path.unlink(missing_ok=True)
+            else:
+                _write_file(path, data)
+            errors.append(None)
+        except OSError as e:
+            errors.append(e)
+
+    for directory in {path.parent for path, _ in changes}:
+        try:
+            _fsync(directory)
+        except FileNotFoundError:
+            # Only removing a room that was never archived gets here
+            pass
+        except OSError as e:
+            errors = [
+                e if error is None and path.parent == directory else error
+                for (path, _), error in zip(changes, errors, strict=True)
+            ]
+    return errors
+
+
+def _read_file(path: Path) -> bytes:
+    try:
+        return path.read_bytes()
+    except FileNotFoundError:
+        raise NoSuchRoomError from None
+
+
+def _list_dir(directory: Path) -> list[os.DirEntry]:
+    try:
+        with os.scandir(directory) as entries:
+            return list(entries)
+    except FileNotFoundError:
+        return []
+
+
+class FilesystemRoomArchive(ObjectRoomArchive):
+    """
+    Archives rooms as files in a directory, for running on a single server
+    without S3
+
+    Each room is stored at <a>/<b>/<room id>, where a and b are taken from a
+    hash of the room ID, so no directory holds more than a few files even with
+    millions of rooms. Room IDs are escaped so they're always a single file name.
+
+    Files are written under a temporary name, synced and renamed into place, so
+    a room is never half written. Writes and deletes made at around the same time
+    are applied together in one batch off the event loop, syncing each directory
+    they touch once, and each only returns once its change is on disk.
+    """
+
+    def __init__(
+        self,
+        directory: str | Path,
+        sync_window_seconds: float = DEFAULT_SYNC_WINDOW_SECONDS,
+    ):
+        """
+        :param directory: Where to keep rooms, created if it doesn't exist
+        :param sync_window_seconds: How long to wait for more changes after the
+        first change of a batch before syncing them to disk
+        """
+        self._directory = Path(directory)
+        self._directory.mkdir(parents=True, exist_ok=True)
+        self._sync_window_seconds = sync_window_seconds
+        self._pending: list[_PendingChange] = []
+        self._flush_task: Task | None = None
+
+    def _path(self, room_id: str) -> Path:
+        room_hash = hashlib.sha256(room_id.encode()).hexdigest()
+        return (
+            self._directory / room_hash[:2] / room_hash[2:4] / quote(room_id, safe='')
+        )
+
+    async def get_all_room_ids(self) -> AsyncIterator[str]:
+        # List one directory at a time, so the rooms aren't all held in memory
+        for outer in await asyncio.to_thread(_list_dir, self._directory):
+            if not outer.is_dir():
+                continue
+            for inner in await asyncio.to_thread(_list_dir, Path(outer.path)):
+                if not inner.is_dir():
+                    continue
+                for entry in await asyncio.to_thread(_list_dir, Path(inner.path)):
+                    if not entry.name.endswith(_TEMP_SUFFIX):
+                        yield unquote(entry.name)
+
+    async def room_exists(self, room_id: str) -> bool:
+        return await asyncio.to_thread(self._path(room_id).exists)
+
+    async def read(self, room_id: str) -> Iterable[Action]:
+        return decode_archive(await asyncio.to_thread(_read_file, self._path(room_id)))
+
+    async def read_object(
+        self, room_id: str, if_none_match: str | None = None
+    ) -> ArchiveObject | None:
+        data = await asyncio.to_thread(_read_file, self._path(room_id))
+        etag = md5_etag(data)
+        return None if etag == if_none_match else ArchiveObject(data, etag)
+
+    async def write(self, room_id: str, data: Iterable[Action]) -> None:
+        await self.write_object(room_id, encode_archive(data))
+
+    async def write_raw(self, room_id: str, data: bytes) -> None:
+        await self.write_object(room_id, compress_archive_json(data))
+
+    async def write_object(self, room_id: str, data: bytes) -> str:
+        await self._change(self._path(room_id), data)
+        return md5_etag(data)
+
+    async def delete(self, room_id: str) -> None:
+        await self._change(self._path(room_id), None)
+
+    async def _change(self, path: Path, data: bytes | None) -> None:
+        """Apply the change with the next batch, returning once it's on disk"""
+        future: Future[None] = asyncio.get_running_loop().create_future()
+        self._pending.append(_PendingChange(path, data, future))
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(
+                self._flush(), name='FilesystemRoomArchive flush'
+            )
+        await future
+
+    async def _flush(self) -> None:
+        batch: list[_PendingChange] = []
+        try:
+            while self._pending:
+                await asyncio.sleep(self._sync_window_seconds)
+                batch, self._pending = self._pending, []
+                # Changes are applied in the order they were made, so the last
+                # change to a room wins
+                errors = await asyncio.to_thread(
+                    _apply_changes,
+                    [(change.path, change.data) for change in batch],
+                )
+                logger.debug('Synced archive changes', extra={'changes': len(batch)})
+                for change, error in zip(batch, errors, strict=True):
+                    if change.future.done():
+                        continue
+                    if error is None:
+                        change.future.set_result(None)
+                    else:
+                        change.future.set_exception(error)
+                batch = []
+        finally:
+            self._flush_task = None
+            # Only does anything if the flush was cancelled partway through
+            for change in [*batch, *self._pending]:
+                change.future.cancel()
+            self._pending = []
+
+    async def close(self) -> None:
+        if self._flush_task:
+            await end_task(self._flush_task)
+        self._flush_task = None
+        for change in self._pending:
+            change.future.cancel()
+        self._pending = []
+
+
+@asynccontextmanager
+async def create_filesystem_room_archive(
+    directory: str | Path,
+) -> AsyncIterator[FilesystemRoomArchive]:
+    room_archive = FilesystemRoomArchive(directory)
+    try:
+        yield room_archive
+    finally:
+        await room_archive.close()
@@ -0,0 +1,149 @@
+import logging
+from collections.abc import AsyncIterator, Iterable
+
+from redis.asyncio.client import Redis
+
+from src.api.api_structures import Action
+from src.room_store.archive_format import (
+    compress_archive_json,
+    decode_archive,
+    encode_archive,
+)
+from src.room_store.room_archive import ArchiveObject, ObjectRoomArchive
+
+logger = logging.getLogger(__name__)
+
+# Set of the IDs of every archived room, and possibly some that were deleted or
+# failed to be written, but never missing one that was archived
+ARCHIVED_ROOMS_KEY = 'archived-rooms'
+# Hash of the ETag of each room archived through the index, so unchanged rooms
+# can be found without a request to the archive
+ARCHIVED_ROOM_ETAGS_KEY = 'archived-room-etags'
+# Set once the index has been filled in from the archive, until then every room
+# has to be looked up in the archive. The version is bumped whenever rooms could
+# have been archived without being added to the index, so the index is filled in
+# again instead of trusting a flag set before then
+ARCHIVED_ROOMS_INDEXED_KEY = 'archived-rooms-indexed:v2'
+# How many room IDs to add to the index at once while filling it in
+INDEX_BATCH_SIZE = 1000
+
+
+class IndexedRoomArchive(ObjectRoomArchive):
+    """
+    Keeps the IDs of archived rooms in redis alongside the archive, so checking
+    for a room that was never archived (e.g. every new room) doesn't need a
+    request to the archive
+
+    Rooms are added to the index before they're written and removed after
+    they're deleted, so a room that's missing from the index is never archived.
+    Rooms in the index are still looked up in the archive, unless they were
+    written through the index, in which case the ETag they were written with is
+    kept too. Those rooms are known to exist, and reading one with a matching
+    ETag (e.g. for a copy cached by DiskCachedRoomArchive) is answered without
+    asking the archive. The ETag is removed while the room is being written, so
+    it's never older than the archived room
+
+    If a room was archived without being indexed anyway (e.g. by a server that
+    predates the index), it's read as empty and its archived actions would be
+    overwritten the next time it's archived. So writing a room that's missing from
+    the index keeps the actions already in the archive
+    """
+
+    def __init__(self, room_archive: ObjectRoomArchive, redis: Redis):
+        self._room_archive = room_archive
+        self._redis = redis
+
+    async def index_if_missing(self) -> None:
+        """
+        Fill in the index from the archive, unless it's already been filled in
+        """
+        if await self._redis.exists(ARCHIVED_ROOMS_INDEXED_KEY):
+            return
+
+        logger.info('Indexing archived rooms')
+        room_count = 0
+        batch: list[str] = []
+        async for room_id in self._room_archive.get_all_room_ids():
+            batch.append(room_id)
+            if len(batch) >= INDEX_BATCH_SIZE:
+                await self._redis.sadd(ARCHIVED_ROOMS_KEY, *batch)
+                room_count += len(batch)
+                batch = []
+        if batch:
+            await self._redis.sadd(ARCHIVED_ROOMS_KEY, *batch)
+            room_count += len(batch)
+
+        await self._redis.set(ARCHIVED_ROOMS_INDEXED_KEY, 1)
+        logger.info('Indexed archived rooms', extra={'rooms': room_count})
+
+    def get_all_room_ids(self) -> AsyncIterator[str]:
+        return self._room_archive.get_all_room_ids()
+
+    async def room_exists(self, room_id: str) -> bool:
+        async with self._redis.pipeline() as pipeline:
+            await pipeline.exists(ARCHIVED_ROOMS_INDEXED_KEY)
+            await pipeline.sismember(ARCHIVED_ROOMS_KEY, room_id)
+            await pipeline.hexists(ARCHIVED_ROOM_ETAGS_KEY, room_id)
+            indexed, in_index, has_etag = await pipeline.execute()
+
+        if indexed and not in_index:
+            return False
+        if has_etag:
+            return True
+        return await self._room_archive.room_exists(room_id)
+
+    async def read(self, room_id: str) -> Iterable[Action]:
+        return await self._room_archive.read(room_id)
+
+    async def read_object(
+        self, room_id: str, if_none_match: str | None = None
+    ) -> ArchiveObject | None:
+        if if_none_match is not None:
+            etag = await self._redis.hget(ARCHIVED_ROOM_ETAGS_KEY, room_id)
+            if etag is not None and etag.decode() == if_none_match:
+                return None
+        return await self._room_archive.read_object(room_id, if_none_match)
+
+    async def _add_to_index(self, room_id: str) -> list[Action] | None:
+        """
+        Add the room to the index and forget its ETag until it's written
+
+        :return: The actions already archived for the room, if it was archived
+        without being added to the index
+        """
+        async with self._redis.pipeline() as pipeline:
+            await pipeline.sadd(ARCHIVED_ROOMS_KEY, room_id)
+            await pipeline.hdel(ARCHIVED_ROOM_ETAGS_KEY, room_id)
+            added, _ = await pipeline.execute()
+        if not added:
+            return None
+        if not await self._room_archive.room_exists(room_id):
+            return None
+
+        logger.warning(
+            f'Room {room_id} was archived without being indexed, keeping its '
+            'archived actions',
+            extra={'room_id': room_id},
+        )
+        return list(await self._room_archive.read(room_id))
+
+    async def write(self, room_id: str, data: Iterable[Action]) -> None:
+        await self.write_object(room_id, encode_archive(data))
+
+    async def write_raw(self, room_id: str, data: bytes) -> None:
+        await self.write_object(room_id, compress_archive_json(data))
+
+    async def write_object(self, room_id: str, data: bytes) -> str:
+        archived = await self._add_to_index(room_id)
+        if archived is not None:
+            data = encode_archive([*archived, *decode_archive(data)])
+        etag = await self._room_archive.write_object(room_id, data)
+        await self._redis.hset(ARCHIVED_ROOM_ETAGS_KEY, room_id, etag)
+        return etag
+
+    async def delete(self, room_id: str) -> None:
+        await self._room_archive.delete(room_id)
+        async with self._redis.pipeline() as pipeline:
+            await pipeline.srem(ARCHIVED_ROOMS_KEY, room_id)
+            await pipeline.hdel(ARCHIVED_ROOM_ETAGS_KEY, room_id)
+            await pipeline.execute()
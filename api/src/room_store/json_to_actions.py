@@ -1,17 +1,19 @@
 import json
-from collections.abc import Iterator
+from collections.abc import Iterable, Iterator
 
-from dacite import from_dict
+from src.api.api_structures import Action
+from src.api.codec import decode_action
 
-from src.api.api_structures import Action, DeleteAction, UpsertAction
 
-
-def json_to_actions(raw_updates: list[str]) -> Iterator[Action]:
+def json_to_actions(raw_updates: Iterable[str | bytes]) -> Iterator[Action]:
+    """
+    :param raw_updates: JSON lists of actions, or whole requests holding them in
+    their actions field
+    """
     for raw_update_group in raw_updates:
         update_group = json.loads(raw_update_group)
+        if isinstance(update_group, dict):
+            update_group = update_group['actions']
         for update in update_group:
-            action = update['action']
-            if action == 'upsert':
-                yield from_dict(UpsertAction, update)
-            elif action == 'delete':
-                yield from_dict(DeleteAction, update)
+            if update['action'] in ('upsert', 'delete'):
+                yield decode_action(update)
@@ -1,13 +1,20 @@
 from collections.abc import AsyncIterator, Iterable
 
 from src.api.api_structures import Action
+from src.room_store.archive_format import (
+    compress_archive_json,
+    decode_archive,
+    encode_archive,
+)
 from src.room_store.common import NoSuchRoomError
-from src.room_store.room_archive import RoomArchive
+from src.room_store.room_archive import ArchiveObject, ObjectRoomArchive, md5_etag
 
 
-class MemoryRoomArchive(RoomArchive):
+class MemoryRoomArchive(ObjectRoomArchive):
+    """Keeps archives in the same format as S3RoomArchive, but in memory"""
+
     def __init__(self) -> None:
-        self.storage: dict[str, Iterable[Action]] = {}
+        self.storage: dict[str, bytes] = {}
 
     async def get_all_room_ids(self) -> AsyncIterator[str]:
         for room_id in list(self.storage.keys()):
@@ -17,13 +24,29 @@ class MemoryRoomArchive(RoomArchive):
         return room_id in self.storage
 
     async def read(self, room_id: str) -> Iterable[Action]:
-        actions = self.storage.get(room_id)
-        if actions is None:
+        data = self.storage.get(room_id)
+        if data is None:
+            raise NoSuchRoomError
+        return decode_archive(data)
+
+    async def read_object(
+        self, room_id: str, if_none_match: str | None = None
+    ) -> ArchiveObject | None:
+        data = self.storage.get(room_id)
+        if data is None:
             raise NoSuchRoomError
-        return actions
+        etag = md5_etag(data)
+        return None if etag == if_none_match else ArchiveObject(data, etag)
 
     async def write(self, room_id: str, data: Iterable[Action]) -> None:
+        await self.write_object(room_id, encode_archive(data))
+
+    async def write_raw(self, room_id: str, data: bytes) -> None:
+        await self.write_object(room_id, compress_archive_json(data))
+
+    async def write_object(self, room_id: str, data: bytes) -> str:
         self.storage[room_id] = data
+        return md5_etag(data)
 
     async def delete(self, room_id: str) -> None:
         self.storage.pop(room_id, None)
@@ -1,24 +1,37 @@
 from __future__ import annotations
 
 import asyncio
+import json
 import logging
 import time
-from collections import defaultdict
+from collections import defaultdict, deque
 from collections.abc import AsyncGenerator, AsyncIterator, Iterable
 from copy import copy
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, replace
 from typing import (
     Any,
 )
 
 from src.api.api_structures import Action, Request
-from src.room_store.common import NoSuchRoomError
+from src.api.codec import encode_action
+from src.room_store.common import (
+    EAGER_COMPACTION_COOLDOWN_SECONDS,
+    EAGER_COMPACTION_LENGTH,
+    MAX_QUEUED_CHANGES,
+    ROOM_LOG_LENGTH,
+    NoSuchRoomError,
+    first_room_version,
+)
+from src.room_store.json_to_actions import json_to_actions
 from src.room_store.room_store import (
     COMPACTION_LOCK_EXPIRATION_SECONDS,
+    HYDRATION_LOCK_EXPIRATION_SECONDS,
+    RawReplacementData,
     ReplacementData,
     RoomStore,
     UnexpectedReplacementId,
     UnexpectedReplacementToken,
+    VersionedRoom,
 )
 
 logger = logging.getLogger(__name__)
@@ -32,6 +45,17 @@ class MemoryRoomStorage:
     last_room_activity_by_id: defaultdict[str, int] = field(
         default_factory=lambda: defaultdict(lambda: int(time.time()))
     )
+    dirty_room_ids: set[str] = field(default_factory=set)
+    oversized_room_ids: set[str] = field(default_factory=set)
+    # When each room can next be queued to be compacted right away
+    eager_compaction_cooldowns_by_id: dict[str, float] = field(default_factory=dict)
+    room_versions: dict[str, int] = field(default_factory=dict)
+    # Who holds the lock on loading each room from the archive
+    hydration_locks_by_id: dict[str, HydrationLock] = field(default_factory=dict)
+    # The latest requests added to each room, with their versions
+    room_logs: defaultdict[str, deque[Request]] = field(
+        default_factory=lambda: defaultdict(lambda: deque(maxlen=ROOM_LOG_LENGTH))
+    )
 
 
 @dataclass
@@ -40,14 +64,31 @@ class ReplacementLock:
     expire_time: float
 
 
+@dataclass
+class HydrationLock:
+    loader_id: str
+    expire_time: float
+
+
 class MemoryRoomStore(RoomStore):
-    def __init__(self, storage: MemoryRoomStorage):
+    def __init__(
+        self,
+        storage: MemoryRoomStorage,
+        eager_compaction_length: int = EAGER_COMPACTION_LENGTH,
+    ):
+        """
+        :param eager_compaction_length: How many actions a room can hold before
+        it's queued to be compacted right away. 0 never queues rooms
+        """
         self.storage = storage
+        self._eager_compaction_length = eager_compaction_length
         self._changes: dict[str, list[asyncio.Queue]] = defaultdict(list)
+        self._invalidations: list[asyncio.Queue[str]] = []
         self._replacement_lock: ReplacementLock | None = None
 
     async def changes(self, room_id: str) -> AsyncGenerator[Request, None]:
-        queue: asyncio.Queue[Request] = asyncio.Queue()
+        # Writers wait for listeners that have fallen behind
+        queue: asyncio.Queue[Request] = asyncio.Queue(MAX_QUEUED_CHANGES)
         self._changes[room_id].append(queue)
         return self._room_changes(room_id, queue)
 
@@ -61,11 +102,47 @@ class MemoryRoomStore(RoomStore):
         finally:
             self._changes[room_id].remove(queue)
 
+    async def invalidations(self) -> AsyncGenerator[str, None]:
+        queue: asyncio.Queue[str] = asyncio.Queue()
+        self._invalidations.append(queue)
+        return self._room_invalidations(queue)
+
+    async def _room_invalidations(
+        self, queue: asyncio.Queue[str]
+    ) -> AsyncGenerator[str, None]:
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self._invalidations.remove(queue)
+
+    def _publish_invalidation(self, room_id: str) -> None:
+        for q in self._invalidations:
+            q.put_nowait(room_id)
+
     async def add_request(self, room_id: str, request: Request) -> None:
         await self._write(
             room_id, filter(lambda x: x.action != 'ping', request.actions)
         )
-        await self._publish(room_id, request)
+        version = self.storage.room_versions.get(room_id, first_room_version()) + 1
+        self.storage.room_versions[room_id] = version
+        versioned_request = replace(request, version=version)
+        self.storage.room_logs[room_id].append(versioned_request)
+        self._queue_if_oversized(room_id)
+        await self._publish(room_id, versioned_request)
+
+    def _queue_if_oversized(self, room_id: str) -> None:
+        if (
+            self._eager_compaction_length <= 0
+            or len(self.storage.rooms_by_id[room_id]) < self._eager_compaction_length
+        ):
+            return
+
+        now = time.time()
+        cooldowns = self.storage.eager_compaction_cooldowns_by_id
+        if cooldowns.get(room_id, 0) <= now:
+            cooldowns[room_id] = now + EAGER_COMPACTION_COOLDOWN_SECONDS
+            self.storage.oversized_room_ids.add(room_id)
 
     async def read(self, room_id: str) -> Iterable[Action]:
         # Yield the event loop at least once so reading is truly async
@@ -73,10 +150,37 @@ class MemoryRoomStore(RoomStore):
         self.storage.last_room_activity_by_id[room_id] = int(time.time())
         return copy(self.storage.rooms_by_id.get(room_id, []))
 
+    async def read_with_version(self, room_id: str) -> VersionedRoom:
+        actions = await self.read(room_id)
+        return VersionedRoom(actions, self.storage.room_versions.get(room_id))
+
+    async def write_snapshot(
+        self, room_id: str, actions: Iterable[Action], version: int
+    ) -> None:
+        # Rooms in memory don't keep a log of requests to skip past
+        pass
+
+    async def read_requests_since(
+        self, room_id: str, version: int
+    ) -> list[Request] | None:
+        # Yield the event loop at least once so reading is truly async
+        await asyncio.sleep(0)
+        self.storage.last_room_activity_by_id[room_id] = int(time.time())
+        current_version = self.storage.room_versions.get(room_id)
+        if current_version is None or current_version < version:
+            return None
+
+        missed = current_version - version
+        log = list(self.storage.room_logs.get(room_id, []))
+        if missed > len(log):
+            return None
+        return log[len(log) - missed :]
+
     async def _write(self, room_id: str, updates: Iterable[Action]) -> None:
         # Yield the event loop at least once so writing is truly async
         await asyncio.sleep(0)
         self.storage.last_room_activity_by_id[room_id] = int(time.time())
+        self.storage.dirty_room_ids.add(room_id)
         for update in updates:
             self.storage.rooms_by_id[room_id].append(update)
 
@@ -85,6 +189,8 @@ class MemoryRoomStore(RoomStore):
         await asyncio.sleep(0)
         if not self.storage.rooms_by_id.get(room_id):
             self.storage.rooms_by_id[room_id] = list(actions)
+            self.storage.room_versions.setdefault(room_id, first_room_version())
+            self.storage.dirty_room_ids.add(room_id)
 
     async def get_all_room_ids(self) -> AsyncIterator[str]:
         # Make a copy so that deletions don't break iteration
@@ -114,15 +220,40 @@ class MemoryRoomStore(RoomStore):
         )
         return True
 
+    async def acquire_hydration_lock(self, room_id: str, loader_id: str) -> bool:
+        lock = self.storage.hydration_locks_by_id.get(room_id)
+        if lock is not None and lock.expire_time >= time.monotonic():
+            return False
+
+        self.storage.hydration_locks_by_id[room_id] = HydrationLock(
+            loader_id, time.monotonic() + HYDRATION_LOCK_EXPIRATION_SECONDS
+        )
+        return True
+
+    async def release_hydration_lock(self, room_id: str, loader_id: str) -> None:
+        lock = self.storage.hydration_locks_by_id.get(room_id)
+        if lock is not None and lock.loader_id == loader_id:
+            del self.storage.hydration_locks_by_id[room_id]
+
     async def force_acquire_replacement_lock(self, replacement_id: str) -> None:
         self._replacement_lock = ReplacementLock(
             replacement_id, time.monotonic() + COMPACTION_LOCK_EXPIRATION_SECONDS
         )
 
-    async def read_for_replacement(self, room_id: str) -> ReplacementData:
+    async def read_for_replacement(
+        self, room_id: str, read_only: bool = False
+    ) -> ReplacementData:
         actions = copy(self.storage.rooms_by_id[room_id])
         return ReplacementData(actions, len(actions))
 
+    async def read_raw_for_replacement(
+        self, room_id: str, read_only: bool = False
+    ) -> RawReplacementData:
+        actions = self.storage.rooms_by_id[room_id]
+        # Store every action as its own update, like a room log would
+        updates = [json.dumps([encode_action(action)]).encode() for action in actions]
+        return RawReplacementData(updates, len(actions))
+
     async def replace(
         self,
         room_id: str,
@@ -132,9 +263,21 @@ class MemoryRoomStore(RoomStore):
     ) -> None:
         if self._has_replacement_lock(replacement_id):
             self.storage.rooms_by_id[room_id][0:replace_token] = actions
+            self._publish_invalidation(room_id)
         else:
             raise UnexpectedReplacementId()
 
+    async def replace_raw(
+        self,
+        room_id: str,
+        update: bytes,
+        replace_token: Any,
+        replacement_id: str,
+    ) -> None:
+        await self.replace(
+            room_id, list(json_to_actions([update])), replace_token, replacement_id
+        )
+
     async def delete(
         self, room_id: str, replacement_id: str, replace_token: Any
     ) -> None:
@@ -147,6 +290,9 @@ class MemoryRoomStore(RoomStore):
 
         del self.storage.rooms_by_id[room_id]
         self.storage.last_room_activity_by_id.pop(room_id, None)
+        self.storage.room_versions.pop(room_id, None)
+        self.storage.room_logs.pop(room_id, None)
+        self._publish_invalidation(room_id)
 
     def _has_replacement_lock(self, replacement_id: str) -> bool:
         return (
@@ -155,11 +301,35 @@ class MemoryRoomStore(RoomStore):
             and self._replacement_lock.expire_time >= time.monotonic()
         )
 
-    async def get_room_idle_seconds(self, room_id: str) -> int:
+    async def get_room_idle_seconds(self, room_id: str, read_only: bool = False) -> int:
         if room_id not in self.storage.rooms_by_id:
             raise NoSuchRoomError
         return int(time.time()) - self.storage.last_room_activity_by_id[room_id]
 
+    async def get_idle_room_ids(
+        self, idle_seconds: int, read_only: bool = False
+    ) -> AsyncIterator[str]:
+        cutoff = int(time.time()) - idle_seconds
+        # Make a copy so that deletions don't break iteration
+        for room_id, last_activity_time in list(
+            self.storage.last_room_activity_by_id.items()
+        ):
+            if last_activity_time <= cutoff:
+                yield room_id
+
+    async def drain_dirty_room_ids(self) -> set[str]:
+        dirty_room_ids = self.storage.dirty_room_ids
+        self.storage.dirty_room_ids = set()
+        return dirty_room_ids
+
+    async def add_dirty_room_ids(self, room_ids: Iterable[str]) -> None:
+        self.storage.dirty_room_ids.update(room_ids)
+
+    async def drain_oversized_room_ids(self) -> set[str]:
+        oversized_room_ids = self.storage.oversized_room_ids
+        self.storage.oversized_room_ids = set()
+        return oversized_room_ids
+
     async def seconds_since_last_activity(self) -> int | None:
         most_recent_activity = 0
         for _, last_activity_time in self.storage.last_room_activity_by_id.items():
@@ -1,20 +1,28 @@
 from __future__ import annotations
 
+import asyncio
 import logging
 from collections.abc import AsyncGenerator, AsyncIterator, Iterable
 from typing import (
     Any,
 )
+from uuid import uuid4
 
 from src.api.api_structures import Action, Request
 from src.room_store.room_archive import RoomArchive
 from src.room_store.room_store import (
+    RawReplacementData,
     ReplacementData,
     RoomStore,
+    VersionedRoom,
 )
 
 logger = logging.getLogger(__name__)
 
+# How often to check whether another server has finished loading a room from the
+# archive
+HYDRATION_POLL_SECONDS = 0.05
+
 
 class MergedRoomStore(RoomStore):
     def __init__(
@@ -24,10 +32,16 @@ class MergedRoomStore(RoomStore):
     ):
         self._room_store = room_store
         self._room_archive = room_archive
+        # Rooms being loaded from the archive by this process, so everyone reading
+        # a room at once waits on the same load
+        self._hydrations: dict[str, asyncio.Task[None]] = {}
 
     async def changes(self, room_id: str) -> AsyncIterator[Request]:
         return await self._room_store.changes(room_id)
 
+    async def invalidations(self) -> AsyncIterator[str]:
+        return await self._room_store.invalidations()
+
     async def get_all_room_ids(self) -> AsyncGenerator[str, None]:
         """
         Yield the IDs of all rooms in both the room store and the room archive.
@@ -45,17 +59,66 @@ class MergedRoomStore(RoomStore):
         ) or await self._room_archive.room_exists(room_id)
 
     async def _load_into_redis(self, room_id: str) -> None:
-        if not await self._room_store.room_exists(
-            room_id
-        ) and await self._room_archive.room_exists(room_id):
-            await self._room_store.write_if_missing(
-                room_id, await self._room_archive.read(room_id)
+        if await self._room_store.room_exists(room_id):
+            return
+
+        hydration = self._hydrations.get(room_id)
+        if hydration is None:
+            hydration = asyncio.create_task(
+                self._hydrate(room_id), name=f'hydrate {room_id}'
             )
+            self._hydrations[room_id] = hydration
+            hydration.add_done_callback(lambda _: self._hydrations.pop(room_id, None))
+        # Someone giving up on reading the room shouldn't cancel it for everyone
+        # else waiting on it
+        await asyncio.shield(hydration)
+
+    async def _hydrate(self, room_id: str) -> None:
+        """
+        Load the room from the archive, unless another server is already loading
+        it, in which case wait for it to finish. If the other server gives up or
+        dies, the lock is released or expires and the room is loaded here instead
+
+        Most rooms read for the first time are new rather than archived, so the
+        lock is only taken for rooms that are actually in the archive
+        """
+        if not await self._room_archive.room_exists(room_id):
+            return
+
+        loader_id = str(uuid4())
+        while not await self._room_store.acquire_hydration_lock(room_id, loader_id):
+            await asyncio.sleep(HYDRATION_POLL_SECONDS)
+            if await self._room_store.room_exists(room_id):
+                return
+
+        try:
+            if not await self._room_store.room_exists(room_id):
+                await self._room_store.write_if_missing(
+                    room_id, await self._room_archive.read(room_id)
+                )
+        finally:
+            await self._room_store.release_hydration_lock(room_id, loader_id)
 
     async def read(self, room_id: str) -> Iterable[Action]:
         await self._load_into_redis(room_id)
         return await self._room_store.read(room_id)
 
+    async def read_with_version(self, room_id: str) -> VersionedRoom:
+        await self._load_into_redis(room_id)
+        return await self._room_store.read_with_version(room_id)
+
+    async def write_snapshot(
+        self, room_id: str, actions: Iterable[Action], version: int
+    ) -> None:
+        await self._room_store.write_snapshot(room_id, actions, version)
+
+    async def read_requests_since(
+        self, room_id: str, version: int
+    ) -> list[Request] | None:
+        # A room that's only in the archive has no version, so there's no need to
+        # load it
+        return await self._room_store.read_requests_since(room_id, version)
+
     async def add_request(self, room_id: str, request: Request) -> None:
         await self._room_store.add_request(room_id, request)
 
@@ -67,20 +130,58 @@ class MergedRoomStore(RoomStore):
     ) -> bool:
         return await self._room_store.acquire_replacement_lock(replacer_id, force=force)
 
-    async def read_for_replacement(self, room_id: str) -> ReplacementData:
-        await self._load_into_redis(room_id)
-        return await self._room_store.read_for_replacement(room_id)
+    async def acquire_hydration_lock(self, room_id: str, loader_id: str) -> bool:
+        return await self._room_store.acquire_hydration_lock(room_id, loader_id)
+
+    async def release_hydration_lock(self, room_id: str, loader_id: str) -> None:
+        await self._room_store.release_hydration_lock(room_id, loader_id)
+
+    async def read_for_replacement(
+        self, room_id: str, read_only: bool = False
+    ) -> ReplacementData:
+        if not read_only:
+            await self._load_into_redis(room_id)
+        return await self._room_store.read_for_replacement(room_id, read_only)
+
+    async def read_raw_for_replacement(
+        self, room_id: str, read_only: bool = False
+    ) -> RawReplacementData:
+        if not read_only:
+            await self._load_into_redis(room_id)
+        return await self._room_store.read_raw_for_replacement(room_id, read_only)
 
     async def replace(
         self, room_id: str, actions: list[Action], replace_token: Any, replacer_id: str
     ) -> None:
         await self._room_store.replace(room_id, actions, replace_token, replacer_id)
 
+    async def replace_raw(
+        self, room_id: str, update: bytes, replace_token: Any, replacer_id: str
+    ) -> None:
+        await self._room_store.replace_raw(room_id, update, replace_token, replacer_id)
+
     async def delete(self, room_id: str, replacer_id: str, replace_token: Any) -> None:
         await self._room_store.delete(room_id, replacer_id, replace_token)
 
-    async def get_room_idle_seconds(self, room_id: str) -> int:
-        return await self._room_store.get_room_idle_seconds(room_id)
+    async def get_room_idle_seconds(self, room_id: str, read_only: bool = False) -> int:
+        return await self._room_store.get_room_idle_seconds(room_id, read_only)
+
+    async def get_idle_room_ids(
+        self, idle_seconds: int, read_only: bool = False
+    ) -> AsyncIterator[str]:
+        async for room_id in self._room_store.get_idle_room_ids(
+            idle_seconds, read_only
+        ):
+            yield room_id
+
+    async def drain_dirty_room_ids(self) -> set[str]:
+        return await self._room_store.drain_dirty_room_ids()
+
+    async def add_dirty_room_ids(self, room_ids: Iterable[str]) -> None:
+        await self._room_store.add_dirty_room_ids(room_ids)
+
+    async def drain_oversized_room_ids(self) -> set[str]:
+        return await self._room_store.drain_oversized_room_ids()
 
     async def seconds_since_last_activity(self) -> int | None:
         return await self._room_store.seconds_since_last_activity()
@@ -0,0 +1,563 @@
+from __future__ import annotations
+
+import json
+import logging
+from collections.abc import AsyncGenerator, AsyncIterator, Iterable
+from contextlib import asynccontextmanager
+from typing import Any
+
+from redis.asyncio.client import Pipeline, Redis
+from redis.commands.core import AsyncScript
+from redis.exceptions import ResponseError
+
+from src.api.api_structures import Action, Request, UpsertAction
+from src.api.codec import decode_token, encode_token, request_message
+from src.apm import instrument
+from src.room_store.common import ROOM_LOG_LENGTH, first_room_version
+from src.room_store.json_to_actions import json_to_actions
+from src.room_store.redis_room_listener import (
+    RoomListener,
+    channel_key,
+    create_redis_room_listener,
+)
+from src.room_store.redis_room_store import (
+    ERR_INVALID_COMPACTION_KEY,
+    LOG_REQUEST_FUNCTION,
+    READ_REQUESTS_SINCE,
+    READ_ROOM,
+    REPLACEMENT_KEY,
+    ROOM_ACTIVITY_KEY,
+    WRITE_SNAPSHOT,
+    RedisRoomStore,
+    log_key,
+    version_key,
+)
+from src.room_store.room_store import (
+    RawReplacementData,
+    ReplacementData,
+    UnexpectedReplacementId,
+    UnexpectedReplacementToken,
+    VersionedRoom,
+)
+from src.room_store.write_coalescer import QueueCommands, WriteCoalescer
+from src.spatial_index import DEFAULT_CELL_SIZE
+
+logger = logging.getLogger(__name__)
+
+ERR_INVALID_ROOM_VERSION = 'INVALID_ROOM_VERSION'
+
+# Each room is stored in two hashes:
+#
+# room-tokens:{room_id} maps token ids to "<creation sequence> <token json>", so
+# reading the room is a single HGETALL that's proportional to the number of tokens
+#
+# room-index:{room_id} holds the bookkeeping needed to apply actions the same way
+# Room does:
+#   box:{token_id}   -> "start_x start_y start_z end_x end_y end_z" of the token
+#   bucket:{x}:{y}   -> the tokens in that bucket of the same grid over the x/y
+#                       plane that BoxIndex uses, as "<id length>:<id><box>;" for
+#                       each token so ids can hold any character
+#   next-seq         -> creation sequence of the most recently created token
+#   version          -> incremented on every write, used as the replace token
+#
+# A token is only checked against the tokens in the buckets it covers, so applying
+# an action costs time proportional to the buckets and tokens nearby instead of
+# the volume of the token
+#
+# The version of the room sent to clients and its log of recent requests are kept
+# the same way as RedisRoomStore keeps them
+#
+# Actions are passed to the scripts flattened into ARGV. Upserts take four
+# arguments: "upsert", token id, box, token json. Deletes take two: "delete",
+# token id
+# language=lua
+_APPLY_ACTIONS_FUNCTIONS = f"""
+local cell_size = {DEFAULT_CELL_SIZE}
+
+local function parse_box(box)
+    local c = {{}}
+    for coord in string.gmatch(box, '%S+') do
+        c[#c + 1] = tonumber(coord)
+    end
+    return c
+end
+
+local function boxes_intersect(a, b)
+    return a[1] < b[4] and b[1] < a[4]
+        and a[2] < b[5] and b[2] < a[5]
+        and a[3] < b[6] and b[3] < a[6]
+end
+
+-- Call fn with the field of each bucket the box covers, stopping once it
+-- returns true
+local function any_bucket(c, fn)
+    for x = math.floor(c[1] / cell_size), math.floor((c[4] - 1) / cell_size) do
+        for y = math.floor(c[2] / cell_size), math.floor((c[5] - 1) / cell_size) do
+            if fn('bucket:' .. x .. ':' .. y) then
+                return true
+            end
+        end
+    end
+    return false
+end
+
+-- Call fn with the id and box of each token in the bucket, stopping once it
+-- returns true
+local function any_entry(bucket, fn)
+    local pos = 1
+    while pos <= #bucket do
+        local colon = string.find(bucket, ':', pos, true)
+        local id_end = colon + tonumber(string.sub(bucket, pos, colon - 1))
+        local box_end = string.find(bucket, ';', id_end + 1, true)
+        local token_id = string.sub(bucket, colon + 1, id_end)
+        if fn(token_id, string.sub(bucket, id_end + 1, box_end - 1)) then
+            return true
+        end
+        pos = box_end + 1
+    end
+    return false
+end
+
+local function remove_from_buckets(index_key, token_id)
+    local old_box = redis.call('hget', index_key, 'box:' .. token_id)
+    if not old_box then
+        return
+    end
+
+    any_bucket(parse_box(old_box), function(field)
+        local kept = {{}}
+        any_entry(redis.call('hget', index_key, field) or '', function(id, box)
+            if id ~= token_id then
+                kept[#kept + 1] = #id .. ':' .. id .. box .. ';'
+            end
+            return false
+        end)
+        if #kept == 0 then
+            redis.call('hdel', index_key, field)
+        else
+            redis.call('hset', index_key, field, table.concat(kept))
+        end
+        return false
+    end)
+    redis.call('hdel', index_key, 'box:' .. token_id)
+end
+
+local function add_to_buckets(index_key, token_id, box)
+    local entry = #token_id .. ':' .. token_id .. box .. ';'
+    any_bucket(parse_box(box), function(field)
+        local bucket = redis.call('hget', index_key, field) or ''
+        redis.call('hset', index_key, field, bucket .. entry)
+        return false
+    end)
+    redis.call('hset', index_key, 'box:' .. token_id, box)
+end
+
+local function is_occupied(index_key, box)
+    local c = parse_box(box)
+    return any_bucket(c, function(field)
+        local bucket = redis.call('hget', index_key, field)
+        return bucket and any_entry(bucket, function(_, other_box)
+            return boxes_intersect(c, parse_box(other_box))
+        end)
+    end)
+end
+
+local function apply_actions(tokens_key, index_key, first_arg)
+    local i = first_arg
+    while i <= #ARGV do
+        local token_id = ARGV[i + 1]
+        if ARGV[i] == 'delete' then
+            remove_from_buckets(index_key, token_id)
+            redis.call('hdel', tokens_key, token_id)
+            i = i + 2
+        else
+            local box = ARGV[i + 2]
+            -- Like Room, reject any token that overlaps an existing token,
+            -- including itself
+            if not is_occupied(index_key, box) then
+                local seq
+                local existing = redis.call('hget', tokens_key, token_id)
+                if existing then
+                    seq = string.match(existing, '^%d+')
+                    remove_from_buckets(index_key, token_id)
+                else
+                    seq = redis.call('hincrby', index_key, 'next-seq', 1)
+                end
+
+                add_to_buckets(index_key, token_id, box)
+                redis.call('hset', tokens_key, token_id, seq .. ' ' .. ARGV[i + 3])
+            end
+            i = i + 4
+        end
+    end
+end
+"""
+
+# language=lua
+_APPLY_ACTIONS = f"""
+{_APPLY_ACTIONS_FUNCTIONS}
+{LOG_REQUEST_FUNCTION}
+local tokens_key = KEYS[1]
+local index_key = KEYS[2]
+local version_key = KEYS[3]
+local log_key = KEYS[4]
+local channel_key = KEYS[5]
+local message = ARGV[1]
+local first_version = ARGV[2]
+local log_length = tonumber(ARGV[3])
+
+apply_actions(tokens_key, index_key, 4)
+redis.call('hincrby', index_key, 'version', 1)
+log_request(version_key, log_key, channel_key, message, first_version, log_length)
+"""
+
+# language=lua
+_WRITE_IF_MISSING = f"""
+{_APPLY_ACTIONS_FUNCTIONS}
+local tokens_key = KEYS[1]
+local index_key = KEYS[2]
+local version_key = KEYS[3]
+local first_version = ARGV[1]
+
+if redis.call('exists', index_key) == 0 then
+    apply_actions(tokens_key, index_key, 2)
+    redis.call('hincrby', index_key, 'version', 1)
+    redis.call('set', version_key, first_version, 'nx')
+end
+"""
+
+# Rewrite the room from the given actions if nothing has been written to it since
+# it was read. Returns 1 if the room was rewritten, 0 otherwise
+# language=lua
+_REPLACE_ROOM = f"""
+{_APPLY_ACTIONS_FUNCTIONS}
+local tokens_key = KEYS[1]
+local index_key = KEYS[2]
+local compaction_key = KEYS[3]
+local compactor_id = ARGV[1]
+local expected_version = tonumber(ARGV[2])
+
+if redis.call('get', compaction_key) ~= compactor_id then
+    return redis.error_reply('{ERR_INVALID_COMPACTION_KEY}')
+end
+
+local version = tonumber(redis.call('hget', index_key, 'version')) or 0
+if version ~= expected_version then
+    return 0
+end
+
+redis.call('del', tokens_key, index_key)
+apply_actions(tokens_key, index_key, 3)
+redis.call('hset', index_key, 'version', version + 1)
+return 1
+"""
+
+# language=lua
+_DELETE_ROOM = f"""
+local tokens_key = KEYS[1]
+local index_key = KEYS[2]
+local compaction_key = KEYS[3]
+local version_key = KEYS[4]
+local log_key = KEYS[5]
+local compactor_id = ARGV[1]
+local expected_version = tonumber(ARGV[2])
+
+if redis.call('get', compaction_key) ~= compactor_id then
+    return redis.error_reply('{ERR_INVALID_COMPACTION_KEY}')
+end
+
+if (tonumber(redis.call('hget', index_key, 'version')) or 0) ~= expected_version then
+    return redis.error_reply('{ERR_INVALID_ROOM_VERSION}')
+end
+
+redis.call('del', tokens_key, index_key, version_key, log_key)
+"""
+
+
+def _tokens_key(room_id: str) -> str:
+    return f'room-tokens:{room_id}'
+
+
+def _index_key(room_id: str) -> str:
+    return f'room-index:{room_id}'
+
+
+def _action_args(actions: Iterable[Action]) -> list[str]:
+    args = []
+    for action in actions:
+        if action.action == 'upsert':
+            token = action.data
+            box = (
+                f'{token.start_x} {token.start_y} {token.start_z}'
+                f' {token.end_x} {token.end_y} {token.end_z}'
+            )
+            args += ['upsert', token.id, box, json.dumps(encode_token(token))]
+        elif action.action == 'delete':
+            args += ['delete', action.data]
+    return args
+
+
+def _sorted_token_json(raw_tokens: dict[bytes, bytes]) -> list[bytes]:
+    entries = []
+    for value in raw_tokens.values():
+        seq, token_json = value.split(b' ', 1)
+        entries.append((int(seq), token_json))
+    # Return tokens in the order they were created, like replaying the room would
+    entries.sort(key=lambda entry: entry[0])
+    return [token_json for _, token_json in entries]
+
+
+def _token_json_to_actions(token_json: list[bytes]) -> list[Action]:
+    return [UpsertAction(decode_token(json.loads(token))) for token in token_json]
+
+
+def _tokens_to_actions(raw_tokens: dict[bytes, bytes]) -> list[Action]:
+    return _token_json_to_actions(_sorted_token_json(raw_tokens))
+
+
+def _upsert_json(token_json: bytes) -> bytes:
+    return b'{"action": "upsert", "data": ' + token_json + b'}'
+
+
+class RedisHashRoomStore(RedisRoomStore):
+    """
+    Room store that keeps the current state of each room in redis instead of a log
+    of every change made to it.
+
+    Actions are applied to the stored room atomically as they are added, so reads
+    never need to replay history and compaction only needs to archive and delete
+    rooms. Tokens without a color are assigned one when the room is read, instead
+    of when they are added.
+    """
+
+    def __init__(
+        self,
+        redis: Redis,
+        room_listener: RoomListener,
+        apply_actions: AsyncScript,
+        replace_room: AsyncScript,
+        delete_room: AsyncScript,
+        write_if_missing: AsyncScript,
+        read_requests_since: AsyncScript,
+        read_room: AsyncScript,
+        write_snapshot: AsyncScript,
+        write_coalescer: WriteCoalescer | None = None,
+    ):
+        # Adding requests, reading and replacement are overridden, so the list
+        # scripts are unused
+        super().__init__(
+            redis,
+            room_listener,
+            apply_actions,
+            replace_room,
+            delete_room,
+            write_if_missing,
+            read_requests_since,
+            read_room,
+            write_snapshot,
+            write_coalescer,
+        )
+        self._apply_actions = apply_actions
+        self._replace_room = replace_room
+
+    def _existence_key(self, room_id: str) -> str:
+        return _index_key(room_id)
+
+    async def get_all_room_ids(self) -> AsyncGenerator[str, None]:
+        async for room_key in self._redis.scan_iter('room-index:*'):
+            yield room_key.decode().removeprefix('room-index:')
+
+    @instrument
+    async def room_exists(self, room_id: str) -> bool:
+        return bool(await self._redis.exists(_index_key(room_id)))
+
+    @instrument
+    async def read_with_version(self, room_id: str) -> VersionedRoom:
+        async with self._redis.pipeline() as pipeline:
+            await pipeline.hgetall(_tokens_key(room_id))
+            await pipeline.get(version_key(room_id))
+            await self._record_activity(pipeline, room_id)
+            raw_tokens, version, _ = await pipeline.execute()
+            return VersionedRoom(
+                _tokens_to_actions(raw_tokens),
+                None if version is None else int(version),
+            )
+
+    async def write_snapshot(
+        self, room_id: str, actions: Iterable[Action], version: int
+    ) -> None:
+        # Rooms are always stored compacted, so there's nothing to snapshot
+        pass
+
+    def _add_request_commands(self, room_id: str, request: Request) -> QueueCommands:
+        args: list[str | int] = [
+            request_message(request),
+            first_room_version(),
+            ROOM_LOG_LENGTH,
+            *_action_args(request.actions),
+        ]
+
+        async def queue_commands(pipeline: Pipeline) -> None:
+            await self._apply_actions(
+                client=pipeline,
+                keys=[
+                    _tokens_key(room_id),
+                    _index_key(room_id),
+                    version_key(room_id),
+                    log_key(room_id),
+                    channel_key(room_id),
+                ],
+                args=args,
+            )
+            await self._record_activity(pipeline, room_id)
+            await self._mark_dirty(pipeline, room_id)
+
+        return queue_commands
+
+    @instrument
+    async def write_if_missing(self, room_id: str, actions: Iterable[Action]) -> None:
+        async with self._redis.pipeline() as pipeline:
+            await self._write_if_missing(
+                client=pipeline,
+                keys=[_tokens_key(room_id), _index_key(room_id), version_key(room_id)],
+                args=[first_room_version(), *_action_args(actions)],
+            )
+            await self._record_activity(pipeline, room_id)
+            await self._mark_dirty(pipeline, room_id)
+            await pipeline.execute()
+
+    async def _read_tokens_for_replacement(
+        self, room_id: str, read_only: bool
+    ) -> tuple[list[bytes], int]:
+        async with self._redis.pipeline() as pipeline:
+            await pipeline.hgetall(_tokens_key(room_id))
+            await pipeline.hget(_index_key(room_id), 'version')
+            await pipeline.zscore(ROOM_ACTIVITY_KEY, room_id)
+            raw_tokens, version, last_activity = await pipeline.execute()
+
+        if version is not None and last_activity is None and not read_only:
+            await self._record_missing_activity(room_id)
+
+        return _sorted_token_json(raw_tokens), int(version or 0)
+
+    @instrument
+    async def read_for_replacement(
+        self, room_id: str, read_only: bool = False
+    ) -> ReplacementData:
+        token_json, version = await self._read_tokens_for_replacement(
+            room_id, read_only
+        )
+        return ReplacementData(_token_json_to_actions(token_json), version)
+
+    @instrument
+    async def read_raw_for_replacement(
+        self, room_id: str, read_only: bool = False
+    ) -> RawReplacementData:
+        token_json, version = await self._read_tokens_for_replacement(
+            room_id, read_only
+        )
+        update = b'[' + b', '.join(_upsert_json(token) for token in token_json) + b']'
+        return RawReplacementData([update], version)
+
+    @instrument
+    async def replace(
+        self, room_id: str, actions: list[Action], replace_token: Any, replacer_id: str
+    ) -> None:
+        try:
+            replaced = await self._replace_room(
+                keys=[_tokens_key(room_id), _index_key(room_id), REPLACEMENT_KEY],
+                args=[replacer_id, replace_token, *_action_args(actions)],
+            )
+        except ResponseError as e:
+            # The error message is only exposed as the first element in the args
+            # tuple :(
+            (msg,) = e.args
+
+            if msg == ERR_INVALID_COMPACTION_KEY:
+                raise UnexpectedReplacementId() from e
+            else:
+                raise
+
+        # The room is always stored compacted, so if it changed since it was read
+        # there's no harm in leaving it as it is
+        if replaced:
+            await self._room_listener.publish_invalidation(room_id)
+
+    async def replace_raw(
+        self, room_id: str, update: bytes, replace_token: Any, replacer_id: str
+    ) -> None:
+        # Applying actions to a hash room needs the position of every token, so
+        # there's no avoiding decoding them
+        await self.replace(
+            room_id, list(json_to_actions([update])), replace_token, replacer_id
+        )
+
+    @instrument
+    async def delete(self, room_id: str, replacer_id: str, replace_token: Any) -> None:
+        try:
+            async with self._redis.pipeline() as pipeline:
+                await self._delete_room(
+                    keys=[
+                        _tokens_key(room_id),
+                        _index_key(room_id),
+                        REPLACEMENT_KEY,
+                        version_key(room_id),
+                        log_key(room_id),
+                    ],
+                    args=[replacer_id, replace_token],
+                )
+                await self._forget_activity(pipeline, room_id)
+                await self._room_listener.publish_invalidation(room_id, pipeline)
+                await pipeline.execute()
+        except ResponseError as e:
+            # The error message is only exposed as the first element in the args
+            # tuple :(
+            (msg,) = e.args
+
+            if msg == ERR_INVALID_ROOM_VERSION:
+                raise UnexpectedReplacementToken() from e
+            elif msg == ERR_INVALID_COMPACTION_KEY:
+                raise UnexpectedReplacementId() from e
+            else:
+                raise
+
+
+@asynccontextmanager
+async def create_redis_hash_room_store(
+    redis: Redis, write_batch_window_seconds: float | None = None
+) -> AsyncIterator[RedisHashRoomStore]:
+    """
+    :param write_batch_window_seconds: How long to gather requests from every
+    connection before writing them together, or None to write each on its own
+    """
+    write_coalescer = (
+        None
+        if write_batch_window_seconds is None
+        else WriteCoalescer(redis, write_batch_window_seconds)
+    )
+    apply_actions = redis.register_script(_APPLY_ACTIONS)
+    replace_room = redis.register_script(_REPLACE_ROOM)
+    delete_room = redis.register_script(_DELETE_ROOM)
+    write_if_missing = redis.register_script(_WRITE_IF_MISSING)
+    read_requests_since = redis.register_script(READ_REQUESTS_SINCE)
+    read_room = redis.register_script(READ_ROOM)
+    write_snapshot = redis.register_script(WRITE_SNAPSHOT)
+
+    async with create_redis_room_listener(redis) as listener:
+        store = RedisHashRoomStore(
+            redis,
+            listener,
+            apply_actions,
+            replace_room,
+            delete_room,
+            write_if_missing,
+            read_requests_since,
+            read_room,
+            write_snapshot,
+            write_coalescer,
+        )
+        try:
+            yield store
+        finally:
+            await store.close()
+            await listener.reset()
@@ -4,30 +4,80 @@ import json
 from asyncio import CancelledError, Future, Task
 from collections import defaultdict
 from collections.abc import AsyncIterator
-from dataclasses import asdict, dataclass
 from json import JSONDecodeError
-from typing import Literal, NoReturn
-
-from dacite import DaciteError, from_dict
+from typing import NoReturn, Protocol
 
 from redis.asyncio.client import PubSub, Redis
 from src.api.api_structures import Request
+from src.api.codec import DecodeError, decode_request
+from src.room_store.common import MAX_QUEUED_CHANGES
 from src.util.async_util import end_task
 
 # Heroku will close an inactive connection after 300 seconds
 # https://devcenter.heroku.com/articles/heroku-redis#timeout
 KEEPALIVE_INTERVAL_SECS = 60
+INVALIDATION_CHANNEL = 'room-invalidations'
+
 
+class ListenerFellBehindError(Exception):
+    """
+    A listener stopped taking changes to a room for so long that its queue filled
+    up, so the changes after that were lost
+    """
 
-def _channel_key(room_id: str) -> str:
+
+def channel_key(room_id: str) -> str:
     return f'channel:{room_id}'
 
 
-@dataclass
-class _PubSubMessage:
-    type: Literal['message']
-    channel: bytes
-    data: bytes
+def decode_logged_request(data: bytes) -> Request:
+    """
+    Decode a request the way it's logged and published, as the version of the room
+    followed by a space and the request JSON
+
+    :raises DecodeError: If the version or the request is invalid
+    :raises JSONDecodeError: If the request is not valid JSON
+    """
+    version: int | None = None
+    # Servers that don't version rooms yet publish just the request JSON
+    if not data.startswith(b'{'):
+        raw_version, _, data = data.partition(b' ')
+        try:
+            version = int(raw_version)
+        except ValueError as e:
+            raise DecodeError(f'invalid room version: {raw_version!r}') from e
+
+    request = decode_request(json.loads(data))
+    request.version = version
+    return request
+
+
+def put_or_fall_behind(
+    queue: asyncio.Queue[Request | BaseException], update: Request | BaseException
+) -> None:
+    """
+    Queue the update without waiting for space, since waiting would hold up the
+    changes to every other room. A listener that's fallen too far behind is sent
+    an error instead, ending its changes
+    """
+    if queue.full():
+        while not queue.empty():
+            queue.get_nowait()
+        if not isinstance(update, BaseException):
+            update = ListenerFellBehindError()
+    queue.put_nowait(update)
+
+
+class RoomListener(Protocol):
+    """Passes on the changes to rooms in redis, however they're announced"""
+
+    async def changes(self, room_id: str) -> AsyncIterator[Request]: ...
+
+    async def invalidations(self) -> AsyncIterator[str]: ...
+
+    async def publish_invalidation(
+        self, room_id: str, pipeline: Redis | None = None
+    ) -> None: ...
 
 
 class RedisRoomListener:
@@ -40,6 +90,7 @@ class RedisRoomListener:
         self._queues_by_room_id: defaultdict[
             str, list[asyncio.Queue[Request | BaseException]]
         ] = defaultdict(list)
+        self._invalidation_queues: list[asyncio.Queue[str | BaseException]] = []
 
     async def reset(self) -> None:
         self._listening_started.cancel('Resetting RedisRoomStore')
@@ -52,11 +103,11 @@ class RedisRoomListener:
             self._keepalive_task.cancel('Resetting RedisRoomStore')
             await end_task(self._keepalive_task)
 
-    async def publish(
-        self, room_id: str, request: Request, pipeline: Redis | None = None
+    async def publish_invalidation(
+        self, room_id: str, pipeline: Redis | None = None
     ) -> None:
         con = pipeline or self._redis
-        await con.publish(_channel_key(room_id), json.dumps(asdict(request)))
+        await con.publish(INVALIDATION_CHANNEL, room_id)
 
     async def _keep_connection_alive(self) -> NoReturn:
         while True:
@@ -78,8 +129,9 @@ class RedisRoomListener:
 
         for queues in self._queues_by_room_id.values():
             for q in queues:
-                # put_nowait will not throw here because we use unbounded queues
-                q.put_nowait(exc)
+                put_or_fall_behind(q, exc)
+        for inv_q in self._invalidation_queues:
+            inv_q.put_nowait(exc)
 
     def _listening_for_changes(self) -> bool:
         return bool(self._pubsub_task and self._keepalive_task)
@@ -106,26 +158,39 @@ class RedisRoomListener:
             if raw_event is None or raw_event['type'] != 'message':
                 continue
 
-            event = from_dict(_PubSubMessage, raw_event)
-            room_id = event.channel.decode().removeprefix('channel:')
+            channel = raw_event['channel'].decode()
+            data: bytes = raw_event['data']
+            if channel == INVALIDATION_CHANNEL:
+                for inv_q in self._invalidation_queues:
+                    inv_q.put_nowait(data.decode())
+                continue
+
+            room_id = channel.removeprefix('channel:')
             if room_id not in self._queues_by_room_id:
                 # No one's listening anymore, just skip this one
                 continue
 
             update: Request | BaseException
             try:
-                update = from_dict(Request, json.loads(event.data.decode()))
-            except (DaciteError, JSONDecodeError) as e:
+                update = decode_logged_request(data)
+            except (DecodeError, JSONDecodeError) as e:
                 update = e
             for q in self._queues_by_room_id[room_id]:
-                await q.put(update)
+                put_or_fall_behind(q, update)
 
     async def changes(self, room_id: str) -> AsyncIterator[Request]:
-        queue: asyncio.Queue[Request | BaseException] = asyncio.Queue()
+        """
+        :return: Each change to the room
+        :raises ListenerFellBehindError: When iterating, if more than
+        MAX_QUEUED_CHANGES changes are waiting to be taken
+        """
+        queue: asyncio.Queue[Request | BaseException] = asyncio.Queue(
+            MAX_QUEUED_CHANGES
+        )
         self._queues_by_room_id[room_id].append(queue)
         # If we're the first listener for this room, subscribe to updates from redis
         if len(self._queues_by_room_id[room_id]) == 1:
-            await self._pubsub.subscribe(_channel_key(room_id))
+            await self._pubsub.subscribe(channel_key(room_id))
 
         if not self._listening_for_changes():
             self._listen_for_changes()
@@ -134,6 +199,35 @@ class RedisRoomListener:
 
         return self._room_changes(room_id, queue)
 
+    async def invalidations(self) -> AsyncIterator[str]:
+        queue: asyncio.Queue[str | BaseException] = asyncio.Queue()
+        self._invalidation_queues.append(queue)
+        # If we're the first listener, subscribe to invalidations from redis
+        if len(self._invalidation_queues) == 1:
+            await self._pubsub.subscribe(INVALIDATION_CHANNEL)
+
+        if not self._listening_for_changes():
+            self._listen_for_changes()
+
+        await self._listening_started
+
+        return self._room_invalidations(queue)
+
+    async def _room_invalidations(
+        self, queue: asyncio.Queue[str | BaseException]
+    ) -> AsyncIterator[str]:
+        try:
+            while True:
+                item = await queue.get()
+                if isinstance(item, str):
+                    yield item
+                else:
+                    raise item
+        finally:
+            self._invalidation_queues.remove(queue)
+            if not self._invalidation_queues:
+                await self._pubsub.unsubscribe(INVALIDATION_CHANNEL)
+
     async def _room_changes(
         self, room_id: str, queue: asyncio.Queue[Request | BaseException]
     ) -> AsyncIterator[Request]:
@@ -148,7 +242,7 @@ class RedisRoomListener:
             self._queues_by_room_id[room_id].remove(queue)
             if not self._queues_by_room_id[room_id]:
                 del self._queues_by_room_id[room_id]
-                await self._pubsub.unsubscribe(_channel_key(room_id))
+                await self._pubsub.unsubscribe(channel_key(room_id))
 
 
 @contextlib.asynccontextmanager
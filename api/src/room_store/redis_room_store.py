@@ -6,59 +6,224 @@ import logging
 import time
 from collections.abc import AsyncGenerator, AsyncIterator, Iterable
 from contextlib import asynccontextmanager
-from dataclasses import asdict, dataclass, field
+from dataclasses import dataclass, field
 from typing import (
     Any,
 )
 
-from redis.asyncio.client import Redis
+from redis.asyncio.client import Pipeline, Redis
 from redis.commands.core import AsyncScript
 from redis.exceptions import ResponseError
 from src.api.api_structures import Action, Request
+from src.api.codec import encode_action, encode_request_for_room
 from src.apm import instrument
-from src.room_store.common import ARCHIVE_WHEN_IDLE_SECONDS, NoSuchRoomError
+from src.room_store.common import (
+    ARCHIVE_WHEN_IDLE_SECONDS,
+    EAGER_COMPACTION_COOLDOWN_SECONDS,
+    EAGER_COMPACTION_LENGTH,
+    ROOM_LOG_LENGTH,
+    NoSuchRoomError,
+    first_room_version,
+)
 from src.room_store.json_to_actions import json_to_actions
 from src.room_store.redis_room_listener import (
-    RedisRoomListener,
+    RoomListener,
+    channel_key,
     create_redis_room_listener,
+    decode_logged_request,
 )
 from src.room_store.room_store import (
     COMPACTION_LOCK_EXPIRATION_SECONDS,
+    HYDRATION_LOCK_EXPIRATION_SECONDS,
+    RawReplacementData,
     ReplacementData,
     UnexpectedReplacementId,
     UnexpectedReplacementToken,
+    VersionedRoom,
 )
+from src.room_store.write_coalescer import QueueCommands, WriteCoalescer
 
 logger = logging.getLogger(__name__)
 
 NO_REQUEST_ID = 'NO_REQUEST_ID'
 REPLACEMENT_KEY = 'replacement_lock'
+# Sorted set of room ids, scored by the last time each room was read or written to
+ROOM_ACTIVITY_KEY = 'room-activity'
+# Forget activity that's older than this, the same way individual activity keys
+# used to expire
+ROOM_ACTIVITY_RETENTION_SECONDS = ARCHIVE_WHEN_IDLE_SECONDS * 2
+# Set of room ids written to since the compactor last drained it
+DIRTY_ROOMS_KEY = 'dirty-rooms'
+# Set of room ids that grew long enough to be compacted right away
+OVERSIZED_ROOMS_KEY = 'oversized-rooms'
 ERR_INVALID_COMPACTION_KEY = 'INVALID_COMPACTION_KEY'
 ERR_INVALID_ROOM_LENGTH = 'INVALID_ROOM_LENGTH'
 
 
+# Give the room a new version, then log and publish the request with it. Requests
+# are logged and published as "<version> <request json>", and only the latest
+# log_length of them are kept
+# language=lua
+LOG_REQUEST_FUNCTION = """
+local function log_request(
+    version_key, log_key, channel_key, message, first_version, log_length
+)
+    redis.call("set", version_key, first_version, "nx")
+    local logged_request = redis.call("incr", version_key) .. " " .. message
+    redis.call("rpush", log_key, logged_request)
+    redis.call("ltrim", log_key, -log_length, -1)
+    redis.call("publish", channel_key, logged_request)
+end
+"""
+
+# Queue the room to be compacted right away once it's stored as compact_length
+# updates, at most once every cooldown seconds. A compact_length of 0 never queues
+# it
 # language=lua
-_APPEND_TO_ROOM = """
+QUEUE_IF_OVERSIZED_FUNCTION = """
+local function queue_if_oversized(
+    room_id, length, compact_length, oversized_rooms_key, cooldown_key, cooldown
+)
+    if compact_length > 0
+        and length >= compact_length
+        and redis.call("set", cooldown_key, 1, "nx", "ex", cooldown)
+    then
+        redis.call("sadd", oversized_rooms_key, room_id)
+    end
+end
+"""
+
+# language=lua
+_APPEND_TO_ROOM = f"""
+{LOG_REQUEST_FUNCTION}
+{QUEUE_IF_OVERSIZED_FUNCTION}
 local room_key = KEYS[1]
 local channel_key = KEYS[2]
+local activity_key = KEYS[3]
+local dirty_rooms_key = KEYS[4]
+local version_key = KEYS[5]
+local log_key = KEYS[6]
+local oversized_rooms_key = KEYS[7]
+local cooldown_key = KEYS[8]
 local room_update = ARGV[1]
-local publish_value = ARGV[2]
+local message = ARGV[2]
+local room_id = ARGV[3]
+local now = ARGV[4]
+local first_version = ARGV[5]
+local log_length = tonumber(ARGV[6])
+local compact_length = tonumber(ARGV[7])
+local cooldown = ARGV[8]
+
+local room_length = redis.call("rpush", room_key, room_update)
+log_request(version_key, log_key, channel_key, message, first_version, log_length)
+redis.call("zadd", activity_key, now, room_id)
+redis.call("sadd", dirty_rooms_key, room_id)
+queue_if_oversized(
+    room_id, room_length, compact_length, oversized_rooms_key, cooldown_key, cooldown
+)
+return room_length
+"""
+
+# Returns the version of the room followed by the logged requests since the given
+# version, or nothing if the room has no version. If some of those requests have
+# been trimmed from the log, only the rest are returned
+# language=lua
+READ_REQUESTS_SINCE = """
+local version_key = KEYS[1]
+local log_key = KEYS[2]
+local since = tonumber(ARGV[1])
+
+local version = redis.call("get", version_key)
+if not version then
+    return {}
+end
+
+local missed = tonumber(version) - since
+if missed <= 0 then
+    return {version}
+end
+
+local requests = redis.call("lrange", log_key, -missed, -1)
+table.insert(requests, 1, version)
+return requests
+"""
+
+# Returns the version of the room, the length of its list and the actions of its
+# snapshot, followed by the updates after the snapshot. Every update gives the room
+# a new version, so the updates after a snapshot are the last (version - snapshot
+# version) of the list. Without a snapshot that covers the start of the list, the
+# snapshot is nil and every update is returned
+# language=lua
+READ_ROOM = """
+local room_key = KEYS[1]
+local version_key = KEYS[2]
+local snapshot_key = KEYS[3]
+
+local version = redis.call("get", version_key)
+local length = redis.call("llen", room_key)
+local snapshot = redis.call("hmget", snapshot_key, "version", "actions")
+local snapshot_version = tonumber(snapshot[1])
+
+local result = {version or false, length, false}
+local first = 0
+if version and snapshot_version then
+    local tail_length = tonumber(version) - snapshot_version
+    -- A snapshot from before the list was last compacted covers less than the
+    -- compacted update at the start of the list, so it can't be used
+    if tail_length >= 0 and tail_length < length then
+        result[3] = snapshot[2]
+        first = length - tail_length
+    end
+end
+
+if first < length then
+    for _, update in ipairs(redis.call("lrange", room_key, first, -1)) do
+        table.insert(result, update)
+    end
+end
+return result
+"""
+
+# Only replaces an older snapshot, since snapshots can be written by every server
+# the room is cached on
+# language=lua
+WRITE_SNAPSHOT = """
+local snapshot_key = KEYS[1]
+local room_key = KEYS[2]
+local version = tonumber(ARGV[1])
+local actions = ARGV[2]
 
-redis.call("rpush", room_key, room_update)
-redis.call("publish", channel_key, publish_value)
+if redis.call("exists", room_key) == 0 then
+    return
+end
+
+local snapshot_version = tonumber(redis.call("hget", snapshot_key, "version"))
+if not snapshot_version or snapshot_version < version then
+    redis.call("hset", snapshot_key, "version", version, "actions", actions)
+end
 """
 
+# Replaces the start of the list with the compacted update, dropping the snapshot
+# if it's older than what was compacted
 # language=lua
 _LREPLACE = f"""
 local room_key = KEYS[1]
 local compaction_key = KEYS[2]
+local snapshot_key = KEYS[3]
 local replace_item = ARGV[1]
 local replace_until = ARGV[2]
 local compactor_id = ARGV[3]
+local compacted_version = tonumber(ARGV[4])
 
 if redis.call("get", compaction_key) == compactor_id then
     redis.call("ltrim", room_key, replace_until, -1)
     redis.call("lpush", room_key, replace_item)
+    local snapshot_version = tonumber(redis.call("hget", snapshot_key, "version"))
+    if snapshot_version and (
+        not compacted_version or snapshot_version < compacted_version
+    ) then
+        redis.call("del", snapshot_key)
+    end
 else
     return redis.error_reply("{ERR_INVALID_COMPACTION_KEY}")
 end
@@ -68,6 +233,9 @@ end
 _DELETE_ROOM = f"""
 local room_key = KEYS[1]
 local compaction_key = KEYS[2]
+local version_key = KEYS[3]
+local log_key = KEYS[4]
+local snapshot_key = KEYS[5]
 local compactor_id = ARGV[1]
 local expected_length = tonumber(ARGV[2])
 
@@ -79,16 +247,29 @@ if redis.call("llen", room_key) ~= expected_length then
     return redis.error_reply("{ERR_INVALID_ROOM_LENGTH}")
 end
 
-redis.call("del", room_key)
+redis.call("del", room_key, version_key, log_key, snapshot_key)
 """
 
 # language=lua
 _WRITE_IF_MISSING = """
 local room_key = KEYS[1]
+local version_key = KEYS[2]
 local room_data = ARGV[1]
+local first_version = ARGV[2]
 
 if redis.call("exists", room_key) == 0 then
     redis.call("rpush", room_key, room_data)
+    redis.call("set", version_key, first_version, "nx")
+end
+"""
+
+# language=lua
+_RELEASE_HYDRATION_LOCK = """
+local lock_key = KEYS[1]
+local loader_id = ARGV[1]
+
+if redis.call("get", lock_key) == loader_id then
+    redis.call("del", lock_key)
 end
 """
 
@@ -97,8 +278,67 @@ def _room_key(room_id: str) -> str:
     return f'room:{room_id}'
 
 
-def _last_activity_key(room_id: str) -> str:
-    return f'last-room-activity:{room_id}'
+def version_key(room_id: str) -> str:
+    return f'room-version:{room_id}'
+
+
+def log_key(room_id: str) -> str:
+    return f'room-log:{room_id}'
+
+
+def snapshot_key(room_id: str) -> str:
+    return f'room-snapshot:{room_id}'
+
+
+def _hydration_lock_key(room_id: str) -> str:
+    return f'hydration-lock:{room_id}'
+
+
+def eager_compaction_cooldown_key(room_id: str) -> str:
+    return f'eager-compaction-cooldown:{room_id}'
+
+
+@dataclass
+class _ListReplaceToken:
+    # How many updates were read from the start of the list
+    length: int
+    # The version of the room they add up to, if it has one
+    version: int | None
+
+
+@dataclass
+class _RoomRead:
+    version: int | None
+    length: int
+    # The snapshot first, if there is one, followed by the updates after it, as
+    # decoded by json_to_actions
+    updates: list[bytes]
+
+
+def _decode_room(result: list[Any]) -> _RoomRead:
+    """Decode the result of READ_ROOM"""
+    raw_version, length, snapshot, *updates = result
+    return _RoomRead(
+        None if raw_version is None else int(raw_version),
+        length,
+        updates if snapshot is None else [snapshot, *updates],
+    )
+
+
+def _decode_requests_since(result: list[bytes], since: int) -> list[Request] | None:
+    """
+    Decode the result of READ_REQUESTS_SINCE
+
+    :return: The requests since the version, or None if the room never had that
+    version or some of the requests since are no longer logged
+    """
+    if not result:
+        return None
+    raw_version, *logged_requests = result
+    missed = int(raw_version) - since
+    if missed < 0 or len(logged_requests) != missed:
+        return None
+    return [decode_logged_request(logged) for logged in logged_requests]
 
 
 @dataclass
@@ -112,17 +352,58 @@ class RedisRoomStore:
     def __init__(
         self,
         redis: Redis,
-        room_listener: RedisRoomListener,
+        room_listener: RoomListener,
+        append_to_room: AsyncScript,
         lreplace: AsyncScript,
         delete_room: AsyncScript,
         write_if_missing: AsyncScript,
+        read_requests_since: AsyncScript,
+        read_room: AsyncScript,
+        write_snapshot: AsyncScript,
+        write_coalescer: WriteCoalescer | None = None,
+        eager_compaction_length: int = EAGER_COMPACTION_LENGTH,
     ):
+        """
+        :param write_coalescer: Batches requests added by every connection into
+        shared pipelines. If not provided, each request is written on its own
+        :param eager_compaction_length: How many updates a room can be stored as
+        before it's queued to be compacted right away. 0 never queues rooms
+        """
         self._redis = redis
         self._room_listener = room_listener
+        self._append_to_room = append_to_room
         self._lreplace = lreplace
         self._delete_room = delete_room
         self._write_if_missing = write_if_missing
+        self._read_requests_since = read_requests_since
+        self._read_room = read_room
+        self._write_snapshot = write_snapshot
+        # Shared by every kind of room store, since they all lock the same way
+        self._release_hydration_lock = redis.register_script(_RELEASE_HYDRATION_LOCK)
+        self._write_coalescer = write_coalescer
+        self._eager_compaction_length = eager_compaction_length
         self.changes = self._room_listener.changes
+        self.invalidations = self._room_listener.invalidations
+
+    def _existence_key(self, room_id: str) -> str:
+        """The key that exists in redis for as long as the room does"""
+        return _room_key(room_id)
+
+    async def _record_activity(self, con: Redis, room_id: str) -> None:
+        await con.zadd(ROOM_ACTIVITY_KEY, {room_id: int(time.time())})
+
+    async def _mark_dirty(self, con: Redis, room_id: str) -> None:
+        await con.sadd(DIRTY_ROOMS_KEY, room_id)
+
+    async def _forget_activity(self, con: Redis, room_id: str) -> None:
+        await con.zrem(ROOM_ACTIVITY_KEY, room_id)
+
+    async def _record_missing_activity(self, room_id: str) -> None:
+        """
+        Give a room that has no recorded activity an activity time of now, so it
+        can be moved to the archive later
+        """
+        await self._redis.zadd(ROOM_ACTIVITY_KEY, {room_id: int(time.time())}, nx=True)
 
     async def get_all_room_ids(self) -> AsyncGenerator[str, None]:
         async for room_key in self._redis.scan_iter('room:*'):
@@ -134,50 +415,105 @@ class RedisRoomStore:
 
     @instrument
     async def read(self, room_id: str) -> Iterable[Action]:
+        return (await self.read_with_version(room_id)).actions
+
+    async def _queue_read_room(self, pipeline: Pipeline, room_id: str) -> None:
+        await self._read_room(
+            client=pipeline,
+            keys=[_room_key(room_id), version_key(room_id), snapshot_key(room_id)],
+        )
+
+    @instrument
+    async def read_with_version(self, room_id: str) -> VersionedRoom:
         async with self._redis.pipeline() as pipeline:
-            await pipeline.lrange(_room_key(room_id), 0, -1)
-            await pipeline.set(
-                _last_activity_key(room_id),
-                str(int(time.time())),
-                ex=ARCHIVE_WHEN_IDLE_SECONDS * 2,
-            )
-            data, _ = await pipeline.execute()
-            return json_to_actions(data)
+            await self._queue_read_room(pipeline, room_id)
+            await self._record_activity(pipeline, room_id)
+            result, _ = await pipeline.execute()
+        room = _decode_room(result)
+        return VersionedRoom(json_to_actions(room.updates), room.version)
 
     @instrument
-    async def add_request(self, room_id: str, request: Request) -> None:
+    async def write_snapshot(
+        self, room_id: str, actions: Iterable[Action], version: int
+    ) -> None:
+        await self._write_snapshot(
+            keys=[snapshot_key(room_id), _room_key(room_id)],
+            args=[version, json.dumps(list(map(encode_action, actions)))],
+        )
+
+    @instrument
+    async def read_requests_since(
+        self, room_id: str, version: int
+    ) -> list[Request] | None:
         async with self._redis.pipeline() as pipeline:
-            await pipeline.rpush(
-                _room_key(room_id),
-                json.dumps(
-                    [
-                        asdict(action)
-                        for action in request.actions
-                        if action.action != 'ping'
-                    ]
-                ),
+            await self._read_requests_since(
+                client=pipeline,
+                keys=[version_key(room_id), log_key(room_id)],
+                args=[version],
             )
-            await self._room_listener.publish(room_id, request, pipeline)
-            await pipeline.set(
-                _last_activity_key(room_id),
-                str(int(time.time())),
-                ex=ARCHIVE_WHEN_IDLE_SECONDS * 2,
+            await self._record_activity(pipeline, room_id)
+            result, _ = await pipeline.execute()
+        return _decode_requests_since(result, version)
+
+    @instrument
+    async def add_request(self, room_id: str, request: Request) -> None:
+        queue_commands = self._add_request_commands(room_id, request)
+        if self._write_coalescer is None:
+            async with self._redis.pipeline() as pipeline:
+                await queue_commands(pipeline)
+                await pipeline.execute()
+        else:
+            await self._write_coalescer.write(queue_commands)
+
+    def _add_request_commands(self, room_id: str, request: Request) -> QueueCommands:
+        """
+        Encode the request, returning a function that adds the commands to store
+        and publish it to a pipeline
+        """
+        encoded = encode_request_for_room(request)
+        now = int(time.time())
+        first_version = first_room_version()
+
+        async def queue_commands(pipeline: Pipeline) -> None:
+            await self._append_to_room(
+                client=pipeline,
+                keys=[
+                    _room_key(room_id),
+                    channel_key(room_id),
+                    ROOM_ACTIVITY_KEY,
+                    DIRTY_ROOMS_KEY,
+                    version_key(room_id),
+                    log_key(room_id),
+                    OVERSIZED_ROOMS_KEY,
+                    eager_compaction_cooldown_key(room_id),
+                ],
+                args=[
+                    encoded.room_update,
+                    encoded.message,
+                    room_id,
+                    now,
+                    first_version,
+                    ROOM_LOG_LENGTH,
+                    self._eager_compaction_length,
+                    EAGER_COMPACTION_COOLDOWN_SECONDS,
+                ],
             )
-            await pipeline.execute()
+
+        return queue_commands
 
     @instrument
     async def write_if_missing(self, room_id: str, actions: Iterable[Action]) -> None:
         async with self._redis.pipeline() as pipeline:
             await self._write_if_missing(
                 client=pipeline,
-                keys=[_room_key(room_id)],
-                args=[json.dumps(list(map(asdict, actions)))],
-            )
-            await pipeline.set(
-                _last_activity_key(room_id),
-                str(int(time.time())),
-                ex=ARCHIVE_WHEN_IDLE_SECONDS * 2,
+                keys=[_room_key(room_id), version_key(room_id)],
+                args=[
+                    json.dumps(list(map(encode_action, actions))),
+                    first_room_version(),
+                ],
             )
+            await self._record_activity(pipeline, room_id)
+            await self._mark_dirty(pipeline, room_id)
             await pipeline.execute()
 
     @instrument
@@ -194,24 +530,74 @@ class RedisRoomStore:
         )
 
     @instrument
-    async def read_for_replacement(self, room_id: str) -> ReplacementData:
-        updates = await self._redis.lrange(_room_key(room_id), 0, -1)
-        actions = [action for action in json_to_actions(updates)]
-        return ReplacementData(actions, len(updates))
+    async def acquire_hydration_lock(self, room_id: str, loader_id: str) -> bool:
+        return bool(
+            await self._redis.set(
+                _hydration_lock_key(room_id),
+                loader_id,
+                ex=HYDRATION_LOCK_EXPIRATION_SECONDS,
+                nx=True,
+            )
+        )
 
     @instrument
+    async def release_hydration_lock(self, room_id: str, loader_id: str) -> None:
+        await self._release_hydration_lock(
+            keys=[_hydration_lock_key(room_id)], args=[loader_id]
+        )
+
+    @instrument
+    async def read_for_replacement(
+        self, room_id: str, read_only: bool = False
+    ) -> ReplacementData:
+        raw_data = await self.read_raw_for_replacement(room_id, read_only)
+        actions = [action for action in json_to_actions(raw_data.updates)]
+        return ReplacementData(actions, raw_data.replace_token)
+
+    @instrument
+    async def read_raw_for_replacement(
+        self, room_id: str, read_only: bool = False
+    ) -> RawReplacementData:
+        async with self._redis.pipeline() as pipeline:
+            await self._queue_read_room(pipeline, room_id)
+            await pipeline.zscore(ROOM_ACTIVITY_KEY, room_id)
+            result, last_activity = await pipeline.execute()
+
+        room = _decode_room(result)
+        if room.updates and last_activity is None and not read_only:
+            await self._record_missing_activity(room_id)
+
+        # The whole list is replaced, even if only the updates after the snapshot
+        # were read
+        return RawReplacementData(
+            room.updates, _ListReplaceToken(room.length, room.version)
+        )
+
     async def replace(
         self, room_id: str, actions: list[Action], replace_token: Any, replacer_id: str
+    ) -> None:
+        await self.replace_raw(
+            room_id,
+            json.dumps(list(map(encode_action, actions))).encode(),
+            replace_token,
+            replacer_id,
+        )
+
+    @instrument
+    async def replace_raw(
+        self, room_id: str, update: bytes, replace_token: Any, replacer_id: str
     ) -> None:
         try:
             await self._lreplace(
-                keys=[_room_key(room_id), REPLACEMENT_KEY],
+                keys=[_room_key(room_id), REPLACEMENT_KEY, snapshot_key(room_id)],
                 args=[
-                    json.dumps(list(map(asdict, actions))),
-                    replace_token,
+                    update,
+                    replace_token.length,
                     replacer_id,
+                    '' if replace_token.version is None else replace_token.version,
                 ],
             )
+            await self._room_listener.publish_invalidation(room_id)
         except ResponseError as e:
             # The error message is only exposed as the first element in the args
             # tuple :(
@@ -227,10 +613,17 @@ class RedisRoomStore:
         try:
             async with self._redis.pipeline() as pipeline:
                 await self._delete_room(
-                    keys=[_room_key(room_id), REPLACEMENT_KEY],
-                    args=[replacer_id, replace_token],
+                    keys=[
+                        _room_key(room_id),
+                        REPLACEMENT_KEY,
+                        version_key(room_id),
+                        log_key(room_id),
+                        snapshot_key(room_id),
+                    ],
+                    args=[replacer_id, replace_token.length],
                 )
-                await pipeline.delete(_last_activity_key(room_id))
+                await self._forget_activity(pipeline, room_id)
+                await self._room_listener.publish_invalidation(room_id, pipeline)
                 await pipeline.execute()
         except ResponseError as e:
             # The error message is only exposed as the first element in the args
@@ -245,50 +638,119 @@ class RedisRoomStore:
                 raise
 
     @instrument
-    async def get_room_idle_seconds(self, room_id: str) -> int:
+    async def get_room_idle_seconds(self, room_id: str, read_only: bool = False) -> int:
         async with self._redis.pipeline() as pipeline:
-            await pipeline.exists(_room_key(room_id))
-            await pipeline.get(_last_activity_key(room_id))
-            room_exists, last_edited = await pipeline.execute()
+            await pipeline.exists(self._existence_key(room_id))
+            await pipeline.zscore(ROOM_ACTIVITY_KEY, room_id)
+            room_exists, last_activity = await pipeline.execute()
             if not room_exists:
                 raise NoSuchRoomError
 
-        # If a room does not have a last edited time, add one here so the room
+        # If a room does not have a last activity time, add one here so the room
         # can be moved to the archive later
-        if last_edited is None:
-            await self._redis.set(
-                _last_activity_key(room_id),
-                str(int(time.time())),
-                ex=ARCHIVE_WHEN_IDLE_SECONDS * 2,
-            )
+        if last_activity is None:
+            if not read_only:
+                await self._record_missing_activity(room_id)
             return 0
         else:
-            return int(time.time()) - int(last_edited)
+            return int(time.time()) - int(last_activity)
+
+    async def get_idle_room_ids(
+        self, idle_seconds: int, read_only: bool = False
+    ) -> AsyncIterator[str]:
+        now = int(time.time())
+        async with self._redis.pipeline() as pipeline:
+            if not read_only:
+                await pipeline.zremrangebyscore(
+                    ROOM_ACTIVITY_KEY,
+                    '-inf',
+                    f'({now - ROOM_ACTIVITY_RETENTION_SECONDS}',
+                )
+            await pipeline.zrangebyscore(ROOM_ACTIVITY_KEY, '-inf', now - idle_seconds)
+            *_, room_ids = await pipeline.execute()
+        for room_id in room_ids:
+            yield room_id.decode()
+
+    @instrument
+    async def drain_dirty_room_ids(self) -> set[str]:
+        # The pipeline runs as a transaction, so rooms marked dirty between reading
+        # and deleting the set can't be lost
+        async with self._redis.pipeline() as pipeline:
+            await pipeline.smembers(DIRTY_ROOMS_KEY)
+            await pipeline.delete(DIRTY_ROOMS_KEY)
+            room_ids, _ = await pipeline.execute()
+        return {room_id.decode() for room_id in room_ids}
+
+    @instrument
+    async def drain_oversized_room_ids(self) -> set[str]:
+        async with self._redis.pipeline() as pipeline:
+            await pipeline.smembers(OVERSIZED_ROOMS_KEY)
+            await pipeline.delete(OVERSIZED_ROOMS_KEY)
+            room_ids, _ = await pipeline.execute()
+        return {room_id.decode() for room_id in room_ids}
+
+    @instrument
+    async def add_dirty_room_ids(self, room_ids: Iterable[str]) -> None:
+        room_ids = list(room_ids)
+        if room_ids:
+            await self._redis.sadd(DIRTY_ROOMS_KEY, *room_ids)
 
     @instrument
     async def seconds_since_last_activity(self) -> int | None:
-        most_recent_activity = 0
-        async for entry in self._redis.scan_iter(match='last-room-activity:*'):
-            value = await self._redis.get(entry)
-            if value is None:
-                continue
-            last_activity_time = int(value)
-            if last_activity_time > most_recent_activity:
-                most_recent_activity = last_activity_time
-        if most_recent_activity == 0:
+        most_recent = await self._redis.zrevrange(
+            ROOM_ACTIVITY_KEY, 0, 0, withscores=True
+        )
+        if not most_recent:
             return None
-        return int(time.time() - most_recent_activity)
+        ((_, last_activity_time),) = most_recent
+        return int(time.time() - last_activity_time)
+
+    async def close(self) -> None:
+        if self._write_coalescer:
+            await self._write_coalescer.close()
 
 
 @asynccontextmanager
-async def create_redis_room_store(redis: Redis) -> AsyncIterator[RedisRoomStore]:
+async def create_redis_room_store(
+    redis: Redis,
+    write_batch_window_seconds: float | None = None,
+    eager_compaction_length: int = EAGER_COMPACTION_LENGTH,
+) -> AsyncIterator[RedisRoomStore]:
+    """
+    :param write_batch_window_seconds: How long to gather requests from every
+    connection before writing them together, or None to write each on its own
+    :param eager_compaction_length: How many updates a room can be stored as
+    before it's queued to be compacted right away. 0 never queues rooms
+    """
+    write_coalescer = (
+        None
+        if write_batch_window_seconds is None
+        else WriteCoalescer(redis, write_batch_window_seconds)
+    )
+    append_to_room = redis.register_script(_APPEND_TO_ROOM)
     lreplace = redis.register_script(_LREPLACE)
     delete_room = redis.register_script(_DELETE_ROOM)
     write_if_missing = redis.register_script(_WRITE_IF_MISSING)
+    read_requests_since = redis.register_script(READ_REQUESTS_SINCE)
+    read_room = redis.register_script(READ_ROOM)
+    write_snapshot = redis.register_script(WRITE_SNAPSHOT)
 
     async with create_redis_room_listener(redis) as listener:
-        store = RedisRoomStore(redis, listener, lreplace, delete_room, write_if_missing)
+        store = RedisRoomStore(
+            redis,
+            listener,
+            append_to_room,
+            lreplace,
+            delete_room,
+            write_if_missing,
+            read_requests_since,
+            read_room,
+            write_snapshot,
+            write_coalescer,
+            eager_compaction_length,
+        )
         try:
             yield store
         finally:
+            await store.close()
             await listener.reset()
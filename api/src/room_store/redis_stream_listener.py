@@ -0,0 +1,287 @@
+import asyncio
+import contextlib
+import json
+import logging
+from asyncio import CancelledError, Task
+from collections import defaultdict
+from collections.abc import AsyncIterator
+from json import JSONDecodeError
+from typing import NoReturn
+from uuid import uuid4
+
+from redis.asyncio.client import Redis
+from redis.exceptions import RedisError
+
+from src.api.api_structures import Request
+from src.api.codec import DecodeError, decode_request
+from src.room_store.common import MAX_QUEUED_CHANGES
+from src.room_store.redis_room_listener import put_or_fall_behind
+from src.room_store.redis_room_store import version_key
+from src.util.async_util import end_task
+
+logger = logging.getLogger(__name__)
+
+# How long each read waits for changes before starting again. Heroku will close a
+# connection that's inactive for 300 seconds
+# https://devcenter.heroku.com/articles/heroku-redis#timeout
+BLOCK_MILLISECONDS = 30_000
+# How long to wait before reading again after reading fails, e.g. because the
+# connection to redis was lost or redis is failing over
+RECONNECT_DELAY_SECONDS = 1
+INVALIDATION_STREAM_KEY = 'room-invalidation-stream'
+# Roughly how many invalidations are kept for listeners that reconnect
+INVALIDATION_STREAM_LENGTH = 1024
+# Entries are added to a room's stream with the version of the room as the id, and
+# the request JSON in this field
+REQUEST_FIELD = 'request'
+ROOM_ID_FIELD = 'room_id'
+# The stream id to read from for a stream that doesn't exist yet
+FIRST_STREAM_ID = '0-0'
+
+
+def room_stream_key(room_id: str) -> str:
+    return f'room-stream:{room_id}'
+
+
+def _wakeup_key(listener_id: str) -> str:
+    return f'stream-listener-wakeup:{listener_id}'
+
+
+def stream_id(version: int) -> str:
+    """The id of the stream entry for the request that gave a room the version"""
+    return f'{version}-0'
+
+
+def decode_stream_entry(entry_id: bytes, request: bytes) -> Request:
+    """
+    Decode a request added to a room's stream
+
+    :param entry_id: The id of the entry, which holds the version of the room
+    :param request: The request JSON
+    :raises DecodeError: If the id or the request is invalid
+    :raises JSONDecodeError: If the request is not valid JSON
+    """
+    raw_version, _, _ = entry_id.partition(b'-')
+    try:
+        version = int(raw_version)
+    except ValueError as e:
+        raise DecodeError(f'invalid stream entry id: {entry_id!r}') from e
+
+    decoded = decode_request(json.loads(request))
+    decoded.version = version
+    return decoded
+
+
+class RedisStreamListener:
+    """
+    Listens for changes to rooms with a single blocking XREAD across every room
+    someone's listening to. The listener remembers how far it's read each stream,
+    so if the connection to redis drops it carries on from where it was instead
+    of missing the changes made in the meantime
+    """
+
+    def __init__(self, redis: Redis):
+        self._redis = redis
+        # Readers are woken by adding to this stream, so they start reading the
+        # streams of rooms that were listened to while they were blocked
+        self._wakeup_key = _wakeup_key(str(uuid4()))
+        # Tracked like the other streams, so a wakeup added just before a read
+        # reaches redis still wakes it
+        self._last_wakeup_id: bytes | str = FIRST_STREAM_ID
+        self._read_task: Task | None = None
+        self._queues_by_room_id: defaultdict[
+            str, list[asyncio.Queue[Request | BaseException]]
+        ] = defaultdict(list)
+        self._last_ids_by_room_id: dict[str, bytes | str] = {}
+        self._invalidation_queues: list[asyncio.Queue[str | BaseException]] = []
+        self._last_invalidation_id: bytes | str = FIRST_STREAM_ID
+
+    async def reset(self) -> None:
+        if self._read_task:
+            # Cancelling a blocked read waits for it to finish, so end it early
+            await self._wake_up()
+            self._read_task.cancel('Resetting RedisStreamListener')
+            await end_task(self._read_task)
+        await self._redis.delete(self._wakeup_key)
+
+    async def publish_invalidation(
+        self, room_id: str, pipeline: Redis | None = None
+    ) -> None:
+        con = pipeline or self._redis
+        await con.xadd(
+            INVALIDATION_STREAM_KEY,
+            {ROOM_ID_FIELD: room_id},
+            maxlen=INVALIDATION_STREAM_LENGTH,
+            approximate=True,
+        )
+
+    async def _wake_up(self) -> None:
+        """Start reading again so the latest streams are read"""
+        async with self._redis.pipeline() as pipeline:
+            await pipeline.xadd(self._wakeup_key, {'wakeup': ''}, maxlen=1)
+            await pipeline.expire(self._wakeup_key, BLOCK_MILLISECONDS // 1000 * 2)
+            await pipeline.execute()
+
+    def _on_read_task_finished(self, task: Task) -> None:
+        try:
+            exc = task.exception()
+        except CancelledError as e:
+            exc = e
+
+        # Reading never finishes without being cancelled or throwing an exception
+        if exc is None:  # pragma: no cover
+            exc = ValueError(
+                f'{task.get_name()} finished without throwing an exception'
+            )
+
+        for queues in self._queues_by_room_id.values():
+            for q in queues:
+                put_or_fall_behind(q, exc)
+        for inv_q in self._invalidation_queues:
+            inv_q.put_nowait(exc)
+
+    def _check_not_reset(self) -> None:
+        if self._read_task is not None and self._read_task.done():
+            raise CancelledError('RedisStreamListener was reset')
+
+    async def _start_reading(self) -> None:
+        if self._read_task is None:
+            self._read_task = asyncio.create_task(
+                self._announce_changes(), name='RedisStreamListener read'
+            )
+            self._read_task.add_done_callback(self._on_read_task_finished)
+        else:
+            await self._wake_up()
+
+    def _streams(self) -> dict[str, bytes | str]:
+        streams: dict[str, bytes | str] = {self._wakeup_key: self._last_wakeup_id}
+        if self._invalidation_queues:
+            streams[INVALIDATION_STREAM_KEY] = self._last_invalidation_id
+        for room_id, last_id in self._last_ids_by_room_id.items():
+            streams[room_stream_key(room_id)] = last_id
+        return streams
+
+    async def _announce_changes(self) -> NoReturn:
+        while True:
+            try:
+                result = await self._redis.xread(
+                    self._streams(), count=MAX_QUEUED_CHANGES, block=BLOCK_MILLISECONDS
+                )
+            except RedisError:
+                # Every stream is read on from where it was, so nothing is missed
+                logger.warning(
+                    'Failed to read room streams, reading again', exc_info=True
+                )
+                await asyncio.sleep(RECONNECT_DELAY_SECONDS)
+                continue
+
+            for raw_key, entries in result:
+                key = raw_key.decode()
+                if key == INVALIDATION_STREAM_KEY:
+                    self._announce_invalidations(entries)
+                elif key == self._wakeup_key:
+                    self._last_wakeup_id = entries[-1][0]
+                else:
+                    self._announce_room_changes(
+                        key.removeprefix(room_stream_key('')), entries
+                    )
+
+    def _announce_invalidations(
+        self, entries: list[tuple[bytes, dict[bytes, bytes]]]
+    ) -> None:
+        for entry_id, fields in entries:
+            self._last_invalidation_id = entry_id
+            for inv_q in self._invalidation_queues:
+                inv_q.put_nowait(fields[ROOM_ID_FIELD.encode()].decode())
+
+    def _announce_room_changes(
+        self, room_id: str, entries: list[tuple[bytes, dict[bytes, bytes]]]
+    ) -> None:
+        if room_id not in self._last_ids_by_room_id:
+            # No one's listening anymore, just skip these
+            return
+
+        for entry_id, fields in entries:
+            self._last_ids_by_room_id[room_id] = entry_id
+            update: Request | BaseException
+            try:
+                update = decode_stream_entry(entry_id, fields[REQUEST_FIELD.encode()])
+            except (DecodeError, JSONDecodeError, KeyError) as e:
+                update = e
+            for q in self._queues_by_room_id[room_id]:
+                put_or_fall_behind(q, update)
+
+    async def changes(self, room_id: str) -> AsyncIterator[Request]:
+        """
+        :return: Each change to the room made after this returns
+        :raises ListenerFellBehindError: When iterating, if more than
+        MAX_QUEUED_CHANGES changes are waiting to be taken
+        """
+        self._check_not_reset()
+        queue: asyncio.Queue[Request | BaseException] = asyncio.Queue(
+            MAX_QUEUED_CHANGES
+        )
+        self._queues_by_room_id[room_id].append(queue)
+        # If we're the first listener for this room, start reading its stream from
+        # the current version. Changes made while this is starting have later
+        # versions, so they can't be missed
+        if len(self._queues_by_room_id[room_id]) == 1:
+            version = await self._redis.get(version_key(room_id))
+            self._last_ids_by_room_id[room_id] = (
+                FIRST_STREAM_ID if version is None else stream_id(int(version))
+            )
+            await self._start_reading()
+
+        return self._room_changes(room_id, queue)
+
+    async def invalidations(self) -> AsyncIterator[str]:
+        self._check_not_reset()
+        queue: asyncio.Queue[str | BaseException] = asyncio.Queue()
+        self._invalidation_queues.append(queue)
+        # If we're the first listener, start reading invalidations from the latest
+        if len(self._invalidation_queues) == 1:
+            latest = await self._redis.xrevrange(INVALIDATION_STREAM_KEY, count=1)
+            self._last_invalidation_id = latest[0][0] if latest else FIRST_STREAM_ID
+            await self._start_reading()
+
+        return self._room_invalidations(queue)
+
+    async def _room_invalidations(
+        self, queue: asyncio.Queue[str | BaseException]
+    ) -> AsyncIterator[str]:
+        try:
+            while True:
+                item = await queue.get()
+                if isinstance(item, str):
+                    yield item
+                else:
+                    raise item
+        finally:
+            self._invalidation_queues.remove(queue)
+
+    async def _room_changes(
+        self, room_id: str, queue: asyncio.Queue[Request | BaseException]
+    ) -> AsyncIterator[Request]:
+        try:
+            while True:
+                item = await queue.get()
+                if isinstance(item, Request):
+                    yield item
+                else:
+                    raise item
+        finally:
+            self._queues_by_room_id[room_id].remove(queue)
+            if not self._queues_by_room_id[room_id]:
+                del self._queues_by_room_id[room_id]
+                del self._last_ids_by_room_id[room_id]
+
+
+@contextlib.asynccontextmanager
+async def create_redis_stream_listener(
+    redis: Redis,
+) -> AsyncIterator[RedisStreamListener]:
+    listener = RedisStreamListener(redis)
+    try:
+        yield listener
+    finally:
+        await listener.reset()
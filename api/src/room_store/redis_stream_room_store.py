@@ -0,0 +1,487 @@
+from __future__ import annotations
+
+import json
+import logging
+import time
+from collections.abc import AsyncGenerator, AsyncIterator, Iterable
+from contextlib import asynccontextmanager
+from typing import Any
+
+from redis.asyncio.client import Pipeline, Redis
+from redis.commands.core import AsyncScript
+from redis.exceptions import ResponseError
+
+from src.api.api_structures import Action, Request
+from src.api.codec import encode_action, request_message
+from src.apm import instrument
+from src.room_store.common import (
+    EAGER_COMPACTION_COOLDOWN_SECONDS,
+    EAGER_COMPACTION_LENGTH,
+    ROOM_LOG_LENGTH,
+    first_room_version,
+)
+from src.room_store.json_to_actions import json_to_actions
+from src.room_store.redis_hash_room_store import ERR_INVALID_ROOM_VERSION
+from src.room_store.redis_room_store import (
+    DIRTY_ROOMS_KEY,
+    ERR_INVALID_COMPACTION_KEY,
+    OVERSIZED_ROOMS_KEY,
+    QUEUE_IF_OVERSIZED_FUNCTION,
+    READ_ROOM,
+    REPLACEMENT_KEY,
+    ROOM_ACTIVITY_KEY,
+    WRITE_SNAPSHOT,
+    RedisRoomStore,
+    eager_compaction_cooldown_key,
+    snapshot_key,
+    version_key,
+)
+from src.room_store.redis_stream_listener import (
+    REQUEST_FIELD,
+    RedisStreamListener,
+    create_redis_stream_listener,
+    decode_stream_entry,
+    room_stream_key,
+    stream_id,
+)
+from src.room_store.room_store import (
+    RawReplacementData,
+    ReplacementData,
+    UnexpectedReplacementId,
+    UnexpectedReplacementToken,
+    VersionedRoom,
+)
+from src.room_store.write_coalescer import QueueCommands, WriteCoalescer
+
+logger = logging.getLogger(__name__)
+
+# Each room is stored in two keys:
+#
+# room-stream:{room_id} is a stream with an entry for each request added since the
+# room was last compacted. Entries have the version the request gave the room as
+# their id, and the request JSON, pings included, in their request field. Servers
+# read the streams of the rooms they're serving to hear about changes, so the
+# request is only written once
+#
+# room-snapshot:{room_id} holds the actions the compactor replaced the requests
+# before the stream with, as a JSON list. Unlike RedisRoomStore's snapshots, it's
+# only written when the room is compacted
+#
+# The version of the room is kept the same way as RedisRoomStore keeps it, and
+# compacting a room trims its stream up to the version that was compacted
+
+# language=lua
+_APPEND_TO_STREAM = f"""
+{QUEUE_IF_OVERSIZED_FUNCTION}
+local stream_key = KEYS[1]
+local activity_key = KEYS[2]
+local dirty_rooms_key = KEYS[3]
+local version_key = KEYS[4]
+local oversized_rooms_key = KEYS[5]
+local cooldown_key = KEYS[6]
+local message = ARGV[1]
+local room_id = ARGV[2]
+local now = ARGV[3]
+local first_version = ARGV[4]
+local compact_length = tonumber(ARGV[5])
+local cooldown = ARGV[6]
+
+redis.call("set", version_key, first_version, "nx")
+local version = redis.call("incr", version_key)
+redis.call("xadd", stream_key, version .. "-0", "{REQUEST_FIELD}", message)
+redis.call("zadd", activity_key, now, room_id)
+redis.call("sadd", dirty_rooms_key, room_id)
+queue_if_oversized(
+    room_id,
+    redis.call("xlen", stream_key),
+    compact_length,
+    oversized_rooms_key,
+    cooldown_key,
+    cooldown
+)
+return version
+"""
+
+# Returns the version of the room followed by the id and request of each entry
+# since the given version, or nothing if the room has no version. If more requests
+# than the log length were missed, or some were trimmed by compaction, only the
+# rest are returned
+# language=lua
+_READ_REQUESTS_SINCE = f"""
+local version_key = KEYS[1]
+local stream_key = KEYS[2]
+local since = tonumber(ARGV[1])
+local start_id = ARGV[2]
+local log_length = tonumber(ARGV[3])
+
+local version = redis.call("get", version_key)
+if not version then
+    return {{}}
+end
+
+local missed = tonumber(version) - since
+if missed <= 0 or missed > log_length then
+    return {{version}}
+end
+
+local result = {{version}}
+for _, entry in ipairs(redis.call("xrange", stream_key, start_id, "+")) do
+    local fields = entry[2]
+    for i = 1, #fields, 2 do
+        if fields[i] == "{REQUEST_FIELD}" then
+            table.insert(result, entry[1])
+            table.insert(result, fields[i + 1])
+        end
+    end
+end
+return result
+"""
+
+# language=lua
+_REPLACE_ROOM = f"""
+local stream_key = KEYS[1]
+local snapshot_key = KEYS[2]
+local compaction_key = KEYS[3]
+local snapshot = ARGV[1]
+local trim_until = ARGV[2]
+local compactor_id = ARGV[3]
+
+if redis.call("get", compaction_key) ~= compactor_id then
+    return redis.error_reply("{ERR_INVALID_COMPACTION_KEY}")
+end
+
+if redis.call("exists", stream_key) == 1 then
+    redis.call("set", snapshot_key, snapshot)
+    redis.call("xtrim", stream_key, "minid", trim_until)
+end
+"""
+
+# language=lua
+_DELETE_ROOM = f"""
+local stream_key = KEYS[1]
+local snapshot_key = KEYS[2]
+local compaction_key = KEYS[3]
+local version_key = KEYS[4]
+local compactor_id = ARGV[1]
+local expected_version = tonumber(ARGV[2])
+
+if redis.call("get", compaction_key) ~= compactor_id then
+    return redis.error_reply("{ERR_INVALID_COMPACTION_KEY}")
+end
+
+if tonumber(redis.call("get", version_key) or 0) ~= expected_version then
+    return redis.error_reply("{ERR_INVALID_ROOM_VERSION}")
+end
+
+redis.call("del", stream_key, snapshot_key, version_key)
+"""
+
+# Creates the stream without any entries, so it exists and later entries come
+# after the version the room starts at
+# language=lua
+_WRITE_IF_MISSING = f"""
+local stream_key = KEYS[1]
+local snapshot_key = KEYS[2]
+local version_key = KEYS[3]
+local room_data = ARGV[1]
+local first_version = ARGV[2]
+
+if redis.call("exists", stream_key) == 0 then
+    redis.call("set", snapshot_key, room_data)
+    redis.call("set", version_key, first_version, "nx")
+    local first_id = redis.call("get", version_key) .. "-0"
+    redis.call("xadd", stream_key, first_id, "{REQUEST_FIELD}", "")
+    redis.call("xdel", stream_key, first_id)
+end
+"""
+
+
+def _stream_requests(entries: list[tuple[bytes, dict[bytes, bytes]]]) -> list[bytes]:
+    return [fields[REQUEST_FIELD.encode()] for _, fields in entries]
+
+
+def _room_updates(
+    snapshot: bytes | None, entries: list[tuple[bytes, dict[bytes, bytes]]]
+) -> list[bytes]:
+    """The updates a room is made of, as decoded by json_to_actions"""
+    return [
+        *([snapshot] if snapshot is not None else []),
+        *_stream_requests(entries),
+    ]
+
+
+def _decode_requests_since(result: list[bytes], since: int) -> list[Request] | None:
+    """
+    Decode the result of _READ_REQUESTS_SINCE
+
+    :return: The requests since the version, or None if the room never had that
+    version or some of the requests since are no longer in the stream
+    """
+    if not result:
+        return None
+    raw_version, *entries = result
+    missed = int(raw_version) - since
+    if missed < 0 or len(entries) != missed * 2:
+        return None
+    return [
+        decode_stream_entry(entry_id, request)
+        for entry_id, request in zip(entries[::2], entries[1::2], strict=True)
+    ]
+
+
+class RedisStreamRoomStore(RedisRoomStore):
+    """
+    Stores each room as a stream of requests on top of a compacted snapshot. The
+    version of the room is the id of the latest entry, so servers that lose their
+    connection to redis read on from where they were, and clients that reconnect
+    are sent the entries they missed
+    """
+
+    def __init__(
+        self,
+        redis: Redis,
+        room_listener: RedisStreamListener,
+        append_to_stream: AsyncScript,
+        replace_room: AsyncScript,
+        delete_room: AsyncScript,
+        write_if_missing: AsyncScript,
+        read_requests_since: AsyncScript,
+        read_room: AsyncScript,
+        write_snapshot: AsyncScript,
+        write_coalescer: WriteCoalescer | None = None,
+        eager_compaction_length: int = EAGER_COMPACTION_LENGTH,
+    ):
+        # Reading rooms is overridden, so the list snapshot scripts are unused
+        super().__init__(
+            redis,
+            room_listener,
+            append_to_stream,
+            replace_room,
+            delete_room,
+            write_if_missing,
+            read_requests_since,
+            read_room,
+            write_snapshot,
+            write_coalescer,
+            eager_compaction_length,
+        )
+        self._append_to_stream = append_to_stream
+        self._replace_room = replace_room
+
+    def _existence_key(self, room_id: str) -> str:
+        return room_stream_key(room_id)
+
+    async def get_all_room_ids(self) -> AsyncGenerator[str, None]:
+        prefix = room_stream_key('')
+        async for stream_key in self._redis.scan_iter(f'{prefix}*'):
+            yield stream_key.decode().removeprefix(prefix)
+
+    @instrument
+    async def room_exists(self, room_id: str) -> bool:
+        return bool(await self._redis.exists(room_stream_key(room_id)))
+
+    @instrument
+    async def read_with_version(self, room_id: str) -> VersionedRoom:
+        async with self._redis.pipeline() as pipeline:
+            await pipeline.get(snapshot_key(room_id))
+            await pipeline.xrange(room_stream_key(room_id))
+            await pipeline.get(version_key(room_id))
+            await self._record_activity(pipeline, room_id)
+            snapshot, entries, version, _ = await pipeline.execute()
+        return VersionedRoom(
+            json_to_actions(_room_updates(snapshot, entries)),
+            None if version is None else int(version),
+        )
+
+    @instrument
+    async def read_requests_since(
+        self, room_id: str, version: int
+    ) -> list[Request] | None:
+        async with self._redis.pipeline() as pipeline:
+            await self._read_requests_since(
+                client=pipeline,
+                keys=[version_key(room_id), room_stream_key(room_id)],
+                args=[version, stream_id(version + 1), ROOM_LOG_LENGTH],
+            )
+            await self._record_activity(pipeline, room_id)
+            result, _ = await pipeline.execute()
+        return _decode_requests_since(result, version)
+
+    async def write_snapshot(
+        self, room_id: str, actions: Iterable[Action], version: int
+    ) -> None:
+        # Trimming the stream would throw away the requests clients catch up
+        # with, so rooms are only snapshotted when they're compacted
+        pass
+
+    def _add_request_commands(self, room_id: str, request: Request) -> QueueCommands:
+        message = request_message(request)
+        now = int(time.time())
+        first_version = first_room_version()
+
+        async def queue_commands(pipeline: Pipeline) -> None:
+            await self._append_to_stream(
+                client=pipeline,
+                keys=[
+                    room_stream_key(room_id),
+                    ROOM_ACTIVITY_KEY,
+                    DIRTY_ROOMS_KEY,
+                    version_key(room_id),
+                    OVERSIZED_ROOMS_KEY,
+                    eager_compaction_cooldown_key(room_id),
+                ],
+                args=[
+                    message,
+                    room_id,
+                    now,
+                    first_version,
+                    self._eager_compaction_length,
+                    EAGER_COMPACTION_COOLDOWN_SECONDS,
+                ],
+            )
+
+        return queue_commands
+
+    @instrument
+    async def write_if_missing(self, room_id: str, actions: Iterable[Action]) -> None:
+        async with self._redis.pipeline() as pipeline:
+            await self._write_if_missing(
+                client=pipeline,
+                keys=[
+                    room_stream_key(room_id),
+                    snapshot_key(room_id),
+                    version_key(room_id),
+                ],
+                args=[
+                    json.dumps(list(map(encode_action, actions))),
+                    first_room_version(),
+                ],
+            )
+            await self._record_activity(pipeline, room_id)
+            await self._mark_dirty(pipeline, room_id)
+            await pipeline.execute()
+
+    @instrument
+    async def read_for_replacement(
+        self, room_id: str, read_only: bool = False
+    ) -> ReplacementData:
+        raw_data = await self.read_raw_for_replacement(room_id, read_only)
+        return ReplacementData(
+            list(json_to_actions(raw_data.updates)), raw_data.replace_token
+        )
+
+    @instrument
+    async def read_raw_for_replacement(
+        self, room_id: str, read_only: bool = False
+    ) -> RawReplacementData:
+        async with self._redis.pipeline() as pipeline:
+            await pipeline.get(snapshot_key(room_id))
+            await pipeline.xrange(room_stream_key(room_id))
+            await pipeline.get(version_key(room_id))
+            await pipeline.zscore(ROOM_ACTIVITY_KEY, room_id)
+            snapshot, entries, version, last_activity = await pipeline.execute()
+
+        updates = _room_updates(snapshot, entries)
+        if updates and last_activity is None and not read_only:
+            await self._record_missing_activity(room_id)
+
+        # Requests added after reading have later versions, so they're kept when
+        # the stream is trimmed up to this one
+        return RawReplacementData(updates, 0 if version is None else int(version))
+
+    @instrument
+    async def replace_raw(
+        self, room_id: str, update: bytes, replace_token: Any, replacer_id: str
+    ) -> None:
+        try:
+            await self._replace_room(
+                keys=[
+                    room_stream_key(room_id),
+                    snapshot_key(room_id),
+                    REPLACEMENT_KEY,
+                ],
+                args=[update, stream_id(replace_token + 1), replacer_id],
+            )
+            await self._room_listener.publish_invalidation(room_id)
+        except ResponseError as e:
+            # The error message is only exposed as the first element in the args
+            # tuple :(
+            (msg,) = e.args
+
+            if msg == ERR_INVALID_COMPACTION_KEY:
+                raise UnexpectedReplacementId() from e
+            else:
+                raise
+
+    @instrument
+    async def delete(self, room_id: str, replacer_id: str, replace_token: Any) -> None:
+        try:
+            async with self._redis.pipeline() as pipeline:
+                await self._delete_room(
+                    keys=[
+                        room_stream_key(room_id),
+                        snapshot_key(room_id),
+                        REPLACEMENT_KEY,
+                        version_key(room_id),
+                    ],
+                    args=[replacer_id, replace_token],
+                )
+                await self._forget_activity(pipeline, room_id)
+                await self._room_listener.publish_invalidation(room_id, pipeline)
+                await pipeline.execute()
+        except ResponseError as e:
+            # The error message is only exposed as the first element in the args
+            # tuple :(
+            (msg,) = e.args
+
+            if msg == ERR_INVALID_ROOM_VERSION:
+                raise UnexpectedReplacementToken() from e
+            elif msg == ERR_INVALID_COMPACTION_KEY:
+                raise UnexpectedReplacementId() from e
+            else:
+                raise
+
+
+@asynccontextmanager
+async def create_redis_stream_room_store(
+    redis: Redis,
+    write_batch_window_seconds: float | None = None,
+    eager_compaction_length: int = EAGER_COMPACTION_LENGTH,
+) -> AsyncIterator[RedisStreamRoomStore]:
+    """
+    :param write_batch_window_seconds: How long to gather requests from every
+    connection before writing them together, or None to write each on its own
+    :param eager_compaction_length: How many requests a room's stream can hold
+    before it's queued to be compacted right away. 0 never queues rooms
+    """
+    write_coalescer = (
+        None
+        if write_batch_window_seconds is None
+        else WriteCoalescer(redis, write_batch_window_seconds)
+    )
+    append_to_stream = redis.register_script(_APPEND_TO_STREAM)
+    replace_room = redis.register_script(_REPLACE_ROOM)
+    delete_room = redis.register_script(_DELETE_ROOM)
+    write_if_missing = redis.register_script(_WRITE_IF_MISSING)
+    read_requests_since = redis.register_script(_READ_REQUESTS_SINCE)
+    read_room = redis.register_script(READ_ROOM)
+    write_snapshot = redis.register_script(WRITE_SNAPSHOT)
+
+    async with create_redis_stream_listener(redis) as listener:
+        store = RedisStreamRoomStore(
+            redis,
+            listener,
+            append_to_stream,
+            replace_room,
+            delete_room,
+            write_if_missing,
+            read_requests_since,
+            read_room,
+            write_snapshot,
+            write_coalescer,
+            eager_compaction_length,
+        )
+        try:
+            yield store
+        finally:
+            await store.close()
@@ -1,4 +1,6 @@
+import hashlib
 from collections.abc import AsyncIterator, Iterable
+from dataclasses import dataclass
 from typing import Protocol
 
 from src.api.api_structures import Action
@@ -13,4 +15,44 @@ class RoomArchive(Protocol):
 
     async def write(self, room_id: str, data: Iterable[Action]) -> None: ...
 
+    async def write_raw(self, room_id: str, data: bytes) -> None:
+        """
+        Like write, but with the actions already encoded as a JSON list
+        """
+        ...
+
     async def delete(self, room_id: str) -> None: ...
+
+
+def md5_etag(data: bytes) -> str:
+    """The ETag S3 gives objects uploaded in one part"""
+    return f'"{hashlib.md5(data).hexdigest()}"'
+
+
+@dataclass
+class ArchiveObject:
+    # The archive in the format from archive_format
+    data: bytes
+    etag: str
+
+
+class ObjectRoomArchive(RoomArchive, Protocol):
+    """A room archive whose stored objects can be read and written directly"""
+
+    async def read_object(
+        self, room_id: str, if_none_match: str | None = None
+    ) -> ArchiveObject | None:
+        """
+        :param if_none_match: The ETag of a copy of the object that's already
+        been read
+        :return: The object, or None if its ETag is still if_none_match
+        :raises NoSuchRoomError: If the room isn't archived
+        """
+        ...
+
+    async def write_object(self, room_id: str, data: bytes) -> str:
+        """
+        :param data: The archive in the format from archive_format
+        :return: The ETag of the written object
+        """
+        ...
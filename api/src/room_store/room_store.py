@@ -11,6 +11,9 @@ from src.game_components import Ping, Token
 MAX_LOCK_RETRIES = 3
 COMPACTION_INTERVAL_SECONDS = 10 * 60
 COMPACTION_LOCK_EXPIRATION_SECONDS = COMPACTION_INTERVAL_SECONDS * 2
+# How long one server can spend loading a room from the archive before another
+# server takes over, in case the first one died
+HYDRATION_LOCK_EXPIRATION_SECONDS = 10
 
 
 class CorruptedRoomException(Exception):
@@ -35,21 +38,70 @@ class RoomChangeEvent:
     entities: list[Token | Ping]
 
 
+@dataclass
+class VersionedRoom:
+    actions: Iterable[Action]
+    # The version of the room the actions are from, or None if the room doesn't
+    # have a version yet, e.g. because nothing has been written to it
+    version: int | None
+
+
 @dataclass
 class ReplacementData:
     actions: Iterable[Action]
     replace_token: Any
 
 
+@dataclass
+class RawReplacementData:
+    # Each update is a JSON encoded list of actions or a request holding them, as
+    # decoded by json_to_actions
+    updates: list[bytes]
+    replace_token: Any
+
+
 class RoomStore(Protocol):
     def changes(self, room_id: str) -> Awaitable[AsyncIterator[Request]]: ...
 
+    def invalidations(self) -> Awaitable[AsyncIterator[str]]:
+        """
+        Subscribe to the IDs of rooms whose stored contents are replaced or deleted,
+        by any replacer on any server
+        """
+        ...
+
     def get_all_room_ids(self) -> AsyncIterator[str]: ...
 
     async def room_exists(self, room_id: str) -> bool: ...
 
     async def read(self, room_id: str) -> Iterable[Action]: ...
 
+    async def read_with_version(self, room_id: str) -> VersionedRoom:
+        """Like read, but also return the version of the room that was read"""
+        ...
+
+    async def write_snapshot(
+        self, room_id: str, actions: Iterable[Action], version: int
+    ) -> None:
+        """
+        Save the state of the room at a version, so reading the room only has to
+        go through the requests added after it. Stores that don't need snapshots
+        can ignore them
+        :param actions: Upserts for every token in the room at that version
+        """
+        ...
+
+    async def read_requests_since(
+        self, room_id: str, version: int
+    ) -> list[Request] | None:
+        """
+        :param version: A version of the room, e.g. the last one a client saw
+        :return: Every request added to the room after that version, in order, or
+        None if the room never had that version or some of the requests since
+        are no longer kept
+        """
+        ...
+
     async def write_if_missing(self, room_id: str, actions: Iterable[Action]) -> None:
         """
         Create a room and add the actions to it if the room is not already in
@@ -59,13 +111,52 @@ class RoomStore(Protocol):
         """
         ...
 
-    async def add_request(self, room_id: str, request: Request) -> None: ...
+    async def add_request(self, room_id: str, request: Request) -> None:
+        """
+        Add the request to the room, giving the room a new version. The request is
+        passed on to listeners with the version set
+        """
+        ...
 
     async def acquire_replacement_lock(
         self, compaction_id: str, force: bool = False
     ) -> bool: ...
 
-    async def read_for_replacement(self, room_id: str) -> ReplacementData: ...
+    async def acquire_hydration_lock(self, room_id: str, loader_id: str) -> bool:
+        """
+        Take the lock on loading a room from the archive, so only one server loads
+        it at once. The lock expires after HYDRATION_LOCK_EXPIRATION_SECONDS
+
+        :param loader_id: A unique id for the caller, needed to release the lock
+        :return: Whether the lock was acquired
+        """
+        ...
+
+    async def release_hydration_lock(self, room_id: str, loader_id: str) -> None:
+        """
+        Release the lock, unless it expired and someone else has taken it since
+
+        :param loader_id: The id the lock was acquired with
+        """
+        ...
+
+    async def read_for_replacement(
+        self, room_id: str, read_only: bool = False
+    ) -> ReplacementData:
+        """
+        :param read_only: Don't give the room an activity time if it's missing one,
+        e.g. for a dry run
+        """
+        ...
+
+    async def read_raw_for_replacement(
+        self, room_id: str, read_only: bool = False
+    ) -> RawReplacementData:
+        """
+        Like read_for_replacement, but without decoding the room so it can be
+        decoded somewhere other than the event loop
+        """
+        ...
 
     async def delete(
         self, room_id: str, replacer_id: str, replace_token: Any
@@ -79,14 +170,61 @@ class RoomStore(Protocol):
         compaction_id: str,
     ) -> None: ...
 
-    async def get_room_idle_seconds(self, room_id: str) -> int:
+    async def replace_raw(
+        self,
+        room_id: str,
+        update: bytes,
+        replace_token: Any,
+        compaction_id: str,
+    ) -> None:
+        """
+        Like replace, but with the actions already encoded as a single update in
+        the same format as RawReplacementData
+        """
+        ...
+
+    async def get_room_idle_seconds(self, room_id: str, read_only: bool = False) -> int:
         """
         :param room_id: The ID of the room to get the idle time of
+        :param read_only: Don't give the room an activity time if it's missing one
         :raises: NoSuchRoomError if the room does not exist
         :return: Number of seconds since the room was read or written to by a user
         """
         ...
 
+    def get_idle_room_ids(
+        self, idle_seconds: int, read_only: bool = False
+    ) -> AsyncIterator[str]:
+        """
+        :param idle_seconds: Minimum number of seconds since the room was read or
+        written to by a user
+        :param read_only: Don't forget the activity of rooms that have been gone
+        long enough to not be worth keeping
+        :return: The IDs of rooms that have been idle for at least idle_seconds
+        """
+        ...
+
+    async def drain_dirty_room_ids(self) -> set[str]:
+        """
+        Remove and return the IDs of every room written to since the last time
+        they were drained
+        """
+        ...
+
+    async def add_dirty_room_ids(self, room_ids: Iterable[str]) -> None:
+        """
+        Mark rooms as written to again, e.g. if they were drained but couldn't be
+        compacted
+        """
+        ...
+
+    async def drain_oversized_room_ids(self) -> set[str]:
+        """
+        Remove and return the IDs of rooms that grew long enough to be compacted
+        right away instead of waiting for the next compaction cycle
+        """
+        ...
+
     async def seconds_since_last_activity(self) -> int | None:
         """
         :return: How many seconds have passed since the last room update,
@@ -1,14 +1,16 @@
-import json
 from collections.abc import AsyncIterator, Iterable
-from dataclasses import asdict
 
 import botocore.exceptions
 from aiobotocore.client import AioBaseClient
 
 from src.api.api_structures import Action
+from src.room_store.archive_format import (
+    compress_archive_json,
+    decode_archive,
+    encode_archive,
+)
 from src.room_store.common import NoSuchRoomError
-from src.room_store.json_to_actions import json_to_actions
-from src.room_store.room_archive import RoomArchive
+from src.room_store.room_archive import ArchiveObject, ObjectRoomArchive
 
 ROOM_DIR = 'rooms/'
 
@@ -17,7 +19,7 @@ def _room_id_to_key(room_id: str) -> str:
     return f'{ROOM_DIR}{room_id}'
 
 
-class S3RoomArchive(RoomArchive):
+class S3RoomArchive(ObjectRoomArchive):
     def __init__(self, client: AioBaseClient, bucket: str):
         self._client = client
         self._bucket = bucket
@@ -41,23 +43,41 @@ class S3RoomArchive(RoomArchive):
         return True
 
     async def read(self, room_id: str) -> Iterable[Action]:
+        archive_object = await self.read_object(room_id)
+        # Without an ETag to match, the object is always returned
+        if archive_object is None:  # pragma: no cover
+            raise NoSuchRoomError
+        return decode_archive(archive_object.data)
+
+    async def read_object(
+        self, room_id: str, if_none_match: str | None = None
+    ) -> ArchiveObject | None:
+        condition = {} if if_none_match is None else {'IfNoneMatch': if_none_match}
         try:
             resp = await self._client.get_object(
-                Bucket=self._bucket, Key=_room_id_to_key(room_id)
+                Bucket=self._bucket, Key=_room_id_to_key(room_id), **condition
             )
         except botocore.exceptions.ClientError as e:
-            if e.response.get('Error', {}).get('Code', 'Unknown') == 'NoSuchKey':
+            code = e.response.get('Error', {}).get('Code', 'Unknown')
+            if code == 'NoSuchKey':
                 raise NoSuchRoomError from e
+            elif code == '304':
+                return None
             raise
-        data = await resp['Body'].read()
-        return json_to_actions([str(data.decode())])
+        return ArchiveObject(await resp['Body'].read(), resp['ETag'])
 
     async def write(self, room_id: str, data: Iterable[Action]) -> None:
-        await self._client.put_object(
-            Bucket=self._bucket,
-            Key=_room_id_to_key(room_id),
-            Body=json.dumps(list(map(asdict, data))),
+        await self.write_object(room_id, encode_archive(data))
+
+    async def write_raw(self, room_id: str, data: bytes) -> None:
+        await self.write_object(room_id, compress_archive_json(data))
+
+    async def write_object(self, room_id: str, data: bytes) -> str:
+        resp = await self._client.put_object(
+            Bucket=self._bucket, Key=_room_id_to_key(room_id), Body=data
         )
+        etag: str = resp['ETag']
+        return etag
 
     async def delete(self, room_id: str) -> None:
         await self._client.delete_object(
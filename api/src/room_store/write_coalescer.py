@@ -0,0 +1,115 @@
+import asyncio
+import logging
+from asyncio import Future, Task
+from collections.abc import Awaitable, Callable
+
+from redis.asyncio.client import Pipeline, Redis
+
+from src.util.async_util import end_task
+
+logger = logging.getLogger(__name__)
+
+# Adds the commands for one write to a pipeline
+QueueCommands = Callable[[Pipeline], Awaitable[None]]
+
+
+class WriteCoalescer:
+    """
+    Gathers writes from every connection on this server into shared pipelines, so a
+    burst of writes costs one round trip to redis instead of one per write
+
+    Writes are sent in the order they arrive and only one batch is sent at a time,
+    so writes to the same room stay in order. Batches are not transactions, each
+    write succeeds or fails on its own.
+    """
+
+    def __init__(self, redis: Redis, window_seconds: float = 0):
+        """
+        :param window_seconds: How long to wait for more writes after the first
+        write of a batch arrives. 0 waits for a single turn of the event loop
+        """
+        self._redis = redis
+        self._window_seconds = window_seconds
+        self._pending: list[tuple[QueueCommands, Future[None]]] = []
+        self._flush_task: Task | None = None
+
+    async def write(self, queue_commands: QueueCommands) -> None:
+        """
+        Send the write with the next batch, returning once the batch is done
+
+        :param queue_commands: Adds the write's commands to the batch's pipeline
+        :raises: The first error from any of the write's commands
+        """
+        future: Future[None] = asyncio.get_running_loop().create_future()
+        self._pending.append((queue_commands, future))
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(
+                self._flush(), name='WriteCoalescer flush'
+            )
+        await future
+
+    async def _flush(self) -> None:
+        batch: list[tuple[QueueCommands, Future[None]]] = []
+        try:
+            while self._pending:
+                await asyncio.sleep(self._window_seconds)
+                batch, self._pending = self._pending, []
+                await self._write_batch(batch)
+        finally:
+            self._flush_task = None
+            # Only does anything if the flush was cancelled partway through
+            for _, future in [*batch, *self._pending]:
+                future.cancel()
+            self._pending = []
+
+    async def _write_batch(
+        self, batch: list[tuple[QueueCommands, Future[None]]]
+    ) -> None:
+        command_counts = []
+        try:
+            async with self._redis.pipeline(transaction=False) as pipeline:
+                for queue_commands, future in batch:
+                    commands_before = len(pipeline.command_stack)
+                    try:
+                        await queue_commands(pipeline)
+                    except Exception as e:
+                        # Leave out whatever the write managed to queue, so one
+                        # bad write doesn't stop the rest of the batch
+                        del pipeline.command_stack[commands_before:]
+                        if not future.done():
+                            future.set_exception(e)
+                    command_counts.append(len(pipeline.command_stack) - commands_before)
+                results = await pipeline.execute(raise_on_error=False)
+        except Exception as e:
+            # Nothing in the batch can be known to have been written
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        logger.debug('Wrote batch', extra={'writes': len(batch)})
+        start = 0
+        for (_, future), command_count in zip(batch, command_counts, strict=True):
+            errors = [
+                result
+                for result in results[start : start + command_count]
+                if isinstance(result, Exception)
+            ]
+            start += command_count
+            # Either the write failed to queue its commands, or the writer stopped
+            # waiting but the write still happened
+            if future.done():
+                continue
+            if errors:
+                future.set_exception(errors[0])
+            else:
+                future.set_result(None)
+
+    async def close(self) -> None:
+        if self._flush_task:
+            await end_task(self._flush_task)
+        # The flush is cancelled before it cleans up if it never got to start
+        self._flush_task = None
+        for _, future in self._pending:
+            future.cancel()
+        self._pending = []
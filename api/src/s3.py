@@ -0,0 +1,13 @@
+from aiobotocore.session import ClientCreatorContext, get_session
+
+
+def create_s3_context(
+    region: str, endpoint: str | None, key_id: str, secret_key: str
+) -> ClientCreatorContext:
+    return get_session().create_client(
+        's3',
+        region_name=region,
+        endpoint_url=endpoint,
+        aws_access_key_id=key_id,
+        aws_secret_access_key=secret_key,
+    )
@@ -0,0 +1,81 @@
+from collections import defaultdict
+from collections.abc import Iterator
+
+# (start_x, start_y, start_z, end_x, end_y, end_z), end coordinates are exclusive
+Box = tuple[int, int, int, int, int, int]
+
+# Tokens are usually a single unit wide, but floors can be painted over huge areas.
+# Buckets of this size keep a single large floor to a few hundred cells while
+# keeping the number of candidates per bucket low for regular tokens
+DEFAULT_CELL_SIZE = 16
+
+
+def boxes_intersect(a: Box, b: Box) -> bool:
+    return (
+        a[0] < b[3]
+        and b[0] < a[3]
+        and a[1] < b[4]
+        and b[1] < a[4]
+        and a[2] < b[5]
+        and b[2] < a[5]
+    )
+
+
+class BoxIndex:
+    """
+    Spatial index of axis-aligned boxes, bucketed into a coarse grid over the x/y
+    plane.
+
+    Inserting, removing, and querying a box costs time proportional to the number
+    of grid cells it covers plus the number of boxes it overlaps, instead of the
+    volume of the box.
+    """
+
+    def __init__(self, cell_size: int = DEFAULT_CELL_SIZE) -> None:
+        self._cell_size = cell_size
+        self._boxes: dict[str, Box] = {}
+        self._cells: defaultdict[tuple[int, int], set[str]] = defaultdict(set)
+
+    def __len__(self) -> int:
+        return len(self._boxes)
+
+    def __contains__(self, box_id: str) -> bool:
+        return box_id in self._boxes
+
+    def _cells_for(self, box: Box) -> Iterator[tuple[int, int]]:
+        size = self._cell_size
+        for cell_x in range(box[0] // size, (box[3] - 1) // size + 1):
+            for cell_y in range(box[1] // size, (box[4] - 1) // size + 1):
+                yield cell_x, cell_y
+
+    def insert(self, box_id: str, box: Box) -> None:
+        """Add a box to the index, replacing any box already stored under box_id"""
+        self.remove(box_id)
+        self._boxes[box_id] = box
+        for cell in self._cells_for(box):
+            self._cells[cell].add(box_id)
+
+    def remove(self, box_id: str) -> None:
+        box = self._boxes.pop(box_id, None)
+        if box is None:
+            return
+
+        for cell in self._cells_for(box):
+            ids = self._cells[cell]
+            ids.discard(box_id)
+            if not ids:
+                del self._cells[cell]
+
+    def intersecting(self, box: Box) -> Iterator[str]:
+        """Yield the ids of every box in the index that overlaps the given box"""
+        seen: set[str] = set()
+        for cell in self._cells_for(box):
+            for box_id in self._cells.get(cell, ()):
+                if box_id in seen:
+                    continue
+                seen.add(box_id)
+                if boxes_intersect(self._boxes[box_id], box):
+                    yield box_id
+
+    def any_intersecting(self, box: Box) -> bool:
+        return next(self.intersecting(box), None) is not None
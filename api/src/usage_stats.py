@@ -1,6 +1,7 @@
 from dataclasses import dataclass
 
 from src.rate_limit.rate_limit import RateLimiter
+from src.room_cache import FanOutStats, RoomCache
 from src.room_store.room_store import RoomStore
 
 
@@ -8,12 +9,15 @@ from src.room_store.room_store import RoomStore
 class UsageStats:
     seconds_since_last_activity: int | None
     num_connections: int
+    # Only for the worker that handled the stats request
+    fan_out: FanOutStats
 
 
 async def get_usage_stats(
-    room_store: RoomStore, rate_limiter: RateLimiter
+    room_store: RoomStore, rate_limiter: RateLimiter, room_cache: RoomCache
 ) -> UsageStats:
     return UsageStats(
         await room_store.seconds_since_last_activity(),
         await rate_limiter.get_total_num_connections(),
+        room_cache.fan_out_stats(),
     )
@@ -1,5 +1,5 @@
-from collections.abc import AsyncIterable, Mapping
-from typing import TypedDict, cast
+from collections.abc import AsyncIterable, Mapping, Sequence
+from typing import NotRequired, TypedDict, cast
 
 from starlette.websockets import WebSocket
 
@@ -30,12 +30,18 @@ class StarletteWebsocketClient(WebsocketClient):
     def path(self) -> str:
         return self._scope['path']
 
-    async def accept(self) -> None:
-        await self._websocket.accept()
+    async def accept(self, subprotocol: str | None = None) -> None:
+        await self._websocket.accept(subprotocol)
 
     def headers(self) -> Mapping[str, str]:
         return self._websocket.headers
 
+    def subprotocols(self) -> Sequence[str]:
+        return self._scope.get('subprotocols', [])
+
+    def query_params(self) -> Mapping[str, str]:
+        return self._websocket.query_params
+
 
 class WebsocketScope(TypedDict):
     """
@@ -55,3 +61,8 @@ class WebsocketScope(TypedDict):
     HTTP request target excluding any query string, with percent-encoded
     sequences and UTF-8 byte sequences decoded into characters.
     """
+    subprotocols: NotRequired[list[str]]
+    """
+    Subprotocols the client advertised. Optional; if missing defaults to empty
+    list.
+    """
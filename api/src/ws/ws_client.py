@@ -1,4 +1,4 @@
-from collections.abc import AsyncIterable, Mapping
+from collections.abc import AsyncIterable, Mapping, Sequence
 from typing import (
     Protocol,
 )
@@ -19,6 +19,10 @@ class WebsocketClient(Protocol):
 
     def path(self) -> str: ...
 
-    async def accept(self) -> None: ...
+    async def accept(self, subprotocol: str | None = None) -> None: ...
 
     def headers(self) -> Mapping[str, str]: ...
+
+    def subprotocols(self) -> Sequence[str]: ...
+
+    def query_params(self) -> Mapping[str, str]: ...
@@ -0,0 +1,175 @@
+import json
+from dataclasses import asdict, replace
+from typing import Any
+
+import dacite
+import pytest
+
+from src.api.api_structures import (
+    ConnectionResponse,
+    ErrorResponse,
+    Request,
+    Response,
+    UpdateResponse,
+    UpsertAction,
+)
+from src.api.codec import (
+    DecodeError,
+    decode_request,
+    encode_action,
+    encode_request,
+    encode_request_for_room,
+    encode_response,
+    request_message,
+)
+from src.game_components import TextTokenContents
+from tests.static_fixtures import (
+    DELETE_VALID_TOKEN,
+    PING_ACTION,
+    TEST_REQUEST_ID,
+    VALID_ACTION,
+    VALID_TOKEN,
+)
+
+TOKEN_WITHOUT_COLOR = UpsertAction(
+    replace(VALID_TOKEN, contents=TextTokenContents('a'), color_rgb=None)
+)
+TOKEN_DATA = asdict(VALID_TOKEN)
+PING_DATA = asdict(PING_ACTION.data)
+
+
+def _request(*actions: Any) -> dict[str, Any]:
+    return {'request_id': TEST_REQUEST_ID, 'actions': list(actions)}
+
+
+VALID_REQUESTS = [
+    _request(),
+    _request(asdict(VALID_ACTION), asdict(DELETE_VALID_TOKEN), asdict(PING_ACTION)),
+    # The action is optional, the data decides what kind of action it is
+    _request({'data': TOKEN_DATA}, {'data': 'token_id'}, {'data': PING_DATA}),
+    _request({'action': 'upsert', 'data': {**TOKEN_DATA, 'color_rgb': None}}),
+    _request({'action': 'upsert', 'data': {**TOKEN_DATA, 'contents': {'text': 'a'}}}),
+    _request({'data': {k: v for k, v in TOKEN_DATA.items() if k != 'color_rgb'}}),
+    # Text contents win when both are given
+    _request({'data': {**TOKEN_DATA, 'contents': {'text': 'a', 'icon_id': 'b'}}}),
+    _request({'data': {**TOKEN_DATA, 'contents': {'text': 1, 'icon_id': 'b'}}}),
+    {**_request(asdict(VALID_ACTION)), 'unknown': 'field'},
+    # Bools are ints to dacite
+    _request({'data': {**TOKEN_DATA, 'start_x': False, 'end_x': True}}),
+    _request(
+        {'data': {**TOKEN_DATA, 'color_rgb': {'red': True, 'green': 0, 'blue': 0}}}
+    ),
+    _request({'action': 'ping', 'data': {**PING_DATA, 'x': True}}),
+]
+
+INVALID_REQUESTS = [
+    [],
+    'request',
+    {'actions': []},
+    {'request_id': TEST_REQUEST_ID},
+    {'request_id': None, 'actions': []},
+    {'request_id': 1, 'actions': []},
+    {'request_id': TEST_REQUEST_ID, 'actions': 'abc'},
+    {'request_id': TEST_REQUEST_ID, 'actions': {'data': 'token_id'}},
+    _request(1),
+    _request({'action': 'delete'}),
+    _request({'action': 'delete', 'data': TOKEN_DATA}),
+    _request({'action': 'upsert', 'data': 'token_id'}),
+    _request({'action': 'ping', 'data': TOKEN_DATA}),
+    _request({'action': 'unknown', 'data': 'token_id'}),
+    _request({'action': 'upsert', 'data': {**TOKEN_DATA, 'end_x': 0}}),
+    _request({'action': 'upsert', 'data': {**TOKEN_DATA, 'start_x': True}}),
+    _request({'action': 'upsert', 'data': {**TOKEN_DATA, 'start_x': 0.0}}),
+    _request({'action': 'upsert', 'data': {**TOKEN_DATA, 'id': 1}}),
+    _request({'action': 'upsert', 'data': {**TOKEN_DATA, 'type': 'wall'}}),
+    _request({'action': 'upsert', 'data': {**TOKEN_DATA, 'contents': {}}}),
+    _request({'action': 'upsert', 'data': {**TOKEN_DATA, 'contents': 'a'}}),
+    _request({'action': 'upsert', 'data': {**TOKEN_DATA, 'color_rgb': [1, 2, 3]}}),
+    _request(
+        {
+            'action': 'upsert',
+            'data': {**TOKEN_DATA, 'color_rgb': {'red': 256, 'green': 0, 'blue': 0}},
+        }
+    ),
+    _request(
+        {
+            'action': 'upsert',
+            'data': {**TOKEN_DATA, 'color_rgb': {'red': 1.0, 'green': 0, 'blue': 0}},
+        }
+    ),
+    _request({'action': 'upsert', 'data': {**TOKEN_DATA, 'color_rgb': {'red': 1}}}),
+    _request({'action': 'ping', 'data': {**PING_DATA, 'type': 'pong'}}),
+    _request({'action': 'ping', 'data': {**PING_DATA, 'x': '1'}}),
+    _request({'action': 'ping', 'data': {'id': 'ping_id'}}),
+]
+
+
+@pytest.mark.parametrize('data', VALID_REQUESTS)
+def test_decodes_like_dacite(data: Any) -> None:
+    assert decode_request(data) == dacite.from_dict(Request, data)
+
+
+@pytest.mark.parametrize('data', INVALID_REQUESTS)
+def test_rejects_like_dacite(data: Any) -> None:
+    with pytest.raises(dacite.DaciteError):
+        dacite.from_dict(Request, data)
+    with pytest.raises(DecodeError):
+        decode_request(data)
+
+
+@pytest.mark.parametrize(
+    'action', [VALID_ACTION, TOKEN_WITHOUT_COLOR, DELETE_VALID_TOKEN, PING_ACTION]
+)
+def test_encodes_actions_like_asdict(action: Any) -> None:
+    # Compare the JSON so the key order is checked too
+    assert json.dumps(encode_action(action)) == json.dumps(asdict(action))
+
+
+def _without_server_fields(items: list[tuple[str, Any]]) -> dict[str, Any]:
+    return {key: value for key, value in items if key != 'version'}
+
+
+def test_encodes_requests_like_asdict() -> None:
+    request = Request(TEST_REQUEST_ID, [VALID_ACTION, DELETE_VALID_TOKEN])
+    assert json.dumps(encode_request(request)) == json.dumps(
+        asdict(request, dict_factory=_without_server_fields)
+    )
+
+
+def test_encodes_requests_for_rooms() -> None:
+    request = Request(TEST_REQUEST_ID, [VALID_ACTION, PING_ACTION, DELETE_VALID_TOKEN])
+    encoded = encode_request_for_room(request)
+    assert encoded.message == json.dumps(encode_request(request))
+    assert encoded.message == request_message(request)
+    assert encoded.room_update == json.dumps(
+        [encode_action(VALID_ACTION), encode_action(DELETE_VALID_TOKEN)]
+    )
+
+
+def test_encodes_only_decoded_fields() -> None:
+    data = _request({**asdict(VALID_ACTION), 'extra': 'field'})
+    data['extra'] = 'field'
+    request = decode_request(data)
+    assert encode_request_for_room(request).message == json.dumps(
+        _request(asdict(VALID_ACTION))
+    )
+
+
+def _ignore_none(items: list[tuple[str, Any]]) -> dict[str, Any]:
+    return dict(filter(lambda entry: entry[1] is not None, items))
+
+
+@pytest.mark.parametrize(
+    'response',
+    [
+        ConnectionResponse([VALID_TOKEN, TOKEN_WITHOUT_COLOR.data]),
+        ConnectionResponse([VALID_TOKEN], version=3),
+        UpdateResponse([VALID_ACTION, TOKEN_WITHOUT_COLOR, PING_ACTION], 'req'),
+        UpdateResponse([VALID_ACTION], 'req', version=3),
+        ErrorResponse('Invalid request', TEST_REQUEST_ID, 'session'),
+    ],
+)
+def test_encodes_responses_without_none(response: Response) -> None:
+    assert json.dumps(encode_response(response)) == json.dumps(
+        asdict(response, dict_factory=_ignore_none)
+    )
@@ -0,0 +1,63 @@
+import asyncio
+from collections.abc import AsyncIterator, Sequence
+
+import pytest
+
+from src.api.api_structures import ConnectionResponse, Response, UpdateResponse
+from src.api.codec import response_frame
+from src.api.frame_batching import batch_frame, batched_frames
+from src.util.async_util import async_collect
+from tests.static_fixtures import VALID_ACTION, VALID_TOKEN
+
+CONNECTION_RESPONSE = ConnectionResponse([VALID_TOKEN])
+UPDATES = [UpdateResponse([VALID_ACTION], f'request-{i}') for i in range(3)]
+
+
+async def _responses(
+    *batches: Sequence[Response], error: Exception | None = None
+) -> AsyncIterator[Response]:
+    for i, batch in enumerate(batches):
+        if i:
+            # Never finishes, so only the window passing can send the batch before
+            await asyncio.Event().wait()
+        for response in batch:
+            yield response
+    if error:
+        raise error
+
+
+def _frame(*responses: Response) -> str:
+    return batch_frame([response_frame(response) for response in responses])
+
+
+async def test_responses_made_together_are_sent_together() -> None:
+    frames = batched_frames(_responses([CONNECTION_RESPONSE, *UPDATES]))
+    assert await async_collect(frames) == [_frame(CONNECTION_RESPONSE, *UPDATES)]
+
+
+async def test_batch_is_sent_once_window_passes() -> None:
+    frames = batched_frames(
+        _responses([CONNECTION_RESPONSE], UPDATES), window_seconds=0
+    )
+    assert await anext(frames) == _frame(CONNECTION_RESPONSE)
+    await frames.aclose()
+
+
+async def test_batch_is_sent_early_once_big_enough() -> None:
+    frames = batched_frames(
+        _responses(UPDATES),
+        max_batch_bytes=len(response_frame(UPDATES[0])) * 2,
+    )
+    assert await async_collect(frames) == [
+        _frame(*UPDATES[:2]),
+        _frame(UPDATES[2]),
+    ]
+
+
+async def test_responses_before_error_are_sent() -> None:
+    frames = batched_frames(
+        _responses([CONNECTION_RESPONSE], error=ValueError('Disconnected'))
+    )
+    assert await anext(frames) == _frame(CONNECTION_RESPONSE)
+    with pytest.raises(ValueError):
+        await anext(frames)
@@ -9,7 +9,10 @@ from starlette.applications import Starlette
 from starlette.requests import Request
 from starlette.responses import Response
 
-from src.api.api_structures import BYPASS_RATE_LIMIT_HEADER
+from src.api.api_structures import (
+    BATCHED_RESPONSES_SUBPROTOCOL,
+    BYPASS_RATE_LIMIT_HEADER,
+)
 from src.api.ws_close_codes import (
     ERR_INVALID_REQUEST,
     ERR_INVALID_UUID,
@@ -26,6 +29,7 @@ from src.rate_limit.rate_limit import (
     MAX_CONNECTIONS_PER_USER,
     MAX_ROOMS_PER_TEN_MINUTES,
 )
+from src.room_cache import RoomCache
 from src.room_store.memory_room_store import MemoryRoomStorage, MemoryRoomStore
 from src.routes import routes
 from tests import emulated_client
@@ -67,7 +71,9 @@ async def app() -> WebsocketAsgiApp:
         'server-id',
         MemoryRateLimiterStorage(),
     )
-    gss = GameStateServer(room_store, rate_limiter, NoopRateLimiter())
+    gss = GameStateServer(
+        room_store, RoomCache(room_store), rate_limiter, NoopRateLimiter()
+    )
     ws = WebsocketManager(gss, rate_limiter, TEST_BYPASS_RATE_LIMIT_KEY)
     # Starlette has looser definitions than WebsocketAsgiApp but otherwise fits
     # the protocol requirements
@@ -139,6 +145,50 @@ async def test_add_token(app: WebsocketAsgiApp) -> None:
         )
 
 
+async def test_batched_responses(app: WebsocketAsgiApp) -> None:
+    async with emulated_client.connect(
+        app, f'/{ROOM_ID}', subprotocols=[BATCHED_RESPONSES_SUBPROTOCOL]
+    ) as client:
+        assert client.subprotocol == BATCHED_RESPONSES_SUBPROTOCOL
+        assert await client.receive_json() == [{'type': 'connected', 'data': []}]
+        await client.send_json(
+            {
+                'request_id': TEST_REQUEST_ID,
+                'actions': [TEST_UPSERT_TOKEN],
+            }
+        )
+
+        (update,) = await client.receive_json()
+        assert_matches(
+            update,
+            {
+                'type': 'update',
+                'request_id': TEST_REQUEST_ID,
+                'actions': [TEST_UPSERT_TOKEN],
+            },
+        )
+
+
+async def test_reconnect_with_last_seen_version(app: WebsocketAsgiApp) -> None:
+    async with emulated_client.connect(app, f'/{ROOM_ID}') as client:
+        await client.receive_json()
+        await client.send_json(
+            {'request_id': TEST_REQUEST_ID, 'actions': [TEST_UPSERT_TOKEN]}
+        )
+        update = await client.receive_json()
+
+    async with emulated_client.connect(
+        app, f'/{ROOM_ID}', query_string=f'version={update["version"]}'
+    ) as client:
+        delete_action = {'action': 'delete', 'data': TEST_TOKEN['id']}
+        await client.send_json({'request_id': 'delete', 'actions': [delete_action]})
+        # Nothing was missed, so the room isn't sent again
+        assert_matches(
+            await client.receive_json(),
+            {'type': 'update', 'request_id': 'delete', 'actions': [delete_action]},
+        )
+
+
 async def test_invalid_request(app: WebsocketAsgiApp) -> None:
     with pytest.raises(WebsocketClosed) as e:
         async with emulated_client.connect(app, f'/{ROOM_ID}') as client:
@@ -12,7 +12,15 @@ from redis.asyncio.client import Redis
 from src.room_store.memory_room_archive import MemoryRoomArchive
 from src.room_store.memory_room_store import MemoryRoomStorage, MemoryRoomStore
 from src.room_store.merged_room_store import MergedRoomStore
+from src.room_store.redis_hash_room_store import (
+    RedisHashRoomStore,
+    create_redis_hash_room_store,
+)
 from src.room_store.redis_room_store import RedisRoomStore, create_redis_room_store
+from src.room_store.redis_stream_room_store import (
+    RedisStreamRoomStore,
+    create_redis_stream_room_store,
+)
 
 
 @pytest.fixture(autouse=True)
@@ -55,6 +63,26 @@ async def redis_room_store(redis: Redis) -> AsyncIterator[RedisRoomStore]:
         yield room_store
 
 
+@pytest.fixture
+async def batched_redis_room_store(redis: Redis) -> AsyncIterator[RedisRoomStore]:
+    async with create_redis_room_store(redis, write_batch_window_seconds=0) as store:
+        yield store
+
+
+@pytest.fixture
+async def redis_hash_room_store(redis: Redis) -> AsyncIterator[RedisHashRoomStore]:
+    async with create_redis_hash_room_store(redis) as room_store:
+        yield room_store
+
+
+@pytest.fixture
+async def redis_stream_room_store(
+    redis: Redis,
+) -> AsyncIterator[RedisStreamRoomStore]:
+    async with create_redis_stream_room_store(redis) as room_store:
+        yield room_store
+
+
 @pytest.fixture
 async def merged_room_store(
     memory_room_store: MemoryRoomStore, memory_room_archive: MemoryRoomArchive
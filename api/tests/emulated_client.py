@@ -191,9 +191,11 @@ class EmulatedClient:
         self,
         input_q: asyncio.Queue[IncomingEvent],
         output_q: asyncio.Queue[OutgoingEvent],
+        subprotocol: str | None = None,
     ):
         self._input_q = input_q
         self._output_q = output_q
+        self.subprotocol = subprotocol
 
     async def send(self, text: str) -> None:
         await self._input_q.put({'type': 'websocket.receive', 'text': text})
@@ -231,6 +233,8 @@ async def connect(
     path: str,
     client_ip: str = '127.0.0.1',
     headers: Mapping[str, str] | None = None,
+    subprotocols: Iterable[str] = (),
+    query_string: str = '',
 ) -> AsyncIterator[EmulatedClient]:
     """Create an emulated client connected to the provided app"""
     headers = {} if headers is None else headers
@@ -244,6 +248,8 @@ async def connect(
         ],
         client=(client_ip, 65535),
         path=path,
+        subprotocols=subprotocols,
+        query_string=query_string.encode('latin-1'),
     )
 
     input_q: asyncio.Queue[IncomingEvent] = asyncio.Queue()
@@ -258,7 +264,8 @@ async def connect(
 
     try:
         if response['type'] == 'websocket.accept':
-            client = EmulatedClient(input_q, output_q)
+            response = cast(Accept, response)
+            client = EmulatedClient(input_q, output_q, response.get('subprotocol'))
             yield client
             await input_q.put({'type': 'websocket.disconnect', 'code': 1000})
             await app_task
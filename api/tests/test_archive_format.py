@@ -0,0 +1,81 @@
+import json
+import zlib
+
+import pytest
+
+from src.api.api_structures import Action, UpsertAction
+from src.api.codec import DecodeError, encode_action
+from src.game_components import IconTokenContents, TextTokenContents, Token
+from src.room_store.archive_format import (
+    FORMAT_ZLIB_COLUMNS,
+    FORMAT_ZLIB_JSON,
+    compress_archive_json,
+    decode_archive,
+    encode_archive,
+)
+from tests.static_fixtures import (
+    ANOTHER_VALID_ACTION,
+    DELETE_VALID_TOKEN,
+    VALID_ACTION,
+    VALID_ACTION_WITH_DUPLICATE_COLOR,
+)
+
+ACTIONS: list[Action] = [
+    VALID_ACTION,
+    ANOTHER_VALID_ACTION,
+    VALID_ACTION_WITH_DUPLICATE_COLOR,
+    UpsertAction(
+        Token('icon_token', 'floor', IconTokenContents('wall'), 1, 2, 3, 4, 5, 6)
+    ),
+    UpsertAction(
+        Token('text_token', 'character', TextTokenContents('a'), -1, -2, 0, 0, 0, 1)
+    ),
+]
+
+
+def test_upserts_stored_as_columns() -> None:
+    archive = encode_archive(ACTIONS)
+    assert archive[0] == FORMAT_ZLIB_COLUMNS
+    assert decode_archive(archive) == ACTIONS
+
+
+def test_empty_room() -> None:
+    assert decode_archive(encode_archive([])) == []
+
+
+def test_other_actions_stored_as_json() -> None:
+    actions: list[Action] = [VALID_ACTION, DELETE_VALID_TOKEN]
+    archive = encode_archive(actions)
+    assert archive[0] == FORMAT_ZLIB_JSON
+    assert decode_archive(archive) == actions
+
+
+def test_encoded_json_compressed() -> None:
+    data = json.dumps(list(map(encode_action, ACTIONS))).encode()
+    archive = compress_archive_json(data)
+    assert archive[0] == FORMAT_ZLIB_JSON
+    assert decode_archive(archive) == ACTIONS
+
+
+def test_plain_json_still_read() -> None:
+    data = json.dumps(list(map(encode_action, ACTIONS))).encode()
+    assert decode_archive(data) == ACTIONS
+
+
+@pytest.mark.parametrize(
+    'archive',
+    [
+        b'',
+        bytes([FORMAT_ZLIB_COLUMNS]) + b'not compressed',
+        bytes([FORMAT_ZLIB_COLUMNS]) + zlib.compress(b'{"ids": ["a"]}'),
+        bytes([FORMAT_ZLIB_COLUMNS])
+        + zlib.compress(
+            b'{"ids": ["a"], "types": ["floor"], "texts": [null], '
+            b'"icon_ids": [null], "positions": [0, 0, 0, 1, 1, 1], "colors": [null]}'
+        ),
+        b'\xff\xfe',
+    ],
+)
+def test_invalid_archive(archive: bytes) -> None:
+    with pytest.raises(DecodeError):
+        decode_archive(archive)
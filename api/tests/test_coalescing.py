@@ -0,0 +1,112 @@
+from dataclasses import replace
+
+from src.api.api_structures import DeleteAction, UpdateResponse, UpsertAction
+from src.coalescing import coalesce_actions, coalesce_updates
+from src.game_components import Token
+from tests.static_fixtures import (
+    ANOTHER_VALID_ACTION,
+    ANOTHER_VALID_TOKEN,
+    DELETE_VALID_TOKEN,
+    PING_ACTION,
+    UPDATED_TOKEN,
+    VALID_ACTION,
+    VALID_TOKEN,
+)
+
+MOVE_ACTION = UpsertAction(UPDATED_TOKEN)
+
+
+def _by_id(*tokens: Token) -> dict[str, Token]:
+    return {token.id: token for token in tokens}
+
+
+def test_last_change_to_token_wins() -> None:
+    assert coalesce_actions([VALID_ACTION, MOVE_ACTION], _by_id(UPDATED_TOKEN)) == [
+        DeleteAction(VALID_TOKEN.id),
+        MOVE_ACTION,
+    ]
+
+
+def test_upsert_then_delete_only_deletes() -> None:
+    assert coalesce_actions(
+        [VALID_ACTION, MOVE_ACTION, DELETE_VALID_TOKEN], _by_id()
+    ) == [DELETE_VALID_TOKEN]
+
+
+def test_rejected_move_leaves_token_where_it_is() -> None:
+    # The token was moved onto another token, so the server kept it where it was
+    colliding_move = UpsertAction(
+        replace(VALID_TOKEN, start_x=1, start_y=1, start_z=1, end_x=2, end_y=2, end_z=2)
+    )
+    assert coalesce_actions(
+        [ANOTHER_VALID_ACTION, MOVE_ACTION, colliding_move],
+        _by_id(ANOTHER_VALID_TOKEN, UPDATED_TOKEN),
+    ) == [
+        DeleteAction(ANOTHER_VALID_TOKEN.id),
+        DeleteAction(VALID_TOKEN.id),
+        ANOTHER_VALID_ACTION,
+        MOVE_ACTION,
+    ]
+
+
+def test_tokens_are_upserted_in_order_of_last_change() -> None:
+    assert coalesce_actions(
+        [VALID_ACTION, ANOTHER_VALID_ACTION, MOVE_ACTION, PING_ACTION],
+        _by_id(UPDATED_TOKEN, ANOTHER_VALID_TOKEN),
+    ) == [
+        DeleteAction(ANOTHER_VALID_TOKEN.id),
+        DeleteAction(VALID_TOKEN.id),
+        ANOTHER_VALID_ACTION,
+        MOVE_ACTION,
+        PING_ACTION,
+    ]
+
+
+def test_single_update_is_unchanged() -> None:
+    update = UpdateResponse([VALID_ACTION, MOVE_ACTION], 'request-1')
+    assert coalesce_updates([update], {'request-1'}, _by_id(UPDATED_TOKEN)) == [update]
+
+
+def test_every_own_request_is_acknowledged() -> None:
+    updates = [
+        UpdateResponse([VALID_ACTION], 'own-1'),
+        UpdateResponse([ANOTHER_VALID_ACTION], 'other'),
+        UpdateResponse([MOVE_ACTION], 'own-2'),
+    ]
+    assert coalesce_updates(
+        updates, {'own-1', 'own-2'}, _by_id(UPDATED_TOKEN, ANOTHER_VALID_TOKEN)
+    ) == [
+        UpdateResponse(
+            [
+                DeleteAction(ANOTHER_VALID_TOKEN.id),
+                DeleteAction(VALID_TOKEN.id),
+                ANOTHER_VALID_ACTION,
+                MOVE_ACTION,
+            ],
+            'own-1',
+        ),
+        UpdateResponse([], 'own-2'),
+    ]
+
+
+def test_updates_without_own_requests_are_merged_into_one() -> None:
+    updates = [
+        UpdateResponse([VALID_ACTION], 'other-1'),
+        UpdateResponse([DELETE_VALID_TOKEN], 'other-2'),
+    ]
+    assert coalesce_updates(updates, set(), _by_id()) == [
+        UpdateResponse([DELETE_VALID_TOKEN], 'other-2')
+    ]
+
+
+def test_updates_have_version_of_last_update() -> None:
+    updates = [
+        UpdateResponse([VALID_ACTION], 'own-1', version=1),
+        UpdateResponse([ANOTHER_VALID_ACTION], 'own-2', version=2),
+    ]
+    assert [
+        update.version
+        for update in coalesce_updates(
+            updates, {'own-1', 'own-2'}, _by_id(VALID_TOKEN, ANOTHER_VALID_TOKEN)
+        )
+    ] == [2, 2]
@@ -1,19 +1,33 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import timedelta
+from typing import Any
 
 import pytest
 import time_machine
+from pytest_mock import MockerFixture
 
 from src.api.api_structures import (
     Request,
     UpsertAction,
 )
 from src.colors import colors
-from src.compaction import ARCHIVE_WHEN_IDLE_SECONDS, Compactor
+from src.compaction import (
+    ARCHIVE_WHEN_IDLE_SECONDS,
+    FULL_COMPACTION_INTERVAL_SECONDS,
+    CompactionResult,
+    CompactionStats,
+    Compactor,
+)
 from src.game_components import Token
 from src.room_store.memory_room_archive import MemoryRoomArchive
 from src.room_store.memory_room_store import MemoryRoomStorage, MemoryRoomStore
 from src.room_store.room_archive import RoomArchive
-from src.room_store.room_store import RoomStore
+from src.room_store.room_store import (
+    COMPACTION_LOCK_EXPIRATION_SECONDS,
+    RoomStore,
+    UnexpectedReplacementId,
+)
 from tests.static_fixtures import (
     DELETE_REQUEST,
     TEST_ROOM_ID,
@@ -28,7 +42,7 @@ TEST_COMPACTOR_ID = 'compactor_1'
 
 @pytest.fixture
 def room_store() -> RoomStore:
-    return MemoryRoomStore(MemoryRoomStorage())
+    return MemoryRoomStore(MemoryRoomStorage(), eager_compaction_length=2)
 
 
 @pytest.fixture
@@ -131,3 +145,218 @@ async def test_compacts_room_before_archiving(
         await compactor._compact_room(TEST_ROOM_ID)
         assert not await room_store.room_exists(TEST_ROOM_ID)
         assert await room_archive.read(TEST_ROOM_ID) == [UpsertAction(UPDATED_TOKEN)]
+
+
+async def test_archives_room_known_to_be_idle(
+    compactor: Compactor, room_store: RoomStore, room_archive: RoomArchive
+) -> None:
+    await room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+    await room_store.acquire_replacement_lock(TEST_COMPACTOR_ID)
+    await compactor._compact_room(TEST_ROOM_ID, is_idle=True)
+    assert not await room_store.room_exists(TEST_ROOM_ID)
+    assert await room_archive.room_exists(TEST_ROOM_ID)
+
+
+async def test_compaction_cycle_only_compacts_dirty_rooms(
+    compactor: Compactor, room_store: RoomStore
+) -> None:
+    await room_store.acquire_replacement_lock(TEST_COMPACTOR_ID)
+    await room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+    await room_store.add_request(TEST_ROOM_ID, VALID_MOVE_REQUEST)
+    await compactor._compaction_cycle()
+
+    await room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+    await room_store.add_request('other_room', VALID_REQUEST)
+    await room_store.add_request('other_room', VALID_MOVE_REQUEST)
+    await room_store.drain_dirty_room_ids()
+    await room_store.add_request(TEST_ROOM_ID, DELETE_REQUEST)
+    await compactor._compaction_cycle()
+
+    assert (await room_store.read_for_replacement(TEST_ROOM_ID)).actions == []
+    assert len(list((await room_store.read_for_replacement('other_room')).actions)) == 2
+
+
+async def test_compaction_cycle_falls_back_to_full_sweep(
+    compactor: Compactor, room_store: RoomStore
+) -> None:
+    with time_machine.travel('1970-01-01') as traveller:
+        await room_store.acquire_replacement_lock(TEST_COMPACTOR_ID)
+        await compactor._compaction_cycle()
+
+        traveller.shift(timedelta(seconds=FULL_COMPACTION_INTERVAL_SECONDS))
+        await room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+        await room_store.add_request(TEST_ROOM_ID, VALID_MOVE_REQUEST)
+        await room_store.drain_dirty_room_ids()
+        await room_store.acquire_replacement_lock(TEST_COMPACTOR_ID)
+        await compactor._compaction_cycle()
+        assert await room_store.read(TEST_ROOM_ID) == [UpsertAction(UPDATED_TOKEN)]
+
+
+async def test_full_sweep_looks_up_idle_time_of_rooms_not_known_to_be_idle(
+    compactor: Compactor, room_store: RoomStore, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    await room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+    await room_store.acquire_replacement_lock(TEST_COMPACTOR_ID)
+    looked_up_room_ids = []
+    get_room_idle_seconds = room_store.get_room_idle_seconds
+
+    async def record_lookup(room_id: str, read_only: bool = False) -> int:
+        looked_up_room_ids.append(room_id)
+        return await get_room_idle_seconds(room_id, read_only)
+
+    monkeypatch.setattr(room_store, 'get_room_idle_seconds', record_lookup)
+    await compactor._compaction_cycle()
+
+    assert looked_up_room_ids == [TEST_ROOM_ID]
+
+
+async def test_compaction_cycle_compacts_rooms_concurrently(
+    room_store: RoomStore, room_archive: RoomArchive
+) -> None:
+    compactor = Compactor(room_store, room_archive, TEST_COMPACTOR_ID, concurrency=3)
+    room_ids = [f'room_{i}' for i in range(10)]
+    for room_id in room_ids:
+        await room_store.add_request(room_id, VALID_REQUEST)
+        await room_store.add_request(room_id, VALID_MOVE_REQUEST)
+    await room_store.add_request('empty_room', VALID_REQUEST)
+    await room_store.add_request('empty_room', DELETE_REQUEST)
+
+    await room_store.acquire_replacement_lock(TEST_COMPACTOR_ID)
+    stats = CompactionStats()
+    await compactor._compaction_cycle(stats)
+
+    for room_id in room_ids:
+        assert await room_store.read(room_id) == [UpsertAction(UPDATED_TOKEN)]
+    assert not await room_store.room_exists('empty_room')
+    assert stats.rooms_by_result == {
+        CompactionResult.COMPACTED: 10,
+        CompactionResult.DELETED: 1,
+    }
+
+
+async def test_compaction_cycle_stops_when_lock_lost(
+    compactor: Compactor, room_store: RoomStore
+) -> None:
+    await room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+    await room_store.acquire_replacement_lock('other_compactor', force=True)
+    with pytest.raises(ExceptionGroup) as e:
+        await compactor._compaction_cycle()
+    assert e.group_contains(UnexpectedReplacementId)
+
+
+async def test_failed_compaction_cycle_keeps_rooms_dirty(
+    compactor: Compactor, room_store: RoomStore
+) -> None:
+    await room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+    await room_store.add_request('other_room', VALID_REQUEST)
+    await room_store.acquire_replacement_lock(TEST_COMPACTOR_ID)
+    await compactor._compaction_cycle()
+
+    await room_store.add_request(TEST_ROOM_ID, VALID_MOVE_REQUEST)
+    await room_store.add_request('other_room', VALID_MOVE_REQUEST)
+    await room_store.acquire_replacement_lock('other_compactor', force=True)
+    with pytest.raises(ExceptionGroup):
+        await compactor._compaction_cycle()
+
+    assert await room_store.drain_dirty_room_ids() == {TEST_ROOM_ID, 'other_room'}
+
+
+async def test_compacts_in_executor(
+    room_store: RoomStore, room_archive: RoomArchive
+) -> None:
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        compactor = Compactor(
+            room_store, room_archive, TEST_COMPACTOR_ID, executor=executor
+        )
+        await room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+        await room_store.add_request(TEST_ROOM_ID, VALID_MOVE_REQUEST)
+        await room_store.add_request('empty_room', VALID_REQUEST)
+        await room_store.add_request('empty_room', DELETE_REQUEST)
+        await room_store.add_request('idle_room', VALID_REQUEST)
+        await room_store.acquire_replacement_lock(TEST_COMPACTOR_ID)
+
+        await compactor._compact_room(TEST_ROOM_ID, is_idle=False)
+        await compactor._compact_room('empty_room', is_idle=False)
+        await compactor._compact_room('idle_room', is_idle=True)
+
+    assert await room_store.read(TEST_ROOM_ID) == [UpsertAction(UPDATED_TOKEN)]
+    assert not await room_store.room_exists('empty_room')
+    assert not await room_store.room_exists('idle_room')
+    assert await room_archive.read('idle_room') == [UpsertAction(VALID_TOKEN)]
+
+
+async def test_dry_run_changes_nothing(
+    room_store: RoomStore, room_archive: RoomArchive
+) -> None:
+    compactor = Compactor(room_store, room_archive, TEST_COMPACTOR_ID, dry_run=True)
+    with time_machine.travel('1970-01-01') as traveller:
+        await room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+        await room_store.add_request(TEST_ROOM_ID, VALID_MOVE_REQUEST)
+        await room_store.add_request('idle_room', VALID_REQUEST)
+        traveller.shift(timedelta(seconds=ARCHIVE_WHEN_IDLE_SECONDS + 1))
+        await room_store.add_request(TEST_ROOM_ID, DELETE_REQUEST)
+
+        stats = CompactionStats()
+        await compactor._compaction_cycle(stats)
+
+    assert stats.rooms_by_result == {
+        CompactionResult.DELETED: 1,
+        CompactionResult.ARCHIVED: 1,
+    }
+    assert len(list(await room_store.read(TEST_ROOM_ID))) == 3
+    assert await room_store.room_exists('idle_room')
+    assert not await room_archive.room_exists('idle_room')
+    assert await room_store.drain_dirty_room_ids() == {TEST_ROOM_ID, 'idle_room'}
+
+
+async def test_compact_oversized_rooms(
+    compactor: Compactor, room_store: RoomStore
+) -> None:
+    await room_store.acquire_replacement_lock(TEST_COMPACTOR_ID)
+    await room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+    await room_store.add_request(TEST_ROOM_ID, VALID_MOVE_REQUEST)
+    await room_store.add_request('other_room', VALID_REQUEST)
+
+    stats = CompactionStats()
+    await compactor._compact_oversized_rooms(stats)
+
+    assert stats.rooms_by_result == {CompactionResult.COMPACTED: 1}
+    assert await room_store.read(TEST_ROOM_ID) == [UpsertAction(UPDATED_TOKEN)]
+    assert await room_store.drain_oversized_room_ids() == set()
+
+
+async def test_compact_oversized_rooms_marks_rooms_dirty_on_failure(
+    compactor: Compactor, room_store: RoomStore
+) -> None:
+    await room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+    await room_store.add_request(TEST_ROOM_ID, VALID_MOVE_REQUEST)
+    await room_store.drain_dirty_room_ids()
+
+    with pytest.raises(ExceptionGroup):
+        await compactor._compact_oversized_rooms()
+
+    assert await room_store.drain_dirty_room_ids() == {TEST_ROOM_ID}
+
+
+async def test_oversized_rooms_compacted_between_cycles_while_holding_lock(
+    compactor: Compactor, room_store: RoomStore, mocker: MockerFixture
+) -> None:
+    with time_machine.travel('1970-01-01', tick=False) as traveller:
+
+        async def sleep(seconds: float, *args: Any, **kwargs: Any) -> None:
+            traveller.shift(timedelta(seconds=seconds))
+
+        mocker.patch('asyncio.sleep', sleep)
+
+        await room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+        await room_store.add_request(TEST_ROOM_ID, VALID_MOVE_REQUEST)
+        await compactor._compact_oversized_rooms_until(time.monotonic() + 60)
+        # Without the lock, the room is left for whoever holds it
+        assert len(list(await room_store.read(TEST_ROOM_ID))) == 2
+
+        await room_store.acquire_replacement_lock(TEST_COMPACTOR_ID)
+        compactor._lock_expire_time = (
+            time.monotonic() + COMPACTION_LOCK_EXPIRATION_SECONDS
+        )
+        await compactor._compact_oversized_rooms_until(time.monotonic() + 60)
+        assert await room_store.read(TEST_ROOM_ID) == [UpsertAction(UPDATED_TOKEN)]
@@ -0,0 +1,237 @@
+import errno
+import os
+import time
+from datetime import timedelta
+from pathlib import Path
+
+import pytest
+import time_machine
+from pytest_mock import MockerFixture
+from redis.asyncio.client import Redis
+
+from src.room_store.archive_format import encode_archive
+from src.room_store.common import NoSuchRoomError
+from src.room_store.disk_cached_room_archive import (
+    RESCAN_INTERVAL_SECONDS,
+    STALE_TEMP_FILE_SECONDS,
+    DiskCachedRoomArchive,
+)
+from src.room_store.indexed_room_archive import IndexedRoomArchive
+from src.room_store.memory_room_archive import MemoryRoomArchive
+from tests.static_fixtures import (
+    ANOTHER_VALID_ACTION,
+    TEST_ROOM_ID,
+    VALID_ACTION,
+)
+
+
+@pytest.fixture
+def cached_room_archive(
+    memory_room_archive: MemoryRoomArchive, tmp_path: Path
+) -> DiskCachedRoomArchive:
+    return DiskCachedRoomArchive(memory_room_archive, tmp_path)
+
+
+def _cached_files(directory: Path) -> list[Path]:
+    return [path for path in directory.glob('*/*')]
+
+
+async def test_read_is_cached(
+    cached_room_archive: DiskCachedRoomArchive,
+    memory_room_archive: MemoryRoomArchive,
+    tmp_path: Path,
+) -> None:
+    await memory_room_archive.write(TEST_ROOM_ID, [VALID_ACTION])
+    assert await cached_room_archive.read(TEST_ROOM_ID) == [VALID_ACTION]
+    assert len(_cached_files(tmp_path)) == 1
+    assert await cached_room_archive.read(TEST_ROOM_ID) == [VALID_ACTION]
+
+
+async def test_changed_room_read_again(
+    cached_room_archive: DiskCachedRoomArchive, memory_room_archive: MemoryRoomArchive
+) -> None:
+    await memory_room_archive.write(TEST_ROOM_ID, [VALID_ACTION])
+    await cached_room_archive.read(TEST_ROOM_ID)
+
+    # e.g. archived again by another server
+    await memory_room_archive.write(TEST_ROOM_ID, [ANOTHER_VALID_ACTION])
+    assert await cached_room_archive.read(TEST_ROOM_ID) == [ANOTHER_VALID_ACTION]
+
+
+async def test_writes_go_through(
+    cached_room_archive: DiskCachedRoomArchive,
+    memory_room_archive: MemoryRoomArchive,
+    tmp_path: Path,
+) -> None:
+    await cached_room_archive.write(TEST_ROOM_ID, [VALID_ACTION])
+    await cached_room_archive.write_raw('raw_room', b'[]')
+
+    assert await memory_room_archive.read(TEST_ROOM_ID) == [VALID_ACTION]
+    assert await memory_room_archive.read('raw_room') == []
+    assert len(_cached_files(tmp_path)) == 2
+
+
+async def test_delete_goes_through(
+    cached_room_archive: DiskCachedRoomArchive,
+    memory_room_archive: MemoryRoomArchive,
+    tmp_path: Path,
+) -> None:
+    await cached_room_archive.write(TEST_ROOM_ID, [VALID_ACTION])
+    await cached_room_archive.delete(TEST_ROOM_ID)
+
+    assert not await memory_room_archive.room_exists(TEST_ROOM_ID)
+    assert _cached_files(tmp_path) == []
+    with pytest.raises(NoSuchRoomError):
+        await cached_room_archive.read(TEST_ROOM_ID)
+
+
+async def test_room_deleted_elsewhere_not_read_from_cache(
+    cached_room_archive: DiskCachedRoomArchive,
+    memory_room_archive: MemoryRoomArchive,
+    tmp_path: Path,
+) -> None:
+    await cached_room_archive.write(TEST_ROOM_ID, [VALID_ACTION])
+    await memory_room_archive.delete(TEST_ROOM_ID)
+
+    with pytest.raises(NoSuchRoomError):
+        await cached_room_archive.read(TEST_ROOM_ID)
+    assert _cached_files(tmp_path) == []
+
+
+async def test_least_recently_used_rooms_evicted(
+    memory_room_archive: MemoryRoomArchive, tmp_path: Path
+) -> None:
+    room_size = len(encode_archive([VALID_ACTION]))
+    # Room for two rooms and their ETags and checksums, but not three
+    cached_room_archive = DiskCachedRoomArchive(
+        memory_room_archive, tmp_path, max_bytes=(room_size + 200) * 2
+    )
+    await cached_room_archive.write('room_1', [VALID_ACTION])
+    await cached_room_archive.write('room_2', [VALID_ACTION])
+    await cached_room_archive.read('room_1')
+    await cached_room_archive.write('room_3', [VALID_ACTION])
+
+    reloaded = DiskCachedRoomArchive(memory_room_archive, tmp_path)
+    assert reloaded._sizes_by_path.keys() == {
+        cached_room_archive._path('room_1'),
+        cached_room_archive._path('room_3'),
+    }
+
+
+async def test_corrupted_file_read_again(
+    cached_room_archive: DiskCachedRoomArchive,
+    memory_room_archive: MemoryRoomArchive,
+    tmp_path: Path,
+) -> None:
+    await cached_room_archive.write(TEST_ROOM_ID, [VALID_ACTION])
+    (cached_file,) = _cached_files(tmp_path)
+    cached_file.write_bytes(cached_file.read_bytes()[:-1])
+
+    assert await cached_room_archive.read(TEST_ROOM_ID) == [VALID_ACTION]
+    assert await cached_room_archive.read(TEST_ROOM_ID) == [VALID_ACTION]
+
+
+async def test_cache_kept_across_restarts(
+    cached_room_archive: DiskCachedRoomArchive,
+    memory_room_archive: MemoryRoomArchive,
+    tmp_path: Path,
+) -> None:
+    await cached_room_archive.write(TEST_ROOM_ID, [VALID_ACTION])
+    (tmp_path / 'ab').mkdir()
+    stale_temp_file = tmp_path / 'ab' / 'abc.1234.tmp'
+    stale_temp_file.write_bytes(b'half written')
+    stale_time = time.time() - STALE_TEMP_FILE_SECONDS - 1
+    os.utime(stale_temp_file, (stale_time, stale_time))
+    # Being written by another process sharing the cache
+    (tmp_path / 'ab' / 'abc.5678.tmp').write_bytes(b'half written')
+
+    reloaded = DiskCachedRoomArchive(memory_room_archive, tmp_path)
+    assert len(_cached_files(tmp_path)) == 2
+    assert not stale_temp_file.exists()
+    assert await reloaded.read(TEST_ROOM_ID) == [VALID_ACTION]
+
+
+async def test_cache_shared_between_processes_stays_within_max_bytes(
+    memory_room_archive: MemoryRoomArchive, tmp_path: Path
+) -> None:
+    room_size = len(encode_archive([VALID_ACTION]))
+    max_bytes = (room_size + 200) * 2
+    with time_machine.travel('1970-01-01', tick=False) as traveller:
+        processes = [
+            DiskCachedRoomArchive(memory_room_archive, tmp_path, max_bytes=max_bytes)
+            for _ in range(2)
+        ]
+        for i, process in enumerate(processes):
+            await process.write(f'room_{i}_1', [VALID_ACTION])
+            await process.write(f'room_{i}_2', [VALID_ACTION])
+        # Neither process has seen the other's files yet
+        assert len(_cached_files(tmp_path)) == 4
+
+        traveller.shift(timedelta(seconds=RESCAN_INTERVAL_SECONDS))
+        await processes[0].write('room_0_3', [VALID_ACTION])
+
+    assert len(_cached_files(tmp_path)) == 2
+
+
+@pytest.mark.parametrize(
+    'failing_function',
+    [
+        'src.room_store.disk_cached_room_archive._write_cache_file',
+        'pathlib.Path.read_bytes',
+        'os.utime',
+    ],
+)
+async def test_cache_errors_dont_fail_reads(
+    cached_room_archive: DiskCachedRoomArchive,
+    memory_room_archive: MemoryRoomArchive,
+    mocker: MockerFixture,
+    failing_function: str,
+) -> None:
+    await cached_room_archive.write(TEST_ROOM_ID, [VALID_ACTION])
+    mocker.patch(
+        failing_function,
+        side_effect=OSError(errno.ENOSPC, 'No space left on device'),
+    )
+
+    await memory_room_archive.write(TEST_ROOM_ID, [ANOTHER_VALID_ACTION])
+    assert await cached_room_archive.read(TEST_ROOM_ID) == [ANOTHER_VALID_ACTION]
+    assert await cached_room_archive.read(TEST_ROOM_ID) == [ANOTHER_VALID_ACTION]
+
+
+async def test_cache_removal_errors_dont_fail_deletes(
+    cached_room_archive: DiskCachedRoomArchive,
+    memory_room_archive: MemoryRoomArchive,
+    mocker: MockerFixture,
+) -> None:
+    await cached_room_archive.write(TEST_ROOM_ID, [VALID_ACTION])
+    mocker.patch.object(
+        Path, 'unlink', side_effect=PermissionError(errno.EACCES, 'Permission denied')
+    )
+
+    await cached_room_archive.delete(TEST_ROOM_ID)
+    assert not await memory_room_archive.room_exists(TEST_ROOM_ID)
+
+
+async def test_unchanged_room_read_without_asking_the_archive(
+    memory_room_archive: MemoryRoomArchive,
+    redis: Redis,
+    tmp_path: Path,
+    mocker: MockerFixture,
+) -> None:
+    cached_room_archive = DiskCachedRoomArchive(
+        IndexedRoomArchive(memory_room_archive, redis), tmp_path
+    )
+    await cached_room_archive.write(TEST_ROOM_ID, [VALID_ACTION])
+    room_exists = mocker.spy(memory_room_archive, 'room_exists')
+    read_object = mocker.spy(memory_room_archive, 'read_object')
+
+    assert await cached_room_archive.room_exists(TEST_ROOM_ID)
+    assert await cached_room_archive.read(TEST_ROOM_ID) == [VALID_ACTION]
+    room_exists.assert_not_called()
+    read_object.assert_not_called()
+
+    # e.g. archived again by another server, which updates the index
+    await IndexedRoomArchive(memory_room_archive, redis).write(
+        TEST_ROOM_ID, [ANOTHER_VALID_ACTION]
+    )
+    assert await cached_room_archive.read(TEST_ROOM_ID) == [ANOTHER_VALID_ACTION]
@@ -0,0 +1,118 @@
+import asyncio
+from collections.abc import AsyncIterator
+from pathlib import Path
+
+import pytest
+from pytest_mock import MockerFixture
+
+from src.room_store import filesystem_room_archive
+from src.room_store.common import NoSuchRoomError
+from src.room_store.filesystem_room_archive import (
+    FilesystemRoomArchive,
+    create_filesystem_room_archive,
+)
+from src.util.async_util import async_collect
+from tests.static_fixtures import ANOTHER_VALID_ACTION, TEST_ROOM_ID, VALID_ACTION
+
+
+@pytest.fixture
+async def room_archive(
+    tmp_path: Path,
+) -> AsyncIterator[FilesystemRoomArchive]:
+    async with create_filesystem_room_archive(tmp_path) as room_archive:
+        yield room_archive
+
+
+async def test_write_and_read(room_archive: FilesystemRoomArchive) -> None:
+    await room_archive.write(TEST_ROOM_ID, [VALID_ACTION])
+    await room_archive.write_raw('raw_room', b'[]')
+
+    assert await room_archive.room_exists(TEST_ROOM_ID)
+    assert await room_archive.read(TEST_ROOM_ID) == [VALID_ACTION]
+    assert await room_archive.read('raw_room') == []
+
+
+async def test_missing_room(room_archive: FilesystemRoomArchive) -> None:
+    assert not await room_archive.room_exists(TEST_ROOM_ID)
+    with pytest.raises(NoSuchRoomError):
+        await room_archive.read(TEST_ROOM_ID)
+
+
+async def test_delete(room_archive: FilesystemRoomArchive) -> None:
+    await room_archive.write(TEST_ROOM_ID, [VALID_ACTION])
+    await room_archive.delete(TEST_ROOM_ID)
+    await room_archive.delete('never_archived_room')
+    assert not await room_archive.room_exists(TEST_ROOM_ID)
+
+
+async def test_get_all_room_ids(
+    room_archive: FilesystemRoomArchive,
+) -> None:
+    room_ids = {'room-1', 'room-2', 'room/with/slashes'}
+    for room_id in room_ids:
+        await room_archive.write(room_id, [VALID_ACTION])
+
+    assert set(await async_collect(room_archive.get_all_room_ids())) == (room_ids)
+
+
+async def test_get_all_room_ids_skips_stray_files(
+    room_archive: FilesystemRoomArchive, tmp_path: Path
+) -> None:
+    await room_archive.write(TEST_ROOM_ID, [VALID_ACTION])
+    (tmp_path / 'stray').write_text('')
+    (outer,) = [path for path in tmp_path.iterdir() if path.is_dir()]
+    (outer / 'stray').write_text('')
+
+    assert await async_collect(room_archive.get_all_room_ids()) == [TEST_ROOM_ID]
+
+
+async def test_rooms_sharded_into_directories(
+    room_archive: FilesystemRoomArchive, tmp_path: Path
+) -> None:
+    await room_archive.write(TEST_ROOM_ID, [VALID_ACTION])
+    (room_file,) = [path for path in tmp_path.rglob('*') if path.is_file()]
+    assert room_file.relative_to(tmp_path).parts[2] == TEST_ROOM_ID
+
+
+async def test_read_object_matches_etag(
+    room_archive: FilesystemRoomArchive,
+) -> None:
+    await room_archive.write(TEST_ROOM_ID, [VALID_ACTION])
+    archive_object = await room_archive.read_object(TEST_ROOM_ID)
+    assert archive_object is not None
+    assert await room_archive.read_object(TEST_ROOM_ID, archive_object.etag) is None
+
+    await room_archive.write(TEST_ROOM_ID, [ANOTHER_VALID_ACTION])
+    assert await room_archive.read_object(TEST_ROOM_ID, archive_object.etag)
+
+
+async def test_concurrent_changes_synced_together(
+    room_archive: FilesystemRoomArchive, mocker: MockerFixture
+) -> None:
+    apply_changes = mocker.spy(filesystem_room_archive, '_apply_changes')
+
+    await asyncio.gather(
+        room_archive.write(TEST_ROOM_ID, [VALID_ACTION]),
+        room_archive.write('other_room', [VALID_ACTION]),
+        room_archive.delete('deleted_room'),
+    )
+
+    assert apply_changes.call_count == 1
+    assert await room_archive.room_exists(TEST_ROOM_ID)
+    assert await room_archive.room_exists('other_room')
+
+
+async def test_last_change_to_a_room_wins(
+    room_archive: FilesystemRoomArchive,
+) -> None:
+    await asyncio.gather(
+        room_archive.write(TEST_ROOM_ID, [VALID_ACTION]),
+        room_archive.write(TEST_ROOM_ID, [ANOTHER_VALID_ACTION]),
+    )
+    assert await room_archive.read(TEST_ROOM_ID) == [ANOTHER_VALID_ACTION]
+
+    await asyncio.gather(
+        room_archive.write(TEST_ROOM_ID, [VALID_ACTION]),
+        room_archive.delete(TEST_ROOM_ID),
+    )
+    assert not await room_archive.room_exists(TEST_ROOM_ID)
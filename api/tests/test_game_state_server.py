@@ -1,6 +1,7 @@
 import asyncio
 
 import pytest
+from pytest_mock import MockerFixture
 
 from src.api.api_structures import (
     ConnectionResponse,
@@ -11,10 +12,11 @@ from src.api.api_structures import (
     UpdateResponse,
 )
 from src.game_components import Ping
-from src.game_state_server import GameStateServer
+from src.game_state_server import GameStateServer, InvalidConnectionException
 from src.rate_limit.memory_rate_limit import MemoryRateLimiter, MemoryRateLimiterStorage
 from src.rate_limit.noop_rate_limit import NoopRateLimiter
-from src.rate_limit.rate_limit import RateLimiter
+from src.rate_limit.rate_limit import RateLimiter, TooManyRoomsCreatedException
+from src.room_cache import RoomCache
 from src.room_store.memory_room_archive import MemoryRoomArchive
 from src.room_store.memory_room_store import MemoryRoomStorage, MemoryRoomStore
 from src.room_store.merged_room_store import MergedRoomStore
@@ -47,7 +49,9 @@ def rate_limiter() -> RateLimiter:
 
 @pytest.fixture
 def gss(room_store: RoomStore, rate_limiter: RateLimiter) -> GameStateServer:
-    return GameStateServer(room_store, rate_limiter, NoopRateLimiter())
+    return GameStateServer(
+        room_store, RoomCache(room_store), rate_limiter, NoopRateLimiter()
+    )
 
 
 def errors(responses: list[Response]) -> list[Response]:
@@ -65,6 +69,7 @@ async def collect_responses(
     requests: list[Request],
     response_count: int,
     room_id: str = TEST_ROOM_ID,
+    last_seen_version: int | None = None,
 ) -> list[Response]:
     disconnect_event = asyncio.Event()
     try:
@@ -73,6 +78,7 @@ async def collect_responses(
                 room_id,
                 '127.0.0.1',
                 to_async_until(requests, disconnect_event),
+                last_seen_version=last_seen_version,
             ),
             response_count,
         )
@@ -90,7 +96,9 @@ async def test_new_connection(gss: GameStateServer) -> None:
 async def test_room_data_is_stored(
     room_store: RoomStore, rate_limiter: RateLimiter
 ) -> None:
-    gss_one = GameStateServer(room_store, rate_limiter, NoopRateLimiter())
+    gss_one = GameStateServer(
+        room_store, RoomCache(room_store), rate_limiter, NoopRateLimiter()
+    )
     responses = await collect_responses(
         gss_one,
         requests=[
@@ -107,11 +115,27 @@ async def test_room_data_is_stored(
         UpdateResponse([VALID_ACTION, ANOTHER_VALID_ACTION], 'first-request-id'),
     ]
 
-    gss_two = GameStateServer(room_store, rate_limiter, NoopRateLimiter())
+    gss_two = GameStateServer(
+        room_store, RoomCache(room_store), rate_limiter, NoopRateLimiter()
+    )
     responses = await collect_responses(gss_two, requests=[], response_count=1)
     assert responses == [ConnectionResponse([VALID_TOKEN, ANOTHER_VALID_TOKEN])]
 
 
+async def test_rejected_connection_unsubscribes_from_room(
+    room_store: RoomStore, rate_limiter: RateLimiter, mocker: MockerFixture
+) -> None:
+    room_cache = RoomCache(room_store)
+    gss = GameStateServer(room_store, room_cache, rate_limiter, NoopRateLimiter())
+    mocker.patch.object(
+        rate_limiter, 'acquire_new_room', side_effect=TooManyRoomsCreatedException
+    )
+
+    with pytest.raises(InvalidConnectionException):
+        await collect_responses(gss, requests=[], response_count=1)
+    assert room_cache._subscriptions == {}
+
+
 async def test_ping(gss: GameStateServer) -> None:
     responses = await collect_responses(
         gss,
@@ -161,3 +185,97 @@ async def test_add_duplicate_color(gss: GameStateServer) -> None:
             [VALID_ACTION, VALID_ACTION_WITH_DUPLICATE_COLOR], 'same-color-request-id'
         ),
     ]
+
+
+async def test_pipelines_writes(
+    room_store: RoomStore, rate_limiter: RateLimiter, mocker: MockerFixture
+) -> None:
+    gss = GameStateServer(
+        room_store,
+        RoomCache(room_store),
+        rate_limiter,
+        NoopRateLimiter(),
+        max_writes_in_flight=2,
+    )
+    add_request = room_store.add_request
+    writes_started = []
+    finish_writes = asyncio.Event()
+
+    async def slow_add_request(room_id: str, request: Request) -> None:
+        writes_started.append(request.request_id)
+        await finish_writes.wait()
+        await add_request(room_id, request)
+
+    mocker.patch.object(room_store, 'add_request', slow_add_request)
+    requests = [Request(f'request-{i}', [PING_ACTION]) for i in range(3)]
+    responses_task = asyncio.create_task(
+        collect_responses(gss, requests, response_count=4)
+    )
+    for _ in range(10):
+        await asyncio.sleep(0)
+    # The last request waits for one of the others to be written
+    assert writes_started == ['request-0', 'request-1']
+
+    finish_writes.set()
+    responses = await responses_task
+    assert updates(responses) == [
+        UpdateResponse([PING_ACTION], f'request-{i}') for i in range(3)
+    ]
+
+
+async def test_reconnect_is_sent_missed_updates(
+    gss: GameStateServer, room_store: RoomStore
+) -> None:
+    _, update = await collect_responses(
+        gss, requests=[Request('first-request-id', [VALID_ACTION])], response_count=2
+    )
+    await room_store.add_request(
+        TEST_ROOM_ID, Request('missed-request-id', [ANOTHER_VALID_ACTION])
+    )
+
+    assert isinstance(update, UpdateResponse)
+    responses = await collect_responses(
+        gss, requests=[], response_count=1, last_seen_version=update.version
+    )
+    assert responses == [UpdateResponse([ANOTHER_VALID_ACTION], 'missed-request-id')]
+
+
+async def test_reconnect_is_sent_room_if_updates_are_missing(
+    gss: GameStateServer, room_store: RoomStore
+) -> None:
+    await room_store.add_request(TEST_ROOM_ID, Request('request-id', [VALID_ACTION]))
+    responses = await collect_responses(
+        gss, requests=[], response_count=1, last_seen_version=0
+    )
+    assert responses == [ConnectionResponse([VALID_TOKEN])]
+
+
+async def test_missed_updates_are_not_sent_twice(
+    room_store: RoomStore, rate_limiter: RateLimiter, mocker: MockerFixture
+) -> None:
+    room_cache = RoomCache(room_store)
+    gss = GameStateServer(room_store, room_cache, rate_limiter, NoopRateLimiter())
+    await room_store.add_request(TEST_ROOM_ID, Request('request-id', [VALID_ACTION]))
+    version = (await room_store.read_with_version(TEST_ROOM_ID)).version
+    assert version is not None
+
+    read_updates_since = room_cache.read_updates_since
+
+    async def add_then_read(room_id: str, version: int) -> list[UpdateResponse] | None:
+        # The update is queued for the connection, and is also in what's read
+        await room_store.add_request(
+            room_id, Request('missed-request-id', [ANOTHER_VALID_ACTION])
+        )
+        return await read_updates_since(room_id, version)
+
+    mocker.patch.object(room_cache, 'read_updates_since', add_then_read)
+    responses = await collect_responses(
+        gss,
+        requests=[Request('ping-request-id', [PING_ACTION])],
+        response_count=2,
+        last_seen_version=version,
+    )
+    assert responses == [
+        UpdateResponse([ANOTHER_VALID_ACTION], 'missed-request-id'),
+        UpdateResponse([PING_ACTION], 'ping-request-id'),
+    ]
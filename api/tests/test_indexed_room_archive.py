@@ -0,0 +1,137 @@
+import json
+
+import pytest
+from pytest_mock import MockerFixture
+from redis.asyncio.client import Redis
+
+from src.api.codec import encode_action
+from src.room_store.archive_format import encode_archive
+from src.room_store.indexed_room_archive import IndexedRoomArchive
+from src.room_store.memory_room_archive import MemoryRoomArchive
+from tests.static_fixtures import ANOTHER_VALID_ACTION, TEST_ROOM_ID, VALID_ACTION
+
+
+@pytest.fixture
+def indexed_room_archive(
+    memory_room_archive: MemoryRoomArchive, redis: Redis
+) -> IndexedRoomArchive:
+    return IndexedRoomArchive(memory_room_archive, redis)
+
+
+async def test_missing_room_not_looked_up_once_indexed(
+    indexed_room_archive: IndexedRoomArchive,
+    memory_room_archive: MemoryRoomArchive,
+    mocker: MockerFixture,
+) -> None:
+    room_exists = mocker.spy(memory_room_archive, 'room_exists')
+    assert not await indexed_room_archive.room_exists(TEST_ROOM_ID)
+    assert room_exists.call_count == 1
+
+    await indexed_room_archive.index_if_missing()
+    assert not await indexed_room_archive.room_exists(TEST_ROOM_ID)
+    assert room_exists.call_count == 1
+
+
+async def test_index_includes_previously_archived_rooms(
+    indexed_room_archive: IndexedRoomArchive, memory_room_archive: MemoryRoomArchive
+) -> None:
+    await memory_room_archive.write(TEST_ROOM_ID, [VALID_ACTION])
+    await indexed_room_archive.index_if_missing()
+    assert await indexed_room_archive.room_exists(TEST_ROOM_ID)
+
+
+async def test_index_follows_writes_and_deletes(
+    indexed_room_archive: IndexedRoomArchive,
+) -> None:
+    await indexed_room_archive.index_if_missing()
+
+    await indexed_room_archive.write(TEST_ROOM_ID, [VALID_ACTION])
+    await indexed_room_archive.write_raw('raw_room', b'[]')
+    assert await indexed_room_archive.room_exists(TEST_ROOM_ID)
+    assert await indexed_room_archive.room_exists('raw_room')
+
+    await indexed_room_archive.delete(TEST_ROOM_ID)
+    assert not await indexed_room_archive.room_exists(TEST_ROOM_ID)
+
+
+async def test_indexed_room_still_checked_in_archive(
+    indexed_room_archive: IndexedRoomArchive, memory_room_archive: MemoryRoomArchive
+) -> None:
+    await memory_room_archive.write(TEST_ROOM_ID, [VALID_ACTION])
+    await indexed_room_archive.index_if_missing()
+    # e.g. deleted by something that doesn't know about the index
+    await memory_room_archive.delete(TEST_ROOM_ID)
+    assert not await indexed_room_archive.room_exists(TEST_ROOM_ID)
+
+
+async def test_room_written_through_index_not_looked_up(
+    indexed_room_archive: IndexedRoomArchive,
+    memory_room_archive: MemoryRoomArchive,
+    mocker: MockerFixture,
+) -> None:
+    await indexed_room_archive.index_if_missing()
+    etag = await indexed_room_archive.write_object(
+        TEST_ROOM_ID, encode_archive([VALID_ACTION])
+    )
+    room_exists = mocker.spy(memory_room_archive, 'room_exists')
+    read_object = mocker.spy(memory_room_archive, 'read_object')
+
+    assert await indexed_room_archive.room_exists(TEST_ROOM_ID)
+    assert await indexed_room_archive.read_object(TEST_ROOM_ID, etag) is None
+    room_exists.assert_not_called()
+    read_object.assert_not_called()
+
+    archive_object = await indexed_room_archive.read_object(TEST_ROOM_ID, 'other')
+    assert archive_object is not None
+    assert archive_object.etag == etag
+
+
+async def test_index_only_filled_in_once(
+    indexed_room_archive: IndexedRoomArchive,
+    memory_room_archive: MemoryRoomArchive,
+    mocker: MockerFixture,
+) -> None:
+    get_all_room_ids = mocker.spy(memory_room_archive, 'get_all_room_ids')
+    await indexed_room_archive.index_if_missing()
+    await indexed_room_archive.index_if_missing()
+    assert get_all_room_ids.call_count == 1
+
+
+@pytest.mark.parametrize('raw', [False, True])
+async def test_write_keeps_unindexed_archived_actions(
+    indexed_room_archive: IndexedRoomArchive,
+    memory_room_archive: MemoryRoomArchive,
+    raw: bool,
+) -> None:
+    await indexed_room_archive.index_if_missing()
+    # Archived by something that doesn't know about the index, so the room was
+    # read as empty since
+    await memory_room_archive.write(TEST_ROOM_ID, [VALID_ACTION])
+
+    if raw:
+        await indexed_room_archive.write_raw(
+            TEST_ROOM_ID, json.dumps([encode_action(ANOTHER_VALID_ACTION)]).encode()
+        )
+    else:
+        await indexed_room_archive.write(TEST_ROOM_ID, [ANOTHER_VALID_ACTION])
+
+    assert list(await memory_room_archive.read(TEST_ROOM_ID)) == [
+        VALID_ACTION,
+        ANOTHER_VALID_ACTION,
+    ]
+    assert await indexed_room_archive.room_exists(TEST_ROOM_ID)
+
+
+async def test_indexed_room_is_overwritten(
+    indexed_room_archive: IndexedRoomArchive,
+    memory_room_archive: MemoryRoomArchive,
+    mocker: MockerFixture,
+) -> None:
+    await indexed_room_archive.index_if_missing()
+    await indexed_room_archive.write(TEST_ROOM_ID, [VALID_ACTION])
+    read = mocker.spy(memory_room_archive, 'read')
+
+    await indexed_room_archive.write(TEST_ROOM_ID, [ANOTHER_VALID_ACTION])
+
+    assert list(await memory_room_archive.read(TEST_ROOM_ID)) == [ANOTHER_VALID_ACTION]
+    assert read.call_count == 1
@@ -19,3 +19,16 @@ def test_json_to_actions() -> None:
 
 def test_convert_empty_list() -> None:
     assert list(json_to_actions([])) == []
+
+
+def test_convert_requests() -> None:
+    assert list(
+        json_to_actions(
+            [
+                json.dumps(
+                    {'request_id': 'request-1', 'actions': [asdict(VALID_ACTION)]}
+                ),
+                json.dumps([asdict(ANOTHER_VALID_ACTION)]),
+            ]
+        )
+    ) == [VALID_ACTION, ANOTHER_VALID_ACTION]
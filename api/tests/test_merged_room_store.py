@@ -1,3 +1,9 @@
+import asyncio
+
+from pytest_mock import MockerFixture
+
+from src.room_store.memory_room_archive import MemoryRoomArchive
+from src.room_store.memory_room_store import MemoryRoomStorage, MemoryRoomStore
 from src.room_store.merged_room_store import MergedRoomStore
 from src.room_store.room_archive import RoomArchive
 from tests.static_fixtures import TEST_ROOM_ID, VALID_ACTION
@@ -8,3 +14,75 @@ async def test_archived_room_is_loaded(
 ) -> None:
     await memory_room_archive.write(TEST_ROOM_ID, [VALID_ACTION])
     assert await merged_room_store.read(TEST_ROOM_ID) == [VALID_ACTION]
+
+
+async def test_archived_room_is_loaded_once_for_concurrent_reads(
+    merged_room_store: MergedRoomStore,
+    memory_room_archive: MemoryRoomArchive,
+    mocker: MockerFixture,
+) -> None:
+    await memory_room_archive.write(TEST_ROOM_ID, [VALID_ACTION])
+    read_archive = mocker.spy(memory_room_archive, 'read')
+
+    rooms = await asyncio.gather(
+        *(merged_room_store.read(TEST_ROOM_ID) for _ in range(15))
+    )
+
+    assert rooms == [[VALID_ACTION]] * 15
+    assert read_archive.call_count == 1
+
+
+async def test_archived_room_is_loaded_once_across_servers(
+    memory_room_archive: MemoryRoomArchive, mocker: MockerFixture
+) -> None:
+    await memory_room_archive.write(TEST_ROOM_ID, [VALID_ACTION])
+    read_archive = mocker.spy(memory_room_archive, 'read')
+    storage = MemoryRoomStorage()
+    servers = [
+        MergedRoomStore(MemoryRoomStore(storage), memory_room_archive) for _ in range(3)
+    ]
+
+    rooms = await asyncio.gather(*(server.read(TEST_ROOM_ID) for server in servers))
+
+    assert rooms == [[VALID_ACTION]] * 3
+    assert read_archive.call_count == 1
+
+
+async def test_archived_room_is_loaded_if_the_other_loader_fails(
+    merged_room_store: MergedRoomStore,
+    memory_room_store: MemoryRoomStore,
+    memory_room_archive: MemoryRoomArchive,
+) -> None:
+    await memory_room_archive.write(TEST_ROOM_ID, [VALID_ACTION])
+    assert await memory_room_store.acquire_hydration_lock(TEST_ROOM_ID, 'other')
+
+    read = asyncio.create_task(merged_room_store.read(TEST_ROOM_ID))
+    await asyncio.sleep(0)
+    assert not read.done()
+
+    await memory_room_store.release_hydration_lock(TEST_ROOM_ID, 'other')
+    assert await read == [VALID_ACTION]
+
+
+async def test_cancelled_read_does_not_cancel_loading_for_others(
+    merged_room_store: MergedRoomStore, memory_room_archive: MemoryRoomArchive
+) -> None:
+    await memory_room_archive.write(TEST_ROOM_ID, [VALID_ACTION])
+    cancelled_read = asyncio.create_task(merged_room_store.read(TEST_ROOM_ID))
+    other_read = asyncio.create_task(merged_room_store.read(TEST_ROOM_ID))
+    await asyncio.sleep(0)
+
+    cancelled_read.cancel()
+
+    assert await other_read == [VALID_ACTION]
+
+
+async def test_new_room_is_read_without_taking_the_hydration_lock(
+    merged_room_store: MergedRoomStore,
+    memory_room_store: MemoryRoomStore,
+    mocker: MockerFixture,
+) -> None:
+    acquire_lock = mocker.spy(memory_room_store, 'acquire_hydration_lock')
+
+    assert list(await merged_room_store.read(TEST_ROOM_ID)) == []
+    acquire_lock.assert_not_called()
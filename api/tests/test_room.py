@@ -86,3 +86,45 @@ def test_duplicate_colors(room: Room) -> None:
     room.create_or_update_token(VALID_TOKEN)
     room.create_or_update_token(VALID_TOKEN_WITH_DUPLICATE_COLOR)
     assert VALID_TOKEN_WITH_DUPLICATE_COLOR in room.game_state.values()
+
+
+def test_large_floor_blocks_overlapping_tokens(room: Room) -> None:
+    floor = Token(
+        id='floor',
+        type='floor',
+        contents=IconTokenContents('floor_icon'),
+        start_x=0,
+        start_y=0,
+        start_z=0,
+        end_x=200,
+        end_y=200,
+        end_z=1,
+    )
+    room.create_or_update_token(floor)
+    room.create_or_update_token(
+        Token(
+            id='overlapping_floor',
+            type='floor',
+            contents=IconTokenContents('floor_icon'),
+            start_x=150,
+            start_y=150,
+            start_z=0,
+            end_x=151,
+            end_y=151,
+            end_z=1,
+        )
+    )
+    room.create_or_update_token(
+        Token(
+            id='character_on_floor',
+            type='character',
+            contents=IconTokenContents('some_icon'),
+            start_x=150,
+            start_y=150,
+            start_z=1,
+            end_x=151,
+            end_y=151,
+            end_z=2,
+        )
+    )
+    assert list(room.game_state.keys()) == ['floor', 'character_on_floor']
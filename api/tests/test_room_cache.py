@@ -0,0 +1,421 @@
+import asyncio
+from collections.abc import AsyncIterator
+from contextlib import AsyncExitStack
+from dataclasses import replace
+
+import pytest
+from pytest_mock import MockerFixture
+
+from src.api import codec
+from src.api.api_structures import (
+    ConnectionResponse,
+    DeleteAction,
+    Request,
+    UpdateResponse,
+    UpsertAction,
+)
+from src.api.codec import response_frame
+from src.room_cache import RoomCache, SlowConnectionError, SlowConnectionPolicy
+from src.room_store.memory_room_store import MemoryRoomStore
+from src.util.async_util import async_collect, end_task
+from tests.static_fixtures import (
+    ANOTHER_VALID_ACTION,
+    ANOTHER_VALID_TOKEN,
+    DELETE_REQUEST,
+    TEST_ROOM_ID,
+    UPDATED_TOKEN,
+    VALID_ACTION,
+    VALID_MOVE_REQUEST,
+    VALID_REQUEST,
+    VALID_TOKEN,
+)
+
+
+@pytest.fixture
+def room_cache(
+    memory_room_store: MemoryRoomStore, request: pytest.FixtureRequest
+) -> RoomCache:
+    return RoomCache(
+        memory_room_store,
+        max_rooms=2,
+        max_queued_updates=2,
+        slow_connection_policy=getattr(request, 'param', SlowConnectionPolicy.RESYNC),
+    )
+
+
+async def test_reads_room_from_store(
+    room_cache: RoomCache, memory_room_store: MemoryRoomStore
+) -> None:
+    await memory_room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+    async with room_cache.changes(TEST_ROOM_ID):
+        assert await room_cache.read_tokens(TEST_ROOM_ID) == [VALID_TOKEN]
+
+
+async def test_cached_room_is_not_read_again(
+    room_cache: RoomCache, memory_room_store: MemoryRoomStore, mocker: MockerFixture
+) -> None:
+    await memory_room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+    async with room_cache.changes(TEST_ROOM_ID):
+        await room_cache.read_tokens(TEST_ROOM_ID)
+
+        read_spy = mocker.spy(memory_room_store, 'read')
+        assert await room_cache.read_tokens(TEST_ROOM_ID) == [VALID_TOKEN]
+        read_spy.assert_not_called()
+
+
+async def test_connections_share_encoded_updates(
+    room_cache: RoomCache, memory_room_store: MemoryRoomStore, mocker: MockerFixture
+) -> None:
+    async with (
+        room_cache.changes(TEST_ROOM_ID) as changes_1,
+        room_cache.changes(TEST_ROOM_ID) as changes_2,
+    ):
+        await memory_room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+        (update_1,) = await async_collect(changes_1, 1)
+        (update_2,) = await async_collect(changes_2, 1)
+    assert update_1 is update_2
+
+    encode_spy = mocker.spy(codec, 'encode_response')
+    assert response_frame(update_1) == response_frame(update_2)
+    encode_spy.assert_called_once()
+
+
+async def test_cached_room_follows_changes(
+    room_cache: RoomCache, memory_room_store: MemoryRoomStore, mocker: MockerFixture
+) -> None:
+    await memory_room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+    async with room_cache.changes(TEST_ROOM_ID) as changes:
+        await room_cache.read_tokens(TEST_ROOM_ID)
+
+        read_spy = mocker.spy(memory_room_store, 'read')
+        await memory_room_store.add_request(TEST_ROOM_ID, VALID_MOVE_REQUEST)
+        assert await async_collect(changes, 1) == [
+            UpdateResponse(VALID_MOVE_REQUEST.actions, VALID_MOVE_REQUEST.request_id)
+        ]
+        assert await room_cache.read_tokens(TEST_ROOM_ID) == [UPDATED_TOKEN]
+        read_spy.assert_not_called()
+
+
+async def test_cached_room_does_not_share_tokens_with_changes(
+    room_cache: RoomCache, memory_room_store: MemoryRoomStore
+) -> None:
+    async with room_cache.changes(TEST_ROOM_ID) as changes:
+        await room_cache.read_tokens(TEST_ROOM_ID)
+        await memory_room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+        (update,) = await async_collect(changes, 1)
+
+        (token,) = await room_cache.read_tokens(TEST_ROOM_ID)
+    assert isinstance(update, UpdateResponse)
+    (action,) = update.actions
+    assert isinstance(action, UpsertAction)
+    assert token == action.data
+    assert token is not action.data
+
+
+async def test_room_is_dropped_when_last_listener_leaves(
+    room_cache: RoomCache, memory_room_store: MemoryRoomStore, mocker: MockerFixture
+) -> None:
+    async with room_cache.changes(TEST_ROOM_ID):
+        await room_cache.read_tokens(TEST_ROOM_ID)
+
+    read_spy = mocker.spy(memory_room_store, 'read')
+    async with room_cache.changes(TEST_ROOM_ID):
+        await room_cache.read_tokens(TEST_ROOM_ID)
+    read_spy.assert_called_once()
+    assert room_cache._subscriptions == {}
+
+
+async def test_subscription_is_dropped_when_changes_are_never_read(
+    room_cache: RoomCache,
+) -> None:
+    with pytest.raises(ValueError):
+        async with room_cache.changes(TEST_ROOM_ID):
+            raise ValueError('Connection rejected')
+    assert room_cache._subscriptions == {}
+
+
+async def test_replaced_room_is_invalidated(
+    room_cache: RoomCache, memory_room_store: MemoryRoomStore
+) -> None:
+    invalidation_task = asyncio.create_task(room_cache.maintain_invalidation())
+    await memory_room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+    async with room_cache.changes(TEST_ROOM_ID):
+        await room_cache.read_tokens(TEST_ROOM_ID)
+
+        await memory_room_store.acquire_replacement_lock('replacer')
+        replace_data = await memory_room_store.read_for_replacement(TEST_ROOM_ID)
+        await memory_room_store.replace(
+            TEST_ROOM_ID, [], replace_data.replace_token, 'replacer'
+        )
+        await asyncio.sleep(0)
+
+        assert await room_cache.read_tokens(TEST_ROOM_ID) == []
+    await end_task(invalidation_task)
+
+
+async def test_every_room_is_invalidated_when_listening_again(
+    room_cache: RoomCache,
+    memory_room_store: MemoryRoomStore,
+    mocker: MockerFixture,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    invalidations = memory_room_store.invalidations
+    subscribed = asyncio.Event()
+
+    async def invalidations_after_failing() -> AsyncIterator[str]:
+        if not failed:
+            failed.append(True)
+            raise ConnectionError('Lost connection')
+        room_invalidations = await invalidations()
+        subscribed.set()
+        return room_invalidations
+
+    failed: list[bool] = []
+    monkeypatch.setattr(memory_room_store, 'invalidations', invalidations_after_failing)
+    await memory_room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+    async with room_cache.changes(TEST_ROOM_ID):
+        await room_cache.read_tokens(TEST_ROOM_ID)
+        invalidation_task = asyncio.create_task(room_cache.maintain_invalidation())
+        await subscribed.wait()
+
+        read_spy = mocker.spy(memory_room_store, 'read')
+        assert await room_cache.read_tokens(TEST_ROOM_ID) == [VALID_TOKEN]
+        read_spy.assert_called_once()
+    await end_task(invalidation_task)
+
+
+async def test_least_recently_used_room_is_evicted(
+    room_cache: RoomCache, memory_room_store: MemoryRoomStore, mocker: MockerFixture
+) -> None:
+    async with AsyncExitStack() as stack:
+        for room_id in ['room-1', 'room-2', 'room-3']:
+            await stack.enter_async_context(room_cache.changes(room_id))
+            await room_cache.read_tokens(room_id)
+
+        read_spy = mocker.spy(memory_room_store, 'read')
+        await room_cache.read_tokens('room-3')
+        read_spy.assert_not_called()
+        await room_cache.read_tokens('room-1')
+        read_spy.assert_called_once_with('room-1')
+
+
+async def test_uncached_room_is_read_but_not_cached(
+    room_cache: RoomCache, memory_room_store: MemoryRoomStore, mocker: MockerFixture
+) -> None:
+    """Rooms without a subscription can't be kept up to date, so aren't cached"""
+    await memory_room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+    await memory_room_store.add_request(TEST_ROOM_ID, DELETE_REQUEST)
+    read_spy = mocker.spy(memory_room_store, 'read')
+    assert await room_cache.read_tokens(TEST_ROOM_ID) == []
+    assert await room_cache.read_tokens(TEST_ROOM_ID) == []
+    assert read_spy.call_count == 2
+
+
+async def test_snapshot_has_version_of_latest_update(
+    room_cache: RoomCache, memory_room_store: MemoryRoomStore
+) -> None:
+    await memory_room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+    async with room_cache.changes(TEST_ROOM_ID) as changes:
+        first_snapshot = await room_cache.read_snapshot(TEST_ROOM_ID)
+        await memory_room_store.add_request(TEST_ROOM_ID, VALID_MOVE_REQUEST)
+        (update,) = await async_collect(changes, 1)
+        second_snapshot = await room_cache.read_snapshot(TEST_ROOM_ID)
+
+    assert first_snapshot.version is not None
+    assert update.version == second_snapshot.version == first_snapshot.version + 1
+
+
+async def test_reads_updates_since_version(
+    room_cache: RoomCache, memory_room_store: MemoryRoomStore, mocker: MockerFixture
+) -> None:
+    await memory_room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+    version = (await memory_room_store.read_with_version(TEST_ROOM_ID)).version
+    assert version is not None
+    await memory_room_store.add_request(TEST_ROOM_ID, VALID_MOVE_REQUEST)
+
+    async with room_cache.changes(TEST_ROOM_ID):
+        assert await room_cache.read_updates_since(TEST_ROOM_ID, version) == [
+            UpdateResponse(VALID_MOVE_REQUEST.actions, VALID_MOVE_REQUEST.request_id)
+        ]
+
+        await room_cache.read_snapshot(TEST_ROOM_ID)
+        read_spy = mocker.spy(memory_room_store, 'read_requests_since')
+        # The cached room is already at that version, so there's nothing to read
+        assert await room_cache.read_updates_since(TEST_ROOM_ID, version + 1) == []
+        read_spy.assert_not_called()
+
+
+async def test_updates_are_merged_once_connection_is_behind(
+    memory_room_store: MemoryRoomStore,
+) -> None:
+    room_cache = RoomCache(
+        memory_room_store, max_queued_updates=10, coalesce_queued_updates=2
+    )
+    own_request_ids = {VALID_MOVE_REQUEST.request_id}
+    async with room_cache.changes(TEST_ROOM_ID, own_request_ids) as changes:
+        for request in [
+            VALID_REQUEST,
+            VALID_MOVE_REQUEST,
+            Request('another-request-id', [ANOTHER_VALID_ACTION]),
+        ]:
+            await memory_room_store.add_request(TEST_ROOM_ID, request)
+            await asyncio.sleep(0)
+
+        assert await async_collect(changes, 1) == [
+            UpdateResponse(
+                [
+                    DeleteAction(VALID_TOKEN.id),
+                    DeleteAction(ANOTHER_VALID_TOKEN.id),
+                    *VALID_MOVE_REQUEST.actions,
+                    ANOTHER_VALID_ACTION,
+                ],
+                VALID_MOVE_REQUEST.request_id,
+            )
+        ]
+    assert own_request_ids == set()
+    assert room_cache.fan_out_stats().coalesced_updates == 3
+
+
+async def test_merged_updates_keep_tokens_where_the_server_left_them(
+    memory_room_store: MemoryRoomStore,
+) -> None:
+    room_cache = RoomCache(
+        memory_room_store, max_queued_updates=10, coalesce_queued_updates=2
+    )
+    # Rejected, since it would put the token on top of another one
+    colliding_move = UpsertAction(
+        replace(VALID_TOKEN, start_x=1, start_y=1, start_z=1, end_x=2, end_y=2, end_z=2)
+    )
+    async with room_cache.changes(TEST_ROOM_ID) as changes:
+        for request in [
+            VALID_REQUEST,
+            Request('another-request-id', [ANOTHER_VALID_ACTION]),
+            Request('colliding-request-id', [colliding_move]),
+        ]:
+            await memory_room_store.add_request(TEST_ROOM_ID, request)
+            await asyncio.sleep(0)
+
+        assert await async_collect(changes, 1) == [
+            UpdateResponse(
+                [
+                    DeleteAction(ANOTHER_VALID_TOKEN.id),
+                    DeleteAction(VALID_TOKEN.id),
+                    ANOTHER_VALID_ACTION,
+                    VALID_ACTION,
+                ],
+                'colliding-request-id',
+            )
+        ]
+
+
+async def _fall_behind(memory_room_store: MemoryRoomStore) -> None:
+    """Add one more update than the room cache will queue for a connection"""
+    for request in [VALID_REQUEST, VALID_MOVE_REQUEST, DELETE_REQUEST]:
+        await memory_room_store.add_request(TEST_ROOM_ID, request)
+        # Let the room cache pass the update on
+        await asyncio.sleep(0)
+
+
+async def test_slow_connection_is_resynced(
+    room_cache: RoomCache, memory_room_store: MemoryRoomStore
+) -> None:
+    async with room_cache.changes(TEST_ROOM_ID) as changes:
+        await _fall_behind(memory_room_store)
+        await memory_room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+
+        assert await async_collect(changes, 3) == [
+            UpdateResponse([DeleteAction(VALID_TOKEN.id)], DELETE_REQUEST.request_id),
+            ConnectionResponse([VALID_TOKEN]),
+            UpdateResponse(VALID_REQUEST.actions, VALID_REQUEST.request_id),
+        ]
+    stats = room_cache.fan_out_stats()
+    assert stats.dropped_updates == 3
+    assert stats.resyncs == 1
+
+
+async def test_resynced_connection_is_sent_its_own_requests(
+    room_cache: RoomCache, memory_room_store: MemoryRoomStore
+) -> None:
+    own_request_ids = {VALID_REQUEST.request_id, DELETE_REQUEST.request_id}
+    async with room_cache.changes(TEST_ROOM_ID, own_request_ids) as changes:
+        await _fall_behind(memory_room_store)
+
+        assert await async_collect(changes, 3) == [
+            UpdateResponse([DeleteAction(VALID_TOKEN.id)], VALID_REQUEST.request_id),
+            ConnectionResponse([]),
+            UpdateResponse([], DELETE_REQUEST.request_id),
+        ]
+    assert own_request_ids == set()
+
+
+@pytest.mark.parametrize('room_cache', [SlowConnectionPolicy.DISCONNECT], indirect=True)
+async def test_slow_connection_is_disconnected(
+    room_cache: RoomCache, memory_room_store: MemoryRoomStore
+) -> None:
+    async with room_cache.changes(TEST_ROOM_ID) as changes:
+        await _fall_behind(memory_room_store)
+
+        with pytest.raises(SlowConnectionError):
+            await async_collect(changes, 1)
+    assert room_cache.fan_out_stats().slow_disconnects == 1
+
+
+@pytest.mark.parametrize('room_cache', [SlowConnectionPolicy.BLOCK], indirect=True)
+async def test_slow_connection_blocks_fan_out(
+    room_cache: RoomCache, memory_room_store: MemoryRoomStore
+) -> None:
+    async with room_cache.changes(TEST_ROOM_ID) as changes:
+        await _fall_behind(memory_room_store)
+        assert room_cache.fan_out_stats().max_queued_updates == 2
+
+        assert await async_collect(changes, 3) == [
+            UpdateResponse(request.actions, request.request_id)
+            for request in [VALID_REQUEST, VALID_MOVE_REQUEST, DELETE_REQUEST]
+        ]
+    assert room_cache.fan_out_stats().dropped_updates == 0
+
+
+async def test_cached_room_is_snapshotted(
+    memory_room_store: MemoryRoomStore, mocker: MockerFixture
+) -> None:
+    room_cache = RoomCache(memory_room_store, snapshot_interval_requests=2)
+    snapshot_spy = mocker.spy(memory_room_store, 'write_snapshot')
+    async with room_cache.changes(TEST_ROOM_ID) as changes:
+        await room_cache.read_tokens(TEST_ROOM_ID)
+        await memory_room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+        await memory_room_store.add_request(TEST_ROOM_ID, VALID_MOVE_REQUEST)
+        *_, update = await async_collect(changes, 2)
+
+    snapshot_spy.assert_called_once_with(
+        TEST_ROOM_ID, [UpsertAction(UPDATED_TOKEN)], update.version
+    )
+
+
+async def test_snapshots_dont_hold_up_updates(
+    memory_room_store: MemoryRoomStore, mocker: MockerFixture
+) -> None:
+    room_cache = RoomCache(memory_room_store, snapshot_interval_requests=1)
+    written = asyncio.Event()
+    snapshot_versions = []
+
+    async def slow_write_snapshot(
+        room_id: str, actions: list[UpsertAction], version: int
+    ) -> None:
+        snapshot_versions.append(version)
+        await written.wait()
+
+    mocker.patch.object(memory_room_store, 'write_snapshot', slow_write_snapshot)
+    async with room_cache.changes(TEST_ROOM_ID) as changes:
+        await room_cache.read_tokens(TEST_ROOM_ID)
+        for request in [VALID_REQUEST, VALID_MOVE_REQUEST, DELETE_REQUEST]:
+            await memory_room_store.add_request(TEST_ROOM_ID, request)
+        first, *_ = await asyncio.wait_for(async_collect(changes, 3), timeout=1)
+
+        # Only one snapshot is saved at a time
+        assert snapshot_versions == [first.version]
+        written.set()
+        await memory_room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+        (last,) = await async_collect(changes, 1)
+        await asyncio.sleep(0)
+
+    assert snapshot_versions == [first.version, last.version]
@@ -1,17 +1,39 @@
 import asyncio
+import json
+import random
 from asyncio import CancelledError
+from collections.abc import AsyncIterator, Callable, Iterable
+from contextlib import AbstractAsyncContextManager, nullcontext
+from dataclasses import asdict, replace
 from datetime import timedelta
+from json import JSONDecodeError
+from typing import Any
 
 import pytest
 import time_machine
 from pytest_lazy_fixtures import lf
-
+from pytest_mock import MockerFixture
 from redis.asyncio.client import Redis
-from src.api.api_structures import Action, Request
-from src.room_store.common import NoSuchRoomError
-from src.room_store.redis_room_store import create_redis_room_store
+from redis.exceptions import ConnectionError, ReadOnlyError, RedisError
+
+from src.api.api_structures import Action, DeleteAction, Request, UpsertAction
+from src.game_components import Token
+from src.room import create_room
+from src.room_store import redis_room_listener
+from src.room_store.common import EAGER_COMPACTION_COOLDOWN_SECONDS, NoSuchRoomError
+from src.room_store.json_to_actions import json_to_actions
+from src.room_store.memory_room_store import MemoryRoomStorage, MemoryRoomStore
+from src.room_store.redis_room_listener import ListenerFellBehindError
+from src.room_store.redis_room_store import (
+    ROOM_ACTIVITY_KEY,
+    ROOM_ACTIVITY_RETENTION_SECONDS,
+    create_redis_room_store,
+)
+from src.room_store.redis_stream_listener import room_stream_key
+from src.room_store.redis_stream_room_store import create_redis_stream_room_store
 from src.room_store.room_store import (
     COMPACTION_LOCK_EXPIRATION_SECONDS,
+    HYDRATION_LOCK_EXPIRATION_SECONDS,
     RoomStore,
     UnexpectedReplacementId,
     UnexpectedReplacementToken,
@@ -19,6 +41,7 @@ from src.room_store.room_store import (
 from src.util.async_util import async_collect
 from tests.static_fixtures import (
     ANOTHER_VALID_ACTION,
+    ANOTHER_VALID_TOKEN,
     DELETE_REQUEST,
     PING_ACTION,
     TEST_REQUEST_ID,
@@ -26,6 +49,7 @@ from tests.static_fixtures import (
     VALID_ACTION,
     VALID_MOVE_REQUEST,
     VALID_REQUEST,
+    VALID_TOKEN,
 )
 
 any_room_store = pytest.mark.parametrize(
@@ -33,6 +57,21 @@ any_room_store = pytest.mark.parametrize(
     [
         lf('memory_room_store'),
         lf('redis_room_store'),
+        lf('batched_redis_room_store'),
+        lf('redis_hash_room_store'),
+        lf('redis_stream_room_store'),
+        lf('merged_room_store'),
+    ],
+)
+
+# Room stores that keep a log of every action instead of just the current state
+log_room_store = pytest.mark.parametrize(
+    'room_store',
+    [
+        lf('memory_room_store'),
+        lf('redis_room_store'),
+        lf('batched_redis_room_store'),
+        lf('redis_stream_room_store'),
         lf('merged_room_store'),
     ],
 )
@@ -85,6 +124,20 @@ async def test_change_notification_error(
         await sub_task
 
 
+async def test_listener_that_falls_behind_is_ended(
+    redis_room_store: RoomStore, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(redis_room_listener, 'MAX_QUEUED_CHANGES', 1)
+    changes = await redis_room_store.changes(TEST_ROOM_ID)
+    await redis_room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+    await redis_room_store.add_request(TEST_ROOM_ID, VALID_MOVE_REQUEST)
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+    with pytest.raises(ListenerFellBehindError):
+        await async_collect(changes, count=1)
+
+
 @any_room_store
 async def test_replacement_lock(room_store: RoomStore) -> None:
     success = await room_store.acquire_replacement_lock('compaction_id_1')
@@ -94,6 +147,34 @@ async def test_replacement_lock(room_store: RoomStore) -> None:
     assert not success
 
 
+@any_room_store
+async def test_hydration_lock(room_store: RoomStore) -> None:
+    with time_machine.travel('1970-01-01', tick=False) as traveller:
+        assert await room_store.acquire_hydration_lock(TEST_ROOM_ID, 'loader_1')
+        assert not await room_store.acquire_hydration_lock(TEST_ROOM_ID, 'loader_2')
+        assert await room_store.acquire_hydration_lock('other_room', 'loader_2')
+
+        await room_store.release_hydration_lock(TEST_ROOM_ID, 'loader_1')
+        assert await room_store.acquire_hydration_lock(TEST_ROOM_ID, 'loader_2')
+
+        traveller.shift(timedelta(seconds=HYDRATION_LOCK_EXPIRATION_SECONDS + 1))
+        assert await room_store.acquire_hydration_lock(TEST_ROOM_ID, 'loader_3')
+
+
+@any_room_store
+async def test_hydration_lock_is_only_released_by_its_holder(
+    room_store: RoomStore,
+) -> None:
+    with time_machine.travel('1970-01-01', tick=False) as traveller:
+        assert await room_store.acquire_hydration_lock(TEST_ROOM_ID, 'slow_loader')
+        traveller.shift(timedelta(seconds=HYDRATION_LOCK_EXPIRATION_SECONDS + 1))
+        assert await room_store.acquire_hydration_lock(TEST_ROOM_ID, 'new_loader')
+
+        # The slow loader finishing doesn't release the new loader's lock
+        await room_store.release_hydration_lock(TEST_ROOM_ID, 'slow_loader')
+        assert not await room_store.acquire_hydration_lock(TEST_ROOM_ID, 'loader')
+
+
 @any_room_store
 async def test_replace(room_store: RoomStore) -> None:
     await room_store.add_request('room-id-1', VALID_REQUEST)
@@ -109,6 +190,23 @@ async def test_replace(room_store: RoomStore) -> None:
 
 
 @any_room_store
+async def test_replace_raw(room_store: RoomStore) -> None:
+    await room_store.add_request('room-id-1', VALID_REQUEST)
+
+    await room_store.acquire_replacement_lock('compaction_id')
+    raw_data = await room_store.read_raw_for_replacement('room-id-1')
+    assert list(json_to_actions(raw_data.updates)) == [VALID_ACTION]
+
+    await room_store.replace_raw(
+        'room-id-1',
+        json.dumps([asdict(ANOTHER_VALID_ACTION)]).encode(),
+        raw_data.replace_token,
+        'compaction_id',
+    )
+    assert list(await room_store.read('room-id-1')) == [ANOTHER_VALID_ACTION]
+
+
+@log_room_store
 async def test_replace_concurrent_updates(room_store: RoomStore) -> None:
     await room_store.add_request('room-id-1', VALID_REQUEST)
 
@@ -231,6 +329,117 @@ async def test_get_nonexistent_room_idle_seconds(room_store: RoomStore) -> None:
         await room_store.get_room_idle_seconds('nonexistent_room')
 
 
+@any_room_store
+async def test_get_idle_room_ids(room_store: RoomStore) -> None:
+    with time_machine.travel('1970-01-01', tick=False) as traveller:
+        await room_store.add_request('idle_room', VALID_REQUEST)
+        traveller.shift(timedelta(seconds=100))
+        await room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+        traveller.shift(timedelta(seconds=50))
+        idle_room_ids = [room_id async for room_id in room_store.get_idle_room_ids(100)]
+        assert idle_room_ids == ['idle_room']
+
+
+@pytest.mark.parametrize(
+    'room_store',
+    [
+        lf('redis_room_store'),
+        lf('redis_hash_room_store'),
+        lf('redis_stream_room_store'),
+    ],
+)
+async def test_read_only_leaves_activity_alone(
+    redis: Redis, room_store: RoomStore
+) -> None:
+    with time_machine.travel('1970-01-01', tick=False) as traveller:
+        await room_store.add_request('forgotten_room', VALID_REQUEST)
+        await room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+        await redis.zrem(ROOM_ACTIVITY_KEY, TEST_ROOM_ID)
+        traveller.shift(timedelta(seconds=ROOM_ACTIVITY_RETENTION_SECONDS + 1))
+
+        await room_store.read_for_replacement(TEST_ROOM_ID, read_only=True)
+        await room_store.read_raw_for_replacement(TEST_ROOM_ID, read_only=True)
+        assert await room_store.get_room_idle_seconds(TEST_ROOM_ID, read_only=True) == 0
+        assert [
+            room_id async for room_id in room_store.get_idle_room_ids(0, read_only=True)
+        ] == ['forgotten_room']
+
+    assert await redis.zscore(ROOM_ACTIVITY_KEY, TEST_ROOM_ID) is None
+
+
+@any_room_store
+async def test_drain_dirty_room_ids(room_store: RoomStore) -> None:
+    await room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+    await room_store.write_if_missing('other_room', [VALID_ACTION])
+    await room_store.read('read_only_room')
+    assert await room_store.drain_dirty_room_ids() == {TEST_ROOM_ID, 'other_room'}
+    assert await room_store.drain_dirty_room_ids() == set()
+
+
+@any_room_store
+async def test_add_dirty_room_ids(room_store: RoomStore) -> None:
+    await room_store.add_dirty_room_ids([TEST_ROOM_ID, 'other_room'])
+    await room_store.add_dirty_room_ids([])
+    assert await room_store.drain_dirty_room_ids() == {TEST_ROOM_ID, 'other_room'}
+
+
+def _memory_room_store_context(
+    redis: Redis, eager_compaction_length: int
+) -> AbstractAsyncContextManager[RoomStore]:
+    return nullcontext(
+        MemoryRoomStore(
+            MemoryRoomStorage(), eager_compaction_length=eager_compaction_length
+        )
+    )
+
+
+# Room stores that grow with every request, and can be asked to queue rooms that
+# grow too long to be compacted right away
+eager_compaction_room_store_context = pytest.mark.parametrize(
+    'room_store_context',
+    [
+        _memory_room_store_context,
+        create_redis_room_store,
+        create_redis_stream_room_store,
+    ],
+)
+
+RoomStoreContext = Callable[..., AbstractAsyncContextManager[RoomStore]]
+
+
+@eager_compaction_room_store_context
+async def test_oversized_rooms_queued_once_per_cooldown(
+    redis: Redis, room_store_context: RoomStoreContext
+) -> None:
+    room_store: RoomStore
+    with time_machine.travel('1970-01-01', tick=False) as traveller:
+        async with room_store_context(redis, eager_compaction_length=2) as room_store:
+            await room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+            await room_store.add_request('other_room', VALID_REQUEST)
+            assert await room_store.drain_oversized_room_ids() == set()
+
+            await room_store.add_request(TEST_ROOM_ID, VALID_MOVE_REQUEST)
+            assert await room_store.drain_oversized_room_ids() == {TEST_ROOM_ID}
+            assert await room_store.drain_oversized_room_ids() == set()
+
+            await room_store.add_request(TEST_ROOM_ID, VALID_MOVE_REQUEST)
+            assert await room_store.drain_oversized_room_ids() == set()
+
+            traveller.shift(timedelta(seconds=EAGER_COMPACTION_COOLDOWN_SECONDS + 1))
+            await room_store.add_request(TEST_ROOM_ID, VALID_MOVE_REQUEST)
+            assert await room_store.drain_oversized_room_ids() == {TEST_ROOM_ID}
+
+
+@eager_compaction_room_store_context
+async def test_oversized_rooms_not_queued_when_disabled(
+    redis: Redis, room_store_context: RoomStoreContext
+) -> None:
+    async with room_store_context(redis, eager_compaction_length=0) as room_store:
+        for _ in range(3):
+            await room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+        assert await room_store.drain_oversized_room_ids() == set()
+
+
 @any_room_store
 async def test_write_if_missing(room_store: RoomStore) -> None:
     await room_store.write_if_missing(TEST_ROOM_ID, [VALID_ACTION])
@@ -244,6 +453,92 @@ async def test_write_if_missing_does_not_overwrite(room_store: RoomStore) -> Non
     assert list(await room_store.read(TEST_ROOM_ID)) == [VALID_ACTION]
 
 
+@any_room_store
+async def test_requests_are_versioned(room_store: RoomStore) -> None:
+    changes = await room_store.changes(TEST_ROOM_ID)
+    sub_task = asyncio.create_task(async_collect(changes, count=2))
+
+    await room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+    await room_store.add_request(TEST_ROOM_ID, VALID_MOVE_REQUEST)
+    first, second = await sub_task
+    assert first.version is not None and second.version == first.version + 1
+    room = await room_store.read_with_version(TEST_ROOM_ID)
+    assert room.version == second.version
+
+
+@any_room_store
+async def test_read_requests_since(room_store: RoomStore) -> None:
+    await room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+    version = (await room_store.read_with_version(TEST_ROOM_ID)).version
+    assert version is not None
+    await room_store.add_request(TEST_ROOM_ID, VALID_MOVE_REQUEST)
+    await room_store.add_request(TEST_ROOM_ID, DELETE_REQUEST)
+
+    assert await room_store.read_requests_since(TEST_ROOM_ID, version) == [
+        VALID_MOVE_REQUEST,
+        DELETE_REQUEST,
+    ]
+    assert await room_store.read_requests_since(TEST_ROOM_ID, version + 2) == []
+    # The room hasn't reached this version yet
+    assert await room_store.read_requests_since(TEST_ROOM_ID, version + 3) is None
+
+
+@any_room_store
+async def test_read_requests_since_requests_no_longer_logged(
+    room_store: RoomStore, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    for module in (
+        'memory_room_store',
+        'redis_room_store',
+        'redis_hash_room_store',
+        'redis_stream_room_store',
+    ):
+        monkeypatch.setattr(f'src.room_store.{module}.ROOM_LOG_LENGTH', 1)
+    await room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+    version = (await room_store.read_with_version(TEST_ROOM_ID)).version
+    assert version is not None
+    await room_store.add_request(TEST_ROOM_ID, VALID_MOVE_REQUEST)
+    await room_store.add_request(TEST_ROOM_ID, DELETE_REQUEST)
+
+    assert await room_store.read_requests_since(TEST_ROOM_ID, version) is None
+    assert await room_store.read_requests_since(TEST_ROOM_ID, version + 1) == [
+        DELETE_REQUEST
+    ]
+
+
+@any_room_store
+async def test_room_brought_back_does_not_reuse_versions(
+    room_store: RoomStore,
+) -> None:
+    with time_machine.travel('2020-01-01', tick=False) as traveller:
+        await room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+        old_version = (await room_store.read_with_version(TEST_ROOM_ID)).version
+        await room_store.acquire_replacement_lock('replacer_id')
+        replace_data = await room_store.read_for_replacement(TEST_ROOM_ID)
+        await room_store.delete(TEST_ROOM_ID, 'replacer_id', replace_data.replace_token)
+
+        traveller.shift(timedelta(seconds=1))
+        await room_store.write_if_missing(TEST_ROOM_ID, [VALID_ACTION])
+        new_version = (await room_store.read_with_version(TEST_ROOM_ID)).version
+
+    assert old_version is not None and new_version is not None
+    assert new_version > old_version
+    assert await room_store.read_requests_since(TEST_ROOM_ID, old_version) is None
+
+
+async def test_unversioned_change_notifications(
+    redis: Redis, redis_room_store: RoomStore
+) -> None:
+    changes = await redis_room_store.changes(TEST_ROOM_ID)
+    sub_task = asyncio.create_task(async_collect(changes, count=1))
+
+    # Servers that don't version rooms yet publish just the request
+    await redis.publish(f'channel:{TEST_ROOM_ID}', json.dumps(asdict(VALID_REQUEST)))
+    (request,) = await sub_task
+    assert request == VALID_REQUEST
+    assert request.version is None
+
+
 @any_room_store
 async def test_get_last_activity_time(room_store: RoomStore) -> None:
     with time_machine.travel('1970-01-01', tick=False) as traveller:
@@ -267,3 +562,275 @@ async def test_change_subscription_throws_when_closed(redis: Redis) -> None:
 
     with pytest.raises(CancelledError):
         await async_collect(test)
+
+
+@any_room_store
+async def test_replace_notifies_invalidations(room_store: RoomStore) -> None:
+    await room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+    invalidations = await room_store.invalidations()
+    sub_task = asyncio.create_task(async_collect(invalidations, count=2))
+
+    await room_store.acquire_replacement_lock('replacer_id')
+    replace_data = await room_store.read_for_replacement(TEST_ROOM_ID)
+    await room_store.replace(
+        TEST_ROOM_ID, [VALID_ACTION], replace_data.replace_token, 'replacer_id'
+    )
+    replace_data = await room_store.read_for_replacement(TEST_ROOM_ID)
+    await room_store.delete(TEST_ROOM_ID, 'replacer_id', replace_data.replace_token)
+    assert await sub_task == [TEST_ROOM_ID, TEST_ROOM_ID]
+
+
+list_room_store = pytest.mark.parametrize(
+    'room_store', [lf('redis_room_store'), lf('batched_redis_room_store')]
+)
+
+
+@list_room_store
+async def test_read_skips_requests_before_snapshot(room_store: RoomStore) -> None:
+    await room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+    version = (await room_store.read_with_version(TEST_ROOM_ID)).version
+    assert version is not None
+    # The snapshot doesn't match the request before it, which shows that request
+    # isn't read
+    await room_store.write_snapshot(TEST_ROOM_ID, [ANOTHER_VALID_ACTION], version)
+    await room_store.add_request(TEST_ROOM_ID, DELETE_REQUEST)
+
+    room = await room_store.read_with_version(TEST_ROOM_ID)
+    assert list(room.actions) == [ANOTHER_VALID_ACTION, *DELETE_REQUEST.actions]
+    assert room.version == version + 1
+    replace_data = await room_store.read_for_replacement(TEST_ROOM_ID)
+    assert replace_data.actions == [ANOTHER_VALID_ACTION, *DELETE_REQUEST.actions]
+
+
+@list_room_store
+async def test_older_snapshot_is_not_saved(room_store: RoomStore) -> None:
+    await room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+    await room_store.add_request(TEST_ROOM_ID, VALID_MOVE_REQUEST)
+    version = (await room_store.read_with_version(TEST_ROOM_ID)).version
+    assert version is not None
+    await room_store.write_snapshot(TEST_ROOM_ID, [ANOTHER_VALID_ACTION], version)
+    await room_store.write_snapshot(TEST_ROOM_ID, [VALID_ACTION], version - 1)
+
+    assert list(await room_store.read(TEST_ROOM_ID)) == [ANOTHER_VALID_ACTION]
+
+
+@list_room_store
+async def test_snapshot_of_missing_room_is_not_saved(room_store: RoomStore) -> None:
+    await room_store.write_snapshot(TEST_ROOM_ID, [VALID_ACTION], 1)
+    assert list(await room_store.read(TEST_ROOM_ID)) == []
+    assert not await room_store.room_exists(TEST_ROOM_ID)
+
+
+@list_room_store
+async def test_compaction_drops_older_snapshot(
+    redis: Redis, room_store: RoomStore
+) -> None:
+    await room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+    version = (await room_store.read_with_version(TEST_ROOM_ID)).version
+    assert version is not None
+    await room_store.write_snapshot(TEST_ROOM_ID, [VALID_ACTION], version)
+    await room_store.add_request(TEST_ROOM_ID, DELETE_REQUEST)
+
+    await room_store.acquire_replacement_lock('replacer_id')
+    replace_data = await room_store.read_for_replacement(TEST_ROOM_ID)
+    await room_store.replace(
+        TEST_ROOM_ID, [ANOTHER_VALID_ACTION], replace_data.replace_token, 'replacer_id'
+    )
+    assert not await redis.exists(f'room-snapshot:{TEST_ROOM_ID}')
+
+    # Even if it's saved again, the compacted room is read instead
+    await room_store.write_snapshot(TEST_ROOM_ID, [VALID_ACTION], version)
+    await room_store.add_request(TEST_ROOM_ID, VALID_MOVE_REQUEST)
+    assert list(await room_store.read(TEST_ROOM_ID)) == [
+        ANOTHER_VALID_ACTION,
+        *VALID_MOVE_REQUEST.actions,
+    ]
+
+
+async def test_hash_room_store_rejects_overlapping_tokens(
+    redis_hash_room_store: RoomStore,
+) -> None:
+    overlapping_action = UpsertAction(
+        replace(ANOTHER_VALID_TOKEN, start_x=0, start_y=0, start_z=0)
+    )
+    await redis_hash_room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+    await redis_hash_room_store.add_request(
+        TEST_ROOM_ID, Request(TEST_REQUEST_ID, [overlapping_action])
+    )
+    assert list(await redis_hash_room_store.read(TEST_ROOM_ID)) == [VALID_ACTION]
+
+
+async def test_hash_room_store_indexes_tokens_not_cells(
+    redis: Redis, redis_hash_room_store: RoomStore
+) -> None:
+    floor = replace(
+        ANOTHER_VALID_TOKEN,
+        type='floor',
+        start_x=-100,
+        start_y=-100,
+        start_z=0,
+        end_x=100,
+        end_y=100,
+        end_z=1,
+    )
+    await redis_hash_room_store.add_request(
+        TEST_ROOM_ID, Request(TEST_REQUEST_ID, [UpsertAction(floor)])
+    )
+    await redis_hash_room_store.add_request(
+        TEST_ROOM_ID,
+        Request(
+            TEST_REQUEST_ID,
+            [
+                UpsertAction(replace(VALID_TOKEN, start_x=50, end_x=51)),
+                UpsertAction(replace(VALID_TOKEN, id='on_floor', start_z=1, end_z=2)),
+            ],
+        ),
+    )
+
+    assert [
+        (action.data.id, action.data.start_z)
+        for action in await redis_hash_room_store.read(TEST_ROOM_ID)
+        if isinstance(action, UpsertAction)
+    ] == [(floor.id, 0), ('on_floor', 1)]
+    # A field per bucket the floor covers, instead of one for each of its 40,000
+    # cells
+    assert await redis.hlen(f'room-index:{TEST_ROOM_ID}') < 1000
+
+
+async def test_hash_room_store_applies_actions_like_room(
+    redis_hash_room_store: RoomStore,
+) -> None:
+    all_actions: list[Action] = []
+    for _ in range(30):
+        actions: list[Action] = []
+        for _ in range(10):
+            # Ids that look like the bucket encoding can't confuse it
+            token_id = f'token:{random.randrange(40)};'
+            if random.random() < 0.2:
+                actions.append(DeleteAction(token_id))
+                continue
+            x, y, z = (random.randrange(-40, 40) for _ in range(3))
+            token = replace(
+                VALID_TOKEN,
+                id=token_id,
+                start_x=x,
+                start_y=y,
+                start_z=z,
+                end_x=x + random.choice([1, 2, 20, 40]),
+                end_y=y + random.choice([1, 2, 20]),
+                end_z=z + 1,
+            )
+            actions.append(UpsertAction(token))
+        await redis_hash_room_store.add_request(
+            TEST_ROOM_ID, Request(TEST_REQUEST_ID, actions)
+        )
+        all_actions += actions
+
+    def token_boxes(tokens: Iterable[Token]) -> set[tuple[Any, ...]]:
+        return {
+            (t.id, t.start_x, t.start_y, t.start_z, t.end_x, t.end_y, t.end_z)
+            for t in tokens
+        }
+
+    stored = await redis_hash_room_store.read(TEST_ROOM_ID)
+    assert token_boxes(
+        action.data for action in stored if isinstance(action, UpsertAction)
+    ) == token_boxes(create_room(all_actions).game_state.values())
+
+
+async def test_hash_room_store_keeps_creation_order(
+    redis_hash_room_store: RoomStore,
+) -> None:
+    await redis_hash_room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+    await redis_hash_room_store.add_request(
+        TEST_ROOM_ID, Request(TEST_REQUEST_ID, [ANOTHER_VALID_ACTION])
+    )
+    await redis_hash_room_store.add_request(TEST_ROOM_ID, VALID_MOVE_REQUEST)
+    assert list(await redis_hash_room_store.read(TEST_ROOM_ID)) == [
+        *VALID_MOVE_REQUEST.actions,
+        ANOTHER_VALID_ACTION,
+    ]
+
+
+async def test_hash_room_store_skips_replacing_changed_room(
+    redis_hash_room_store: RoomStore,
+) -> None:
+    await redis_hash_room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+    await redis_hash_room_store.acquire_replacement_lock('replacer_id')
+    replace_data = await redis_hash_room_store.read_for_replacement(TEST_ROOM_ID)
+    await redis_hash_room_store.add_request(TEST_ROOM_ID, VALID_MOVE_REQUEST)
+
+    await redis_hash_room_store.replace(
+        TEST_ROOM_ID, [ANOTHER_VALID_ACTION], replace_data.replace_token, 'replacer_id'
+    )
+    assert (
+        list(await redis_hash_room_store.read(TEST_ROOM_ID))
+        == VALID_MOVE_REQUEST.actions
+    )
+
+
+@pytest.mark.parametrize(
+    'error',
+    [
+        ConnectionError(),
+        # Raised while redis fails over to a replica
+        ReadOnlyError("You can't write against a read only replica."),
+    ],
+)
+async def test_stream_listener_reads_on_after_reconnecting(
+    redis: Redis,
+    redis_stream_room_store: RoomStore,
+    mocker: MockerFixture,
+    error: RedisError,
+) -> None:
+    xread = redis.xread
+    disconnected = False
+
+    async def disconnect_once(*args: Any, **kwargs: Any) -> Any:
+        nonlocal disconnected
+        if not disconnected:
+            disconnected = True
+            # A change made while the connection is down
+            await redis_stream_room_store.add_request(TEST_ROOM_ID, VALID_REQUEST)
+            raise error
+        return await xread(*args, **kwargs)
+
+    mocker.patch.object(redis, 'xread', disconnect_once)
+    changes = await redis_stream_room_store.changes(TEST_ROOM_ID)
+    assert await async_collect(changes, count=1) == [VALID_REQUEST]
+
+
+async def test_stream_listener_wakes_up_for_rooms_listened_to_mid_read(
+    redis: Redis, redis_stream_room_store: RoomStore, mocker: MockerFixture
+) -> None:
+    xread = redis.xread
+    other_changes: list[AsyncIterator[Request]] = []
+
+    async def listen_before_read(*args: Any, **kwargs: Any) -> Any:
+        if not other_changes:
+            # Listened to after the streams to read were chosen, but before the
+            # read reached redis
+            other_changes.append(await redis_stream_room_store.changes('other_room'))
+        return await xread(*args, **kwargs)
+
+    mocker.patch.object(redis, 'xread', listen_before_read)
+    await redis_stream_room_store.changes(TEST_ROOM_ID)
+    while not other_changes:
+        await asyncio.sleep(0)
+
+    await redis_stream_room_store.add_request('other_room', VALID_REQUEST)
+    # Without the wakeup, the read would block until it timed out
+    assert await asyncio.wait_for(
+        async_collect(other_changes[0], count=1), timeout=1
+    ) == [VALID_REQUEST]
+
+
+async def test_stream_change_notification_error(
+    redis: Redis, redis_stream_room_store: RoomStore
+) -> None:
+    changes = await redis_stream_room_store.changes(TEST_ROOM_ID)
+    sub_task = asyncio.create_task(async_collect(changes, count=1))
+
+    await redis.xadd(room_stream_key(TEST_ROOM_ID), {'request': 'INVALID REQUEST'})
+    with pytest.raises(JSONDecodeError):
+        await sub_task
@@ -0,0 +1,38 @@
+import pytest
+
+from src.spatial_index import BoxIndex
+
+
+@pytest.fixture
+def index() -> BoxIndex:
+    return BoxIndex(cell_size=4)
+
+
+def test_finds_overlapping_box(index: BoxIndex) -> None:
+    index.insert('box', (0, 0, 0, 2, 2, 1))
+    assert list(index.intersecting((1, 1, 0, 3, 3, 1))) == ['box']
+
+
+def test_touching_boxes_do_not_overlap(index: BoxIndex) -> None:
+    index.insert('box', (0, 0, 0, 4, 4, 1))
+    assert not index.any_intersecting((4, 0, 0, 5, 1, 1))
+    assert not index.any_intersecting((0, 0, 1, 1, 1, 2))
+
+
+def test_box_spanning_many_cells_reported_once(index: BoxIndex) -> None:
+    index.insert('floor', (-10, -10, 0, 200, 200, 1))
+    assert list(index.intersecting((-20, -20, 0, 300, 300, 1))) == ['floor']
+
+
+def test_remove(index: BoxIndex) -> None:
+    index.insert('box', (0, 0, 0, 9, 9, 1))
+    index.remove('box')
+    assert not index.any_intersecting((0, 0, 0, 9, 9, 1))
+    assert len(index) == 0
+
+
+def test_insert_replaces_existing_box(index: BoxIndex) -> None:
+    index.insert('box', (0, 0, 0, 1, 1, 1))
+    index.insert('box', (10, 10, 0, 11, 11, 1))
+    assert not index.any_intersecting((0, 0, 0, 1, 1, 1))
+    assert list(index.intersecting((10, 10, 0, 11, 11, 1))) == ['box']
@@ -0,0 +1,101 @@
+import asyncio
+from typing import Any
+
+import pytest
+from pytest_mock import MockerFixture
+from redis.asyncio.client import Pipeline, Redis
+from redis.exceptions import ResponseError
+
+from src.api.api_structures import Request
+from src.room import create_room
+from src.room_store.redis_hash_room_store import create_redis_hash_room_store
+from src.room_store.redis_room_store import create_redis_room_store
+from src.room_store.redis_stream_room_store import create_redis_stream_room_store
+from src.room_store.write_coalescer import WriteCoalescer
+from src.util.async_util import async_collect
+from tests.static_fixtures import (
+    ANOTHER_VALID_ACTION,
+    UPDATED_TOKEN,
+    VALID_ACTION,
+    VALID_MOVE_REQUEST,
+    VALID_REQUEST,
+)
+
+
+@pytest.mark.parametrize(
+    'create_store',
+    [
+        create_redis_room_store,
+        create_redis_hash_room_store,
+        create_redis_stream_room_store,
+    ],
+)
+async def test_writes_concurrent_requests_together(
+    redis: Redis, mocker: MockerFixture, create_store: Any
+) -> None:
+    execute_spy = mocker.spy(Pipeline, 'execute')
+    async with create_store(redis, write_batch_window_seconds=0) as room_store:
+        await asyncio.gather(
+            room_store.add_request('room-1', VALID_REQUEST),
+            room_store.add_request('room-1', VALID_MOVE_REQUEST),
+            room_store.add_request(
+                'room-2', Request('request-id', [ANOTHER_VALID_ACTION])
+            ),
+        )
+        execute_spy.assert_called_once()
+
+        assert list(await room_store.read('room-2')) == [ANOTHER_VALID_ACTION]
+        # Requests to the same room are written in the order they were added
+        room = create_room(await room_store.read('room-1'))
+        assert list(room.game_state.values()) == [UPDATED_TOKEN]
+
+
+async def test_failed_write_does_not_fail_batch(redis: Redis) -> None:
+    # A room key that isn't a list can't be appended to
+    await redis.set('room:bad-room', 'not a list')
+    async with create_redis_room_store(redis, write_batch_window_seconds=0) as store:
+        results = await asyncio.gather(
+            store.add_request('bad-room', VALID_REQUEST),
+            store.add_request('good-room', VALID_REQUEST),
+            return_exceptions=True,
+        )
+        assert isinstance(results[0], ResponseError)
+        assert results[1] is None
+        assert list(await store.read('good-room')) == [VALID_ACTION]
+
+
+async def test_write_failing_to_queue_does_not_fail_batch(redis: Redis) -> None:
+    coalescer = WriteCoalescer(redis)
+
+    async def queue_bad_commands(pipeline: Pipeline) -> None:
+        await pipeline.set('bad-key', 'value')
+        raise ValueError('Failed to queue')
+
+    async def queue_commands(pipeline: Pipeline) -> None:
+        await pipeline.set('key', 'value')
+
+    results = await asyncio.gather(
+        coalescer.write(queue_bad_commands),
+        coalescer.write(queue_commands),
+        return_exceptions=True,
+    )
+    await coalescer.close()
+
+    assert isinstance(results[0], ValueError)
+    assert results[1] is None
+    assert await redis.get('key') == b'value'
+    assert await redis.get('bad-key') is None
+
+
+async def test_close_cancels_pending_writes(redis: Redis) -> None:
+    coalescer = WriteCoalescer(redis)
+
+    async def queue_commands(pipeline: Pipeline) -> None:
+        await pipeline.set('key', 'value')
+
+    write_task = asyncio.create_task(coalescer.write(queue_commands))
+    await asyncio.sleep(0)
+    await coalescer.close()
+    with pytest.raises(asyncio.CancelledError):
+        await write_task
+    assert await async_collect(redis.scan_iter('key')) == []